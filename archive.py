@@ -0,0 +1,180 @@
+
+import os
+import io
+import time
+import logging
+import hashlib
+import tarfile
+
+import checksum
+
+# Size of blocks copied in the archive
+_BLOCK_SIZE = 1024 * 1024
+
+#===============================================================================
+# File object wrapper updating hashes with data read (so files are hashed while
+# tarfile copies them in the archive, without reading them again).
+#===============================================================================
+class _HashingReader(object):
+    def __init__(self, fd, hashes):
+        self.fd = fd
+        self.hashes = hashes
+
+    def read(self, size=-1):
+        data = self.fd.read(size)
+        for _hash in self.hashes:
+            _hash.update(data)
+        return data
+
+#===============================================================================
+# Create a tar member not related to an existing file.
+#===============================================================================
+def _new_tarinfo(name, mode):
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.mode = mode
+    tarinfo.mtime = int(time.time())
+    tarinfo.uid = os.getuid()
+    tarinfo.gid = os.getgid()
+    return tarinfo
+
+#===============================================================================
+# Tar archive writer computing checksums of files while they are added.
+# Like 'tar -h', symlinks are followed. Entries named '.git' are excluded and
+# files starting with '.git' are not listed in checksum files.
+# Checksum files (md5sum.txt...) are added as last members when the archive is
+# closed without error.
+#===============================================================================
+class ReleaseArchive(object):
+    def __init__(self, tar_path, algorithms=("md5",), cache_path=None):
+        self.tar_path = tar_path
+        self.algorithms = list(algorithms)
+        self.checksum_cache = checksum.ChecksumCache(cache_path) \
+                if cache_path else None
+        self.checksums = []
+        self.dirs = set()
+        self.inodes = {}
+        self.tar = None
+
+    def __enter__(self):
+        self.tar = tarfile.open(self.tar_path, "w",
+                format=tarfile.GNU_FORMAT, dereference=True,
+                copybufsize=_BLOCK_SIZE)
+        self._add_dir(".", None)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self._add_checksum_files()
+        finally:
+            self.tar.close()
+        if exc_type is None and self.checksum_cache:
+            self.checksum_cache.save()
+
+    # Add a file or directory (recursively) in the archive at given path
+    # (relative to the top of the archive)
+    def add(self, src, dest):
+        arcname = os.path.join(".", os.path.normpath(dest))
+        self._add_parent_dirs(arcname)
+        if os.path.isdir(src):
+            for dirpath, dirnames, filenames in checksum.walk(src):
+                dirnames[:] = sorted([name for name in dirnames if name != ".git"])
+                reldir = os.path.normpath(os.path.join(arcname,
+                        os.path.relpath(dirpath, src)))
+                self._add_dir(os.path.join(".", reldir), dirpath)
+                for filename in sorted(filenames):
+                    if filename == ".git":
+                        continue
+                    filepath = os.path.join(dirpath, filename)
+                    if os.path.isfile(filepath):
+                        self._add_file(filepath,
+                                os.path.join(".", reldir, filename))
+        else:
+            self._add_file(src, arcname)
+
+    def _add_parent_dirs(self, arcname):
+        parent = os.path.dirname(arcname)
+        if parent and parent not in self.dirs:
+            self._add_parent_dirs(parent)
+            self._add_dir(parent, None)
+
+    def _add_dir(self, arcname, dirpath):
+        if arcname in self.dirs:
+            return
+        self.dirs.add(arcname)
+        if dirpath:
+            tarinfo = self.tar.gettarinfo(dirpath, arcname)
+        else:
+            tarinfo = _new_tarinfo(arcname, 0o755)
+            tarinfo.type = tarfile.DIRTYPE
+        # Directories shall be named with a trailing '/' like tar does
+        tarinfo.name = arcname.rstrip("/") + "/" if arcname != "." else "./"
+        self.tar.addfile(tarinfo)
+
+    def _add_file(self, filepath, arcname):
+        st = os.stat(filepath)
+        tarinfo = self.tar.gettarinfo(filepath, arcname)
+        listed = not os.path.basename(arcname).startswith(".git")
+
+        # Files with several hard links are only stored once
+        inode = (st.st_dev, st.st_ino)
+        if st.st_nlink > 1 and inode in self.inodes:
+            link_arcname, checksums = self.inodes[inode]
+            tarinfo.type = tarfile.LNKTYPE
+            tarinfo.linkname = link_arcname
+            tarinfo.size = 0
+            self.tar.addfile(tarinfo)
+            if listed:
+                self.checksums.append((arcname, checksums))
+            return
+
+        # Files already in the checksum cache are not hashed again
+        key = checksum.ChecksumCache.get_key(st)
+        checksums = self.checksum_cache.get(key, self.algorithms) \
+                if self.checksum_cache else None
+        with open(filepath, "rb") as fd:
+            if checksums:
+                self.tar.addfile(tarinfo, fd)
+            else:
+                hashes = [hashlib.new(algo) for algo in self.algorithms]
+                self.tar.addfile(tarinfo, _HashingReader(fd, hashes))
+                checksums = {algo: _hash.hexdigest()
+                        for algo, _hash in zip(self.algorithms, hashes)}
+                if self.checksum_cache:
+                    self.checksum_cache.put(key, checksums)
+        if st.st_nlink > 1:
+            self.inodes[inode] = (arcname, checksums)
+        if listed:
+            self.checksums.append((arcname, checksums))
+
+    # Add checksum files (md5sum.txt...) as last members of the archive, in
+    # the format of md5sum/sha256sum tools
+    def _add_checksum_files(self):
+        for algo in self.algorithms:
+            data = "".join(["%s  %s\n" % (checksums[algo], arcname)
+                    for arcname, checksums in self.checksums]).encode("utf-8")
+            tarinfo = _new_tarinfo(
+                    os.path.join(".", checksum.CHECKSUM_FILES[algo]), 0o644)
+            tarinfo.size = len(data)
+            self.tar.addfile(tarinfo, io.BytesIO(data))
+        logging.debug("Archive '%s': %d files", self.tar_path, len(self.checksums))
+
+#===============================================================================
+# Write a release archive with given entries in a single pass: each file is
+# read once, its checksums being computed while it is streamed in the archive.
+# entries: list of (src, dest) with dest relative to the top of the archive
+# (from dragon.resolve_release_contents).
+#===============================================================================
+def write_release_archive(tar_path, entries, algorithms=("md5",), cache_path=None):
+    tmp_tar_path = tar_path + ".tmp"
+    try:
+        with ReleaseArchive(tmp_tar_path, algorithms, cache_path) as archive:
+            for src, dest in sorted(entries, key=lambda entry: entry[1]):
+                # Checksum files are generated
+                if dest not in checksum.CHECKSUM_FILES.values():
+                    archive.add(src, dest)
+    except BaseException:
+        if os.path.exists(tmp_tar_path):
+            os.unlink(tmp_tar_path)
+        raise
+    os.replace(tmp_tar_path, tar_path)
@@ -11,6 +11,13 @@ usage() {
 	echo "  If --home is given the home directory will be mounted as a docker volume"
 	echo ""
 	echo "  For custom docker options, please use the env var DOCKER_OPTS."
+	echo ""
+	echo "  If DRAGON_DOCKER_REUSE is set to a number of seconds, a container is kept"
+	echo "  running for the workspace and image and commands are executed in it with"
+	echo "  'docker exec'. It is stopped after being idle for this duration."
+	echo ""
+	echo "Usage: $0 --stop"
+	echo "  Stop the containers kept running for the workspace."
 }
 
 if [ "$1" = "-h" -o "$1" = "--help" ]; then
@@ -18,6 +25,15 @@ if [ "$1" = "-h" -o "$1" = "--help" ]; then
 	exit 0
 fi
 
+# Label of containers kept running for the workspace
+WORKSPACE_LABEL="dragon.workspace=${TOP_DIR}"
+
+if [ "$1" = "--stop" ]; then
+	CONTAINERS=$(docker ps --quiet --filter "label=${WORKSPACE_LABEL}")
+	[ -n "${CONTAINERS}" ] && docker rm --force ${CONTAINERS} > /dev/null
+	exit 0
+fi
+
 MOUNT_HOME=
 if [ "$1" = "--home" ]; then
 	MOUNT_HOME=true
@@ -56,7 +72,8 @@ VOLUME_OPTS="${VOLUME_OPTS} --volume /etc/group:/etc/group"
 
 # By default a non-interactive pseudo-TTY is allocated, and we only
 # keep STDIN open in the case of script being executed from a terminal
-[ -t 0 ] && DOCKER_OPTS="${DOCKER_OPTS} --interactive"
+INTERACTIVE_OPTS=
+[ -t 0 ] && INTERACTIVE_OPTS="--interactive"
 
 # Duplicate all user groups
 for grp in $(id -G); do
@@ -70,21 +87,17 @@ if [ "${MOUNT_HOME}" != "" ]; then
 	fi
 fi
 
-# Run the given image in a new container with some default options.
-#
+# Environment given to commands
 # --env QT_GRAPHICSSYSTEM="native" : allow qt application to work in container.
-# --net=host : to have access to X11 socket.
-# --user $(id -u):$(id -g) : to use initial user/group.
-# --rm : remove container at the end.
-# --interactive --tty : be interactive with tty.
-exec docker run \
-	--env QT_GRAPHICSSYSTEM="native" \
+ENV_OPTS="${ENV_OPTS} \
+	--env QT_GRAPHICSSYSTEM=native \
 	--env HOME \
 	--env DISPLAY \
 	--env SHELL \
 	--env XAUTHORITY \
 	--env DRAGON_OUT_ROOT_DIR \
 	--env DRAGON_OUT_DIR \
+	--env DRAGON_PYCACHE_DIR \
 	--env TARGET_DEPLOY_ROOT \
 	--env PARROT_BUILD_PROP_GROUP \
 	--env PARROT_BUILD_PROP_PROJECT \
@@ -95,13 +108,90 @@ exec docker run \
 	--env PARROT_BUILD_PROP_VERSION \
 	--env PARROT_BUILD_TAG_PREFIX \
 	--env POLICE_HOME \
+	--env DRAGON_TRACE_FILE"
+
+if [ -z "${DRAGON_DOCKER_REUSE}" -o "${DRAGON_DOCKER_REUSE}" = "0" ]; then
+	# Run the given image in a new container with some default options.
+	#
+	# --net=host : to have access to X11 socket.
+	# --user $(id -u):$(id -g) : to use initial user/group.
+	# --rm : remove container at the end.
+	# --interactive --tty : be interactive with tty.
+	exec docker run \
+		${ENV_OPTS} \
+		${VOLUME_OPTS} \
+		--workdir ${TOP_DIR} \
+		--net=host \
+		--user $(id -u):$(id -g) \
+		--rm \
+		--tty \
+		${INTERACTIVE_OPTS} \
+		${DOCKER_OPTS} \
+		${DOCKER_IMAGE} \
+		"$@"
+fi
+
+# Container kept running for the workspace, image and options. Commands are
+# executed in it with 'docker exec', each one creating a file named with its
+# pid in ACTIVE_DIR while it runs (moved to 'done' when it exits or is
+# interrupted, removed if its process does not exist anymore, if killed).
+# The container stops (and is removed) when no command was active during
+# DRAGON_DOCKER_REUSE seconds.
+ACTIVE_DIR=/tmp/dragon-docker-active
+CONTAINER_KEY=$(echo "${TOP_DIR} ${DOCKER_IMAGE} ${VOLUME_OPTS} ${DOCKER_OPTS}" | cksum | cut -d" " -f1)
+CONTAINER_NAME="dragon-$(id -u)-${CONTAINER_KEY}"
+
+KEEPALIVE_SCRIPT="
+mkdir -p ${ACTIVE_DIR}
+idle=0
+while [ \${idle} -lt ${DRAGON_DOCKER_REUSE} ]; do
+	sleep 5
+	for marker in ${ACTIVE_DIR}/*; do
+		pid=\$(basename \${marker})
+		[ \"\${pid}\" = done ] || kill -0 \${pid} 2> /dev/null || rm -f \${marker}
+	done
+	if [ -n \"\$(ls -A ${ACTIVE_DIR})\" ]; then
+		idle=0
+		rm -f ${ACTIVE_DIR}/done
+	else
+		idle=\$((idle + 5))
+	fi
+done"
+
+EXEC_SCRIPT="
+mkdir -p ${ACTIVE_DIR}
+touch ${ACTIVE_DIR}/\$\$
+trap 'mv -f ${ACTIVE_DIR}/\$\$ ${ACTIVE_DIR}/done' EXIT
+trap 'exit 130' INT
+trap 'exit 143' TERM
+\"\$@\""
+
+is_running() {
+	[ "$(docker inspect --format '{{.State.Running}}' ${CONTAINER_NAME} 2> /dev/null)" = "true" ]
+}
+
+if ! is_running; then
+	# Remove a stopped container with the same name (ignore errors)
+	docker rm --force ${CONTAINER_NAME} > /dev/null 2>&1
+	# Another build may start the container at the same time
+	docker run \
+		--detach \
+		--name ${CONTAINER_NAME} \
+		--label "${WORKSPACE_LABEL}" \
+		${VOLUME_OPTS} \
+		--workdir ${TOP_DIR} \
+		--net=host \
+		--user $(id -u):$(id -g) \
+		--rm \
+		${DOCKER_OPTS} \
+		${DOCKER_IMAGE} \
+		sh -c "${KEEPALIVE_SCRIPT}" > /dev/null || is_running || exit 1
+fi
+
+exec docker exec \
 	${ENV_OPTS} \
-	${VOLUME_OPTS} \
 	--workdir ${TOP_DIR} \
-	--net=host \
-	--user $(id -u):$(id -g) \
-	--rm \
 	--tty \
-	${DOCKER_OPTS} \
-	${DOCKER_IMAGE} \
-	"$@"
+	${INTERACTIVE_OPTS} \
+	${CONTAINER_NAME} \
+	sh -c "${EXEC_SCRIPT}" sh "$@"
@@ -2,6 +2,41 @@
 
 import sys
 import os
+
+#===============================================================================
+# Don't pollute tree with pyc: with python >= 3.8, they are written in a
+# separate directory (DRAGON_PYCACHE_DIR or <out>/pycache) so modules (dragon,
+# extensions, product configurations) are not compiled at each execution.
+# Python checks them against the sources (modification time and size).
+#===============================================================================
+def setup_pycache():
+    if sys.version_info < (3, 8):
+        sys.dont_write_bytecode = True
+        return
+    pycache_dir = os.environ.get("DRAGON_PYCACHE_DIR", "")
+    if not pycache_dir:
+        pycache_dir = os.path.join(get_default_out_root_dir(), "pycache")
+    sys.pycache_prefix = os.path.abspath(pycache_dir)
+
+#===============================================================================
+# Get the root output directory before setting up global variables
+# (DRAGON_OUT_ROOT_DIR or <workspace>/out).
+#===============================================================================
+def get_default_out_root_dir():
+    out_root_dir = os.environ.get("DRAGON_OUT_ROOT_DIR", "")
+    if not out_root_dir:
+        out_root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                "..", "..", "out")
+    return os.path.abspath(out_root_dir)
+
+setup_pycache()
+
+# Execute the command in the build daemon if enabled (DRAGON_DAEMON=1) and
+# running, before loading anything else (does not return if it was executed)
+import daemonclient
+if __name__ == "__main__" and daemonclient.is_enabled():
+    daemonclient.run(daemonclient.get_socket_path(get_default_out_root_dir()))
+
 import logging
 import signal
 import argparse
@@ -9,14 +44,24 @@ import datetime
 import re
 import importlib
 import collections
+import contextlib
+import copy
+import functools
 import hashlib
+import json
+import math
+import shlex
 import subprocess
+import time
 
-# Don't pollute tree with pyc
-sys.dont_write_bytecode = True
-
+import cache
+import daemon
 import dragon
+import fingerprint
 import police
+import scheduler
+import tags
+import tracing
 import utils
 
 USAGE = (
@@ -44,10 +89,22 @@ CLR_BLUE = "\033[34m"
 CLR_PURPLE = "\033[35m"
 CLR_CYAN = "\033[36m"
 
+# Default memory (GB) needed by a job, used to limit the number of jobs
+DEFAULT_MEM_PER_JOB = 1.0
+
+# Root of the cgroup file systems
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# Files giving the cgroups of this process and the memory of the system
+PROC_CGROUP_PATH = "/proc/self/cgroup"
+PROC_MEMINFO_PATH = "/proc/meminfo"
+
 #===============================================================================
 # Get list of available entries (products/variants).
+# If ignored is given, entries ignored because of a '.dragonignore' file are
+# appended to it.
 #===============================================================================
-def get_dir_entries(dirpath):
+def get_dir_entries(dirpath, ignored=None):
     excludes = [".git", "__pycache__", "dragon_base", "common"]
     entries = []
     for entry in os.listdir(dirpath):
@@ -56,6 +113,8 @@ def get_dir_entries(dirpath):
         if entry in excludes:
             continue
         if os.path.exists(os.path.join(dirpath, entry, ".dragonignore")):
+            if ignored is not None:
+                ignored.append(entry)
             continue
         # If default is link, ignore it (only the target of the link will be listed)
         if entry == "default" and os.path.islink(os.path.join(dirpath, entry)):
@@ -82,18 +141,101 @@ def get_default_entry(dirpath, entries):
             return target
     return None
 
+#===============================================================================
+# Index of products/variants directories: entries and default entry.
+#
+# Scanning a directory requires several file system accesses per entry (slow
+# on network storage), so results are kept in memory and saved in the output
+# directory for next executions. A saved result is valid while modification
+# times of the directory and its sub-directories did not change (adding or
+# removing a '.dragonignore' changes the one of its directory).
+#===============================================================================
+class DirIndex(object):
+    # Directories modified less than this number of seconds before the scan are
+    # not saved as a modification in the same second would not be detected
+    RACY_DELAY = 2
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.saved = (cache.load(cache_path) or {}) if cache_path else {}
+        self.dirs = {}
+
+    def get_entries(self, dirpath):
+        return self._get(dirpath)["entries"]
+
+    def get_default(self, dirpath):
+        return self._get(dirpath)["default"]
+
+    # Entries already got are checked again (the build daemon keeps the index
+    # for all its commands)
+    def _get(self, dirpath):
+        info = self.dirs.get(dirpath) or self.saved.get(dirpath)
+        if not info or not self._is_valid(dirpath, info):
+            info = self._scan(dirpath)
+        self.dirs[dirpath] = info
+        return info
+
+    # Check modification times of a directory and its sub-directories
+    def _is_valid(self, dirpath, info):
+        try:
+            if os.stat(dirpath).st_mtime_ns != info["mtime"]:
+                return False
+            for name, mtime in info["subdirs"].items():
+                if os.stat(os.path.join(dirpath, name)).st_mtime_ns != mtime:
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def _scan(self, dirpath):
+        logging.debug("Scanning '%s'", dirpath)
+        scan_time = time.time()
+        mtime = os.stat(dirpath).st_mtime_ns
+        ignored = []
+        entries = get_dir_entries(dirpath, ignored)
+        info = {
+            "mtime": mtime,
+            "subdirs": {name: os.stat(os.path.join(dirpath, name)).st_mtime_ns
+                    for name in entries + ignored},
+            "entries": entries,
+            "default": get_default_entry(dirpath, entries),
+        }
+        limit = (scan_time - DirIndex.RACY_DELAY) * 1000000000
+        if self.cache_path and all(mtime < limit
+                for mtime in [info["mtime"]] + list(info["subdirs"].values())):
+            self.saved[dirpath] = info
+            cache.save(self.cache_path, self.saved)
+        return info
+
+_DIR_INDEX = None
+
+#===============================================================================
+# Get the index of products/variants (created on first call, or when its cache
+# file changes: the build daemon keeps it for all its commands).
+#===============================================================================
+def get_dir_index():
+    global _DIR_INDEX
+    cache_path = None
+    if not dragon.OPTIONS or dragon.OPTIONS.products_cache:
+        out_root_dir = dragon.OUT_ROOT_DIR or \
+                os.path.join(dragon.WORKSPACE_DIR, "out")
+        cache_path = os.path.join(out_root_dir, "dragon-cache", "products.json")
+    if _DIR_INDEX is None or _DIR_INDEX.cache_path != cache_path:
+        _DIR_INDEX = DirIndex(cache_path)
+    return _DIR_INDEX
+
 #===============================================================================
 # Get list of available products.
 #===============================================================================
 def get_products():
-    return get_dir_entries(dragon.PRODUCTS_DIR)
+    return get_dir_index().get_entries(dragon.PRODUCTS_DIR)
 
 #===============================================================================
 # Get list of available variants.
 #===============================================================================
 def get_variants(product):
     variants_dir = os.path.join(dragon.PRODUCTS_DIR, product)
-    return get_dir_entries(variants_dir)
+    return get_dir_index().get_entries(variants_dir)
 
 #===============================================================================
 # Get default product.
@@ -102,7 +244,7 @@ def get_variants(product):
 # return it.
 #===============================================================================
 def get_default_product():
-    return get_default_entry(dragon.PRODUCTS_DIR, get_products())
+    return get_dir_index().get_default(dragon.PRODUCTS_DIR)
 
 #===============================================================================
 # Get default variant.
@@ -112,7 +254,7 @@ def get_default_product():
 #===============================================================================
 def get_default_variant(product):
     variants_dir = os.path.join(dragon.PRODUCTS_DIR, product)
-    return get_default_entry(variants_dir, get_variants(product))
+    return get_dir_index().get_default(variants_dir)
 
 #===============================================================================
 # Check that given product is valid (picking default one if needed).
@@ -163,56 +305,234 @@ def check_variant(options):
     logging.error("'%s' is not a valid variant", options.variant)
     return False
 
+#===============================================================================
+# Setup parsed options: jobs, task dependencies, product and variant of the -p
+# option. Options are then set in dragon module, as well as directories of
+# packages and products.
+#===============================================================================
+def setup_options(options):
+    options.jobs = parse_jobs(options.jobs, options.mem_per_job)
+    options.task_deps = parse_task_deps(options.task_deps)
+    dragon.OPTIONS = options
+
+    # Setup packages/products dir from options
+    if not dragon.PACKAGES_DIR:
+        dragon.PACKAGES_DIR = os.path.join(dragon.WORKSPACE_DIR, "packages")
+    if not dragon.PRODUCTS_DIR:
+        dragon.PRODUCTS_DIR = os.path.join(dragon.WORKSPACE_DIR, "products")
+
+    # Extract product and variant from -p option
+    if options.product is not None:
+        idx = options.product.rfind("-")
+        if idx >= 0:
+            options.variant = options.product[idx+1:]
+            options.product = options.product[:idx]
+        elif options.product == "forall":
+            options.variant = "forall"
+        else:
+            options.variant = None
+    else:
+        options.variant = None
+    options.product_dir = None
+    options.variant_dir = None
+
+#===============================================================================
+# Check product/variant of options and set their directories.
+#===============================================================================
+def setup_product(options):
+    if not check_product(options) or not check_variant(options):
+        return False
+    if options.product != "forall":
+        options.product_dir = os.path.join(dragon.PRODUCTS_DIR, options.product)
+    if options.variant != "forall":
+        options.variant_dir = os.path.join(dragon.PRODUCTS_DIR,
+                options.product, options.variant)
+    return True
+
+#===============================================================================
+# Read the first line of a file, None if it can not be read.
+#===============================================================================
+def _read_line(filepath):
+    try:
+        with open(filepath, "r") as fd:
+            return fd.readline().strip()
+    except OSError:
+        return None
+
+#===============================================================================
+# Get the cgroup version and directories of a controller ('cpu', 'memory') for
+# this process, from its cgroup to the root (limits of parents also apply).
+# Return (None, []) if not found.
+#===============================================================================
+def _get_cgroup_dirs(controller):
+    paths = {}
+    try:
+        with open(PROC_CGROUP_PATH, "r") as fd:
+            for line in fd:
+                fields = line.rstrip("\n").split(":", 2)
+                if len(fields) != 3:
+                    continue
+                if controller in fields[1].split(","):
+                    paths[1] = fields[2]
+                elif fields[0] == "0" and not fields[1]:
+                    paths[2] = fields[2]
+    except OSError:
+        return None, []
+    # With cgroup v1 the controller has its own hierarchy
+    if 1 in paths and os.path.isdir(os.path.join(CGROUP_ROOT, controller)):
+        version, root_dir = 1, os.path.join(CGROUP_ROOT, controller)
+    elif 2 in paths and os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.controllers")):
+        version, root_dir = 2, CGROUP_ROOT
+    else:
+        return None, []
+    # The cgroup of the process is the root in a cgroup namespace (container)
+    dirs = []
+    path = paths[version].strip("/")
+    while path:
+        if os.path.isdir(os.path.join(root_dir, path)):
+            dirs.append(os.path.join(root_dir, path))
+        path = os.path.dirname(path)
+    dirs.append(root_dir)
+    return version, dirs
+
+#===============================================================================
+# Get the cpu quota (number of cpus, can be fractional) of the cgroup of this
+# process, None if not limited.
+#===============================================================================
+def get_cgroup_cpu_quota():
+    version, dirs = _get_cgroup_dirs("cpu")
+    quotas = []
+    for dirpath in dirs:
+        if version == 1:
+            fields = [_read_line(os.path.join(dirpath, "cpu.cfs_quota_us")),
+                    _read_line(os.path.join(dirpath, "cpu.cfs_period_us"))]
+        else:
+            fields = (_read_line(os.path.join(dirpath, "cpu.max")) or "").split()
+        try:
+            quota, period = int(fields[0]), int(fields[1])
+        except (ValueError, TypeError, IndexError):
+            # 'max' or -1 when not limited
+            continue
+        if quota > 0 and period > 0:
+            quotas.append(float(quota) / period)
+    return min(quotas) if quotas else None
+
+#===============================================================================
+# Get the memory available for the build (bytes): available memory of the
+# system limited by the memory limit of the cgroup of this process.
+# Return None if unknown.
+#===============================================================================
+def get_available_memory():
+    limits = []
+    try:
+        with open(PROC_MEMINFO_PATH, "r") as fd:
+            for line in fd:
+                if line.startswith("MemAvailable:"):
+                    limits.append(int(line.split()[1]) * 1024)
+    except (OSError, ValueError, IndexError):
+        pass
+    version, dirs = _get_cgroup_dirs("memory")
+    for dirpath in dirs:
+        # Not limited if 'max' (v2) or a huge value (v1)
+        value = _read_line(os.path.join(dirpath,
+                "memory.limit_in_bytes" if version == 1 else "memory.max"))
+        if value and value.isdigit():
+            limits.append(int(value))
+    return min(limits) if limits else None
+
+#===============================================================================
+# Get the maximum number of jobs: cpus this process can use (affinity),
+# limited by the cpu quota of its cgroup and by the available memory
+# (mem_per_job in GB, 0 for no limit).
+# Return the number of jobs and the reason of this number.
+#===============================================================================
+def get_max_jobs(mem_per_job):
+    if hasattr(os, "sched_getaffinity"):
+        max_jobs = len(os.sched_getaffinity(0))
+        reason = "%d cpus in affinity" % max_jobs
+    else:
+        try:
+            import multiprocessing
+            max_jobs = multiprocessing.cpu_count()
+        except (ImportError, NotImplementedError):
+            max_jobs = 1
+        reason = "%d cpus" % max_jobs
+
+    quota = get_cgroup_cpu_quota()
+    if quota is not None and int(math.ceil(quota)) < max_jobs:
+        max_jobs = max(1, int(math.ceil(quota)))
+        reason = "cgroup cpu quota of %.2f cpus" % quota
+
+    memory = get_available_memory() if mem_per_job > 0 else None
+    if memory is not None:
+        mem_jobs = max(1, int(memory // int(mem_per_job * 1024 * 1024 * 1024)))
+        if mem_jobs < max_jobs:
+            max_jobs = mem_jobs
+            reason = "%.1f GB of memory available, %g GB per job" % (
+                    float(memory) / (1024 * 1024 * 1024), mem_per_job)
+    return max_jobs, reason
+
 #===============================================================================
 # Parse the -j option in an actual number of jobs.
+# An explicit number of jobs is used as is (with a warning if above the
+# maximum), other forms are computed from the maximum number of jobs.
+# The resolved number is given to restarted builds (they can run in another
+# environment, a docker container for example, with other limits) except for
+# 0 (make load limit).
 #===============================================================================
-def parse_jobs(sval):
+def parse_jobs(sval, mem_per_job=None):
     # Compute the number of maximum possible jobs
-    try:
-        import multiprocessing
-        max_jobs = multiprocessing.cpu_count()
-    except (ImportError, NotImplementedError):
-        max_jobs = 1
+    if mem_per_job is None:
+        mem_per_job = DEFAULT_MEM_PER_JOB
+    max_jobs, reason = get_max_jobs(mem_per_job)
 
-    JobInfo = collections.namedtuple("JobInfo", ["make_arg", "job_num", "restart_arg"])
+    JobInfo = collections.namedtuple("JobInfo",
+            ["make_arg", "job_num", "restart_arg", "reason"])
     try:
         # Is it /X ?
         if sval.startswith("/"):
             # Divide max_jobs by the given number
             divisor = max(1, int(sval[1:]))
             jobs = (max_jobs + divisor - 1) // divisor
-            return JobInfo("-j %d" % jobs, jobs, sval)
+            return JobInfo("-j %d" % jobs, jobs, str(jobs),
+                    "%s, divided by %d" % (reason, divisor))
         ival = int(sval)
         if ival == 0:
             # Assume another way of computing jobs is wanted
-            return JobInfo("-j -l %d" % max_jobs, max_jobs, sval)
+            return JobInfo("-j -l %d" % max_jobs, max_jobs, sval,
+                    "load limited by %s" % reason)
         elif ival > 0:
-            jobs = min(max_jobs, ival)
-            return JobInfo("-j %d" % jobs, jobs, sval)
+            if ival > max_jobs:
+                logging.warning("-j %d is above the maximum of %d jobs (%s)",
+                        ival, max_jobs, reason)
+            return JobInfo("-j %d" % ival, ival, str(ival), "-j %d" % ival)
         else:
             jobs = max(1, max_jobs + ival)
-            return JobInfo("-j %d" % jobs, jobs, sval)
+            return JobInfo("-j %d" % jobs, jobs, str(jobs),
+                    "%s, minus %d" % (reason, -ival))
     except ValueError:
         if sval == "__ALL_CPUS__":
-            return JobInfo("-j %s" % max_jobs, max_jobs, "")
+            return JobInfo("-j %s" % max_jobs, max_jobs, str(max_jobs), reason)
         # Unable to parse value
         logging.warning("Unable to parse -j option: '%s", sval)
-        return JobInfo("-j 1", 1, sval)
+        return JobInfo("-j 1", 1, "1", "invalid -j option")
 
 #===============================================================================
 # List all products (and variants)
 #===============================================================================
 def list_products():
     products = get_products()
+    default_product = get_default_product()
     for product in products:
         sys.stderr.write(product)
-        if product == get_default_product():
+        if product == default_product:
             sys.stderr.write("*")
         sys.stderr.write(":")
         variants = get_variants(product)
+        default_variant = get_default_variant(product)
         for variant in variants:
             sys.stderr.write(" " + variant)
-            if variant == get_default_variant(product):
+            if variant == default_variant:
                 sys.stderr.write("*")
         sys.stderr.write("\n")
     sys.stderr.write("\n")
@@ -281,11 +601,118 @@ def gen_completion():
 # Restart the build script with given product/variant and optional wrappers
 #===============================================================================
 def restart(tasks, product, variant, with_wrappers=False):
+    dragon.restart(product, variant, get_restart_args(tasks), with_wrappers)
+
+#===============================================================================
+# Get the arguments to give to restart for the given tasks
+#===============================================================================
+def get_restart_args(tasks):
     args = []
     for _task in tasks:
         args.append("-t %s" % _task["name"])
         args.extend(_task["args"])
-    dragon.restart(product, variant, args, with_wrappers)
+    return args
+
+#===============================================================================
+# Get the list of (product, variant) to build with forall.
+#===============================================================================
+def get_forall_builds(options):
+    if options.product == "forall":
+        products = get_products()
+    else:
+        products = [options.product]
+    return [(product, variant)
+            for product in products
+            for variant in get_variants(product)]
+
+#===============================================================================
+# Split the number of jobs between builds executed concurrently.
+# Each build gets a share proportional to its weight (1 by default). Weights
+# are given by --forall-weight options as <product>-<variant>=<weight> or
+# <variant>=<weight>.
+#===============================================================================
+def get_forall_jobs(options, builds, width):
+    weights = {}
+    for forall_weight in options.forall_weights:
+        try:
+            name, weight = forall_weight.rsplit("=", 1)
+            weights[name] = max(0.0, float(weight))
+        except ValueError:
+            logging.warning("Invalid --forall-weight option: '%s'", forall_weight)
+
+    build_weights = []
+    for product, variant in builds:
+        weight = weights.get("%s-%s" % (product, variant),
+                weights.get(variant, 1.0))
+        build_weights.append(weight)
+    total_weight = sum(build_weights) or 1.0
+
+    # A share is relative to the average weight of the builds, the total of
+    # jobs being shared between concurrent builds
+    total_jobs = options.jobs.job_num
+    avg_weight = total_weight / len(builds)
+    jobs = []
+    for weight in build_weights:
+        share = int(round(total_jobs * weight / (width * avg_weight)))
+        jobs.append(min(total_jobs, max(1, share)))
+    return jobs
+
+#===============================================================================
+# Execute given tasks for all products/variants concurrently.
+#===============================================================================
+def forall_parallel(tasks, options):
+    builds = get_forall_builds(options)
+    if not builds:
+        return
+    width = min(options.forall_parallel, len(builds))
+
+    # -j 0 means load limited, let make deal with it
+    if options.jobs.restart_arg == "0":
+        jobs = ["0"] * len(builds)
+    else:
+        jobs = get_forall_jobs(options, builds, width)
+
+    args = get_restart_args(tasks)
+    keys = ["%s-%s" % build for build in builds]
+    results = {}
+    logging.info("Starting %d builds, %d at a time", len(builds), width)
+
+    def do_build(key):
+        idx = keys.index(key)
+        product, variant = builds[idx]
+        cmd = dragon.get_restart_cmd(product, variant, args, jobs=jobs[idx])
+        start = datetime.datetime.now()
+        try:
+            dragon.exec_cmd(cmd, dryrun_arg="-n")
+        except dragon.TaskError as ex:
+            results[key] = (False, datetime.datetime.now() - start)
+            logging.error("%s: %s", key, str(ex))
+            if not options.keep_going:
+                raise
+        else:
+            results[key] = (True, datetime.datetime.now() - start)
+
+    try:
+        scheduler.run(keys, {}, do_build, width)
+    except dragon.TaskError:
+        pass
+
+    # Summary
+    getclr = lambda clr: clr if options.colors else ""
+    sys.stderr.write("\nSummary of forall builds:\n")
+    for key in keys:
+        if key not in results:
+            status, duration = getclr(CLR_YELLOW) + "NOT STARTED", ""
+        else:
+            status = getclr(CLR_GREEN) + "OK" if results[key][0] \
+                    else getclr(CLR_RED) + "FAILED"
+            duration = " (%s)" % str(results[key][1]).split(".")[0]
+        sys.stderr.write("  %s : %s%s%s\n" % (key, status,
+                getclr(CLR_DEFAULT), duration))
+    failed = [key for key in keys if not results.get(key, (False,))[0]]
+    sys.stderr.write("%d/%d builds OK\n" % (len(keys) - len(failed), len(keys)))
+    if failed and not options.keep_going:
+        sys.exit(1)
 
 #===============================================================================
 #===============================================================================
@@ -325,6 +752,15 @@ def setup_globals(options):
         if next_version_file and os.path.exists(next_version_file):
             with open(next_version_file, "r") as fd:
                 dragon.PARROT_BUILD_PROP_VERSION = fd.read().strip("\n")
+            # 'auto': version following the newest tag of the product
+            if dragon.PARROT_BUILD_PROP_VERSION.strip() == "auto":
+                tag_index = tags.get_tag_index(dragon.PRODUCT_DIR,
+                        dragon.PARROT_BUILD_TAG_PREFIX)
+                dragon.PARROT_BUILD_PROP_VERSION = \
+                        str(tag_index.get_next_version()) if tag_index else "0.0.0"
+                logging.debug("Next version from tags '%s-*': %s",
+                        dragon.PARROT_BUILD_TAG_PREFIX,
+                        dragon.PARROT_BUILD_PROP_VERSION)
         else:
             dragon.PARROT_BUILD_PROP_VERSION = "0.0.0"
 
@@ -426,6 +862,17 @@ def parse_args(extensions):
                     "If 0 is provided, we instead pass -l to make. "
                     "It also accepts the special format /X meaning max/X.")
 
+    parser.add_argument("--mem-per-job",
+            dest="mem_per_job",
+            action="store",
+            type=float,
+            metavar="GB",
+            default=None,
+            help="Memory needed by a job, the number of jobs (unless given "
+                    "explicitly with -j) is limited by the available memory "
+                    "(including cgroup limit). "
+                    "Default is %g, 0 disables the limit." % DEFAULT_MEM_PER_JOB)
+
     parser.add_argument("-v", "--verbose",
             dest="verbose",
             action="store_true",
@@ -462,11 +909,118 @@ def parse_args(extensions):
             action="store_true",
             help="When police is enabled, disable spy and only enable report.")
 
+    parser.add_argument("--police-full",
+            dest="police_full",
+            action="store_true",
+            help="When police is enabled, process the whole spy log instead "
+                    "of only the builds not processed yet.")
+
     parser.add_argument("--police-packages",
             dest="police_packages",
             action="store_true",
             help="When police is enabled, also enable packages generation.")
 
+    parser.add_argument("--force",
+            dest="force",
+            action="store_true",
+            help="Execute tasks declaring inputs/outputs even if they are "
+                    "up to date.")
+
+    parser.add_argument("--task-deps",
+            dest="task_deps",
+            action="append",
+            metavar="TASK:DEP[,DEP...]",
+            default=[],
+            help="Declare that the given task (-t) depends on other given "
+                    "tasks. If used, independent tasks are executed "
+                    "concurrently within the -j limit, otherwise tasks are "
+                    "executed in order.")
+
+    parser.add_argument("--forall-parallel",
+            dest="forall_parallel",
+            action="store",
+            type=int,
+            metavar="N",
+            default=1,
+            help="With forall, execute at most N product/variant builds "
+                    "concurrently, sharing the -j jobs between them. "
+                    "Default is 1 (builds are done one after the other).")
+
+    parser.add_argument("--forall-weight",
+            dest="forall_weights",
+            action="append",
+            metavar="[PRODUCT-]VARIANT=WEIGHT",
+            default=[],
+            help="With --forall-parallel, weight of a build when sharing jobs. "
+                    "Default weight is 1.")
+
+    parser.add_argument("--reexec",
+            dest="reexec",
+            action="store_true",
+            help="Always restart the build script to execute tasks of "
+                    "another product/variant instead of switching in the "
+                    "same process.")
+
+    parser.add_argument("--plan",
+            dest="plan",
+            choices=["json"],
+            default=None,
+            help="Display the plan of the build (tasks, hooks, commands and "
+                    "builds of other products/variants) without executing "
+                    "anything. Hooks are only given by name unless their task "
+                    "has a plan hook describing them. Builds of 'forall' "
+                    "products/variants are listed one after the other, "
+                    "without --forall-parallel scheduling, and --task-deps "
+                    "dependencies are not shown for them.")
+
+    parser.add_argument("--trace",
+            dest="trace",
+            metavar="FILE",
+            default=None,
+            help="Record a trace of tasks, hooks and commands in FILE "
+                    "(Chrome trace event format, see chrome://tracing or "
+                    "https://ui.perfetto.dev). Restarted builds add their "
+                    "events in the same file.")
+
+    parser.add_argument("--no-products-cache",
+            dest="products_cache",
+            action="store_false",
+            help="Do not use the list of products/variants saved by a "
+                    "previous execution (always scan the products directory).")
+
+    parser.add_argument("--task-logs",
+            dest="task_logs",
+            action="store_true",
+            help="Save output of commands in a log file per task "
+                    "(<out>/logs/<task>.log) instead of displaying it, only "
+                    "the last lines are displayed when a command fails. "
+                    "Not suited to interactive tasks (menuconfig...).")
+
+    parser.add_argument("--daemon",
+            dest="daemon",
+            choices=["start", "stop", "status", "run"],
+            default=None,
+            help="Control the build daemon of the workspace, keeping the "
+                    "build script loaded to execute commands faster. Commands "
+                    "are sent to the daemon when DRAGON_DAEMON=1 is set in "
+                    "the environment ('run' executes it in foreground).")
+
+    parser.add_argument("--release-store",
+            dest="release_store",
+            action="store_true",
+            help="Keep release contents in a content addressed store in the "
+                    "output directory, releases referencing it with hard "
+                    "links (see the 'release-store' task).")
+
+    parser.add_argument("--record-fingerprint",
+            dest="record_fingerprint",
+            action="store_true",
+            help="Record the fingerprint of the sources of the workspace "
+                    "(computed before the build) after a successful build "
+                    "(no task failed, even with -k), "
+                    "so it can be checked with the 'workspace-fingerprint' "
+                    "task.")
+
     class DockerAction(argparse.Action):
         def __call__(self, parser, namespace, values, option_string=None):
             setattr(namespace, self.dest, values)
@@ -486,6 +1040,19 @@ def parse_args(extensions):
             help="Use a docker container for the build. "
                     "Default image depends on product/variant.")
 
+    parser.add_argument("--docker-reuse",
+            dest="docker_reuse",
+            type=int,
+            nargs="?",
+            metavar="TIMEOUT",
+            const=600,
+            default=0,
+            help="With --docker, keep a container running for the workspace "
+                    "and image and execute builds in it instead of starting a "
+                    "new container for each one. It is stopped after being "
+                    "idle for TIMEOUT seconds (600 by default) or with "
+                    "'build-with-docker.sh --stop'.")
+
     call_extensions(extensions, "setup_argparse", parser)
 
     # Parse standard arguments and extra arguments
@@ -497,7 +1064,7 @@ def parse_args(extensions):
         parser.print_help()
         parser.exit()
 
-    return options, tasks
+    return options, tasks, parser
 
 #===============================================================================
 # Parse extra arguments and return the list of tasks to execute.
@@ -552,6 +1119,20 @@ def parse_extra_args(parser, options, args):
 
     return tasks
 
+#===============================================================================
+# Parse the --task-deps options in a dictionary task -> list of dependencies.
+#===============================================================================
+def parse_task_deps(task_deps):
+    depends = {}
+    for task_dep in task_deps:
+        idx = task_dep.find(":")
+        if idx <= 0:
+            logging.error("Invalid --task-deps option: '%s'", task_dep)
+            sys.exit(1)
+        deps = [dep for dep in task_dep[idx+1:].split(",") if dep]
+        depends.setdefault(task_dep[:idx], []).extend(deps)
+    return depends
+
 #===============================================================================
 # Setup logging with given options.
 #===============================================================================
@@ -653,6 +1234,321 @@ def check_eula():
     with open(ok_filepath, "w"):
         pass
 
+#===============================================================================
+# Register tasks of current product/variant: default tasks, tasks of
+# extensions and tasks of optional product configuration.
+#===============================================================================
+def load_tasks(options, extensions):
+    # Import default tasks
+    importlib.import_module("deftasks")
+    call_extensions(extensions, "setup_deftasks")
+
+    # Import optional product configuration (search variant dir then product dir)
+    buildcfg_name = "buildcfg.py"
+    for dirpath in [options.variant_dir, options.product_dir]:
+        if dirpath:
+            buildcfg_path = os.path.join(dirpath, buildcfg_name)
+            if os.path.exists(buildcfg_path):
+                logging.debug("Importing '%s'", buildcfg_path)
+                sys.path.append(os.path.dirname(buildcfg_path))
+                try:
+                    importlib.import_module(os.path.splitext(buildcfg_name)[0])
+                except dragon.TaskError as ex:
+                    logging.error(str(ex))
+                    sys.exit(1)
+                break
+
+    # Check all tasks
+    dragon.check_tasks()
+
+#===============================================================================
+# Parse the arguments of a restart of the build script for another
+# product/variant.
+# Return the tasks and variants to build, (None, None) if the arguments require
+# a restart (options given, listing...).
+#===============================================================================
+def parse_product_tasks(parser, product, variant, args):
+    argv = shlex.split(" ".join(args))
+    if "--docker" in argv:
+        return None, None
+    try:
+        defaults, _ = parser.parse_known_args([])
+        options, argv = parser.parse_known_args(argv)
+        if vars(options) != vars(defaults):
+            return None, None
+        tasks = parse_extra_args(parser, options, argv)
+    except SystemExit:
+        return None, None
+    if options.list_tasks or options.help_asked or not tasks:
+        return None, None
+
+    # Check product/variant
+    if product not in get_products():
+        return None, None
+    variants = get_variants(product)
+    if variant == "forall":
+        return tasks, variants
+    elif variant in variants:
+        return tasks, [variant]
+    return None, None
+
+#===============================================================================
+# Context manager loading another product/variant in this process. It gives
+# the options of the product/variant.
+#===============================================================================
+@contextlib.contextmanager
+def product_context(extensions, product, variant):
+    with dragon.switch_context():
+        logging.info("Switching to %s-%s", product, variant)
+        options = copy.copy(dragon.OPTIONS)
+        options.product = product
+        options.variant = variant
+        options.product_dir = os.path.join(dragon.PRODUCTS_DIR, product)
+        options.variant_dir = os.path.join(dragon.PRODUCTS_DIR,
+                product, variant)
+        dragon.OPTIONS = options
+        setup_globals(options)
+        load_tasks(options, extensions)
+        yield options
+
+#===============================================================================
+# Execute tasks of the current product/variant.
+# With --record-fingerprint, record the fingerprint of the workspace (computed
+# before executing the tasks) if no task failed (see fingerprint.py).
+#===============================================================================
+def do_tasks(options, tasks):
+    info = None
+    if options.record_fingerprint and not options.dryrun:
+        info = fingerprint.prepare_record(tasks, options.jobs.job_num)
+    failed_count = len(dragon.FAILED_TASKS)
+    dragon.do_tasks(tasks, options.task_deps)
+    if info is not None and len(dragon.FAILED_TASKS) == failed_count:
+        fingerprint.record(info)
+
+#===============================================================================
+# Execute tasks of another product/variant in this process (instead of
+# restarting the build script with the given arguments).
+# Return False if the arguments require a restart (options given, listing...).
+#===============================================================================
+def run_product_tasks(parser, extensions, product, variant, args):
+    tasks, variants_to_build = parse_product_tasks(parser, product, variant, args)
+    if tasks is None:
+        return False
+
+    for _variant in variants_to_build:
+        with product_context(extensions, product, _variant) as options:
+            try:
+                do_tasks(options, tasks)
+            except dragon.TaskError as ex:
+                logging.error(str(ex))
+                if not options.keep_going:
+                    sys.exit(1)
+    return True
+
+#===============================================================================
+# Get the plans of builds of another product/variant by loading it in this
+# process (see dragon.plan_restart).
+# Return None if the arguments require a restart (options given, listing...).
+#===============================================================================
+def plan_product_tasks(parser, extensions, product, variant, args):
+    tasks, variants_to_build = parse_product_tasks(parser, product, variant, args)
+    if tasks is None:
+        return None
+
+    builds = []
+    for _variant in variants_to_build:
+        with product_context(extensions, product, _variant) as options:
+            builds.append(dragon.plan_build(tasks, options.task_deps))
+    return builds
+
+#===============================================================================
+# Display the plan of the build of given tasks (including forall builds)
+# without executing anything.
+#===============================================================================
+def print_plan(tasks, options):
+    args = get_restart_args(tasks)
+    if options.product == "forall":
+        builds = []
+        for product in get_products():
+            builds.extend(dragon.plan_restart(product, "forall", args))
+    elif options.variant == "forall":
+        builds = dragon.plan_restart(options.product, "forall", args)
+    else:
+        builds = [dragon.plan_build(tasks, options.task_deps)]
+    sys.stdout.write(json.dumps({"builds": builds}, indent=2) + "\n")
+
+# Tasks of products/variants loaded by the build daemon when preparing commands:
+# key of the command -> (changes of the build context, state of the product
+# sources). Only the last _DAEMON_MAX_CONTEXTS are kept.
+_DAEMON_CONTEXTS = collections.OrderedDict()
+_DAEMON_MAX_CONTEXTS = 8
+
+# Key of the command executed by a child of the build daemon
+_DAEMON_KEY = None
+
+#===============================================================================
+# Get files that invalidate the build daemon: sources of loaded modules of the
+# workspace (build script, extensions), extension files that may be added and
+# EULA files (checked when the daemon starts).
+#===============================================================================
+def get_daemon_sources():
+    sources = set()
+    manifest_dir = os.path.join(dragon.WORKSPACE_DIR, ".repo", "manifests")
+    for eula_filename in ["EULA.txt", "EULA.md"]:
+        sources.add(os.path.join(manifest_dir, eula_filename))
+    for module in list(sys.modules.values()):
+        filepath = getattr(module, "__file__", None) or ""
+        if filepath.startswith(os.path.join(dragon.WORKSPACE_DIR, "")):
+            sources.add(os.path.abspath(filepath))
+    extensions_dirpath = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    for entry in os.listdir(extensions_dirpath):
+        sources.add(os.path.join(extensions_dirpath, entry, "buildext.py"))
+    return sorted(sources)
+
+#===============================================================================
+# Get files whose changes invalidate the tasks of the current product/variant
+# kept by the build daemon: loaded product modules, product configurations
+# that may be added and product_config.json files.
+#===============================================================================
+def get_product_sources(options):
+    sources = set()
+    for module in dragon.BuildContext.get_product_modules().values():
+        filepath = getattr(module, "__file__", None)
+        if filepath:
+            sources.add(os.path.abspath(filepath))
+    for dirpath in [options.variant_dir, options.product_dir]:
+        if dirpath:
+            sources.add(os.path.join(dirpath, "buildcfg.py"))
+            sources.add(os.path.join(dirpath, "product_config.json"))
+            sources.add(os.path.join(dirpath, "config", "product_config.json"))
+    if dragon.OUT_DIR:
+        sources.add(os.path.join(dragon.OUT_DIR, "product_config.json"))
+    return sorted(sources)
+
+#===============================================================================
+# Get the key of a command sent to the build daemon.
+#===============================================================================
+def get_daemon_key(argv, cwd, env):
+    return cache.get_digest(argv, cwd, sorted(env.items()))
+
+#===============================================================================
+# Prepare a command in the build daemon process before it forks: load the
+# tasks of its product/variant as main would do, and keep the changes it did
+# (tasks, modules, variables...) so the child only has to apply them.
+# Loaded tasks are kept for next commands with the same arguments, directory
+# and environment, until sources of the daemon or of the product change.
+#===============================================================================
+def prepare_daemon_command(argv, cwd, env):
+    key = get_daemon_key(argv, cwd, env)
+    entry = _DAEMON_CONTEXTS.get(key)
+    if entry and daemon.get_files_state(entry[1]) == entry[1]:
+        _DAEMON_CONTEXTS.move_to_end(key)
+        return
+    _DAEMON_CONTEXTS.pop(key, None)
+
+    saved_cwd, saved_env = os.getcwd(), os.environ.copy()
+    saved_argv, saved_path = sys.argv, list(sys.path)
+    try:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(env)
+        sys.argv = list(argv)
+        dragon.reset_context()
+        extensions = load_extensions()
+        options, _, _ = parse_args(extensions)
+        setup_options(options)
+        if options.daemon or options.list_products or not setup_product(options):
+            return
+        setup_globals(options)
+        before = dragon.BuildContext.capture()
+        load_tasks(options, extensions)
+        changes = dragon.BuildContextChanges(before, dragon.BuildContext.capture())
+        _DAEMON_CONTEXTS[key] = (changes,
+                daemon.get_files_state(get_product_sources(options)))
+        while len(_DAEMON_CONTEXTS) > _DAEMON_MAX_CONTEXTS:
+            _DAEMON_CONTEXTS.popitem(last=False)
+        logging.debug("Loaded %d tasks of %s-%s", len(changes.tasks),
+                options.product, options.variant)
+    except SystemExit:
+        pass
+    finally:
+        for name in dragon.BuildContext.get_product_modules():
+            del sys.modules[name]
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+        sys.argv, sys.path[:] = saved_argv, saved_path
+
+#===============================================================================
+# Register the tasks of the command executed by a child of the build daemon if
+# they were loaded when it was prepared and their sources did not change.
+# Return False if they shall be loaded.
+#===============================================================================
+def load_daemon_tasks():
+    entry = _DAEMON_CONTEXTS.get(_DAEMON_KEY) if _DAEMON_KEY else None
+    if not entry or daemon.get_files_state(entry[1]) != entry[1]:
+        return False
+    logging.debug("Using tasks loaded by the build daemon")
+    entry[0].apply()
+    return True
+
+#===============================================================================
+# Execute a command in a child process of the build daemon (environment,
+# directory and arguments of the client are already set).
+#===============================================================================
+def run_daemon_command():
+    global _DAEMON_KEY
+    _DAEMON_KEY = get_daemon_key(sys.argv, os.getcwd(), os.environ)
+    # Global variables are initialized from the environment of the client,
+    # caches (products index, product_config.json files) are kept
+    dragon.reset_context()
+    try:
+        main()
+    finally:
+        utils.run_cleanups()
+
+#===============================================================================
+# Execute a --daemon command.
+#===============================================================================
+def daemon_command(options):
+    socket_path = daemonclient.get_socket_path(get_default_out_root_dir())
+    if options.daemon == "run":
+        # The daemon itself is not traced, only its commands
+        utils.run_cleanups()
+        try:
+            daemon.Daemon(socket_path, run_daemon_command,
+                    get_daemon_sources, prepare_daemon_command).serve()
+        except OSError as ex:
+            logging.error(str(ex))
+            sys.exit(1)
+    elif options.daemon == "start":
+        log_path = os.path.join(get_default_out_root_dir(), "dragon-daemon.log")
+        utils.makedirs(os.path.dirname(log_path))
+        cmd = [sys.executable, os.path.abspath(sys.argv[0]), "--daemon", "run"]
+        if options.verbose:
+            cmd.append("-v")
+        pid = daemon.start(socket_path, cmd, log_path)
+        if not pid:
+            logging.error("Daemon not started, see '%s'", log_path)
+            sys.exit(1)
+        logging.info("Daemon %d running (use %s=1 to send commands to it)",
+                pid, daemonclient.DAEMON_ENV)
+    elif options.daemon == "stop":
+        pid = daemon.stop(socket_path)
+        if pid:
+            logging.info("Daemon %d stopped", pid)
+        else:
+            logging.info("Daemon not running")
+    else:
+        status = daemon.get_status(socket_path)
+        if status:
+            logging.info("Daemon %d running for %ds: %d commands (%d running)",
+                    status["pid"], status["uptime"], status["served"],
+                    status["running"])
+        else:
+            logging.info("Daemon not running")
+            sys.exit(1)
+
 #===============================================================================
 #===============================================================================
 def main():
@@ -662,60 +1558,52 @@ def main():
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
-    # If an EULA is present, check that it as been accepted.
-    check_eula()
+    # If an EULA is present, check that it as been accepted (already done
+    # when the build daemon was started, it restarts if the EULA changes)
+    if not _DAEMON_KEY:
+        check_eula()
 
     # Load extensions
     extensions = load_extensions()
 
     # Parse options/tasks
-    options, tasks = parse_args(extensions)
+    options, tasks, parser = parse_args(extensions)
     setup_log(options)
-    options.jobs = parse_jobs(options.jobs)
-    dragon.OPTIONS = options
+    jobs_arg = options.jobs
+    setup_options(options)
+    # Only log computed values (not the ones given as is)
+    if options.jobs.restart_arg != jobs_arg:
+        logging.info("Using %s (%s)", options.jobs.make_arg, options.jobs.reason)
+    else:
+        logging.debug("Using %s (%s)", options.jobs.make_arg, options.jobs.reason)
+    tracing.setup(options.trace)
+    utils.add_cleanup(tracing.close)
+
+    # The docker wrapper script gets the idle timeout of a reused container
+    if options.docker_reuse > 0:
+        os.environ["DRAGON_DOCKER_REUSE"] = str(options.docker_reuse)
 
     # We can log now that logging was correctly setup
     for extension in extensions:
         logging.debug("Loaded extension '%s'", extension.__file__)
 
-    # Setup packages/products dir from options
-    if not dragon.PACKAGES_DIR:
-        dragon.PACKAGES_DIR = os.path.join(dragon.WORKSPACE_DIR, "packages")
-    if not dragon.PRODUCTS_DIR:
-        dragon.PRODUCTS_DIR = os.path.join(dragon.WORKSPACE_DIR, "products")
-
-    # Extract product and variant from -p option
-    if options.product is not None:
-        idx = options.product.rfind("-")
-        if idx >= 0:
-            options.variant = options.product[idx+1:]
-            options.product = options.product[:idx]
-        elif options.product == "forall":
-            options.variant = "forall"
-        else:
-            options.variant = None
-    else:
-        options.variant = None
-    options.product_dir = None
-    options.variant_dir = None
-
     if sys.platform != "win32" and os.geteuid() == 0:
         logging.error("Please do not run this script as root.")
         sys.exit(1)
 
+    # Control the build daemon and exit
+    if options.daemon:
+        daemon_command(options)
+        sys.exit(0)
+
     # List products and exit
     if options.list_products:
         list_products()
         sys.exit(0)
 
     # Check product/variant
-    if not check_product(options) or not check_variant(options):
+    if not setup_product(options):
         sys.exit(1)
-    if options.product != "forall":
-        options.product_dir = os.path.join(dragon.PRODUCTS_DIR, options.product)
-    if options.variant != "forall":
-        options.variant_dir = os.path.join(dragon.PRODUCTS_DIR,
-                options.product, options.variant)
 
     # Setup global variables (directories...)
     setup_globals(options)
@@ -729,27 +1617,15 @@ def main():
                     dragon.PRODUCT, dragon.VARIANT)
             sys.exit(1)
 
-    # Import default tasks
-    import deftasks
-    call_extensions(extensions, "setup_deftasks")
-
-    # Import optional product configuration (search variant dir then product dir)
-    buildcfg_name = "buildcfg.py"
-    for dirpath in [options.variant_dir, options.product_dir]:
-        if dirpath:
-            buildcfg_path = os.path.join(dirpath, buildcfg_name)
-            if os.path.exists(buildcfg_path):
-                logging.debug("Importing '%s'", buildcfg_path)
-                sys.path.append(os.path.dirname(buildcfg_path))
-                try:
-                    importlib.import_module(os.path.splitext(buildcfg_name)[0])
-                except dragon.TaskError as ex:
-                    logging.error(str(ex))
-                    sys.exit(1)
-                break
+    # Register tasks (already loaded if executed by the build daemon)
+    if not load_daemon_tasks():
+        load_tasks(options, extensions)
 
-    # Check all tasks
-    dragon.check_tasks()
+    # Allow tasks of other products/variants to be executed in this process
+    dragon.PRODUCT_HANDLER = functools.partial(run_product_tasks,
+            parser, extensions)
+    dragon.PLAN_HANDLER = functools.partial(plan_product_tasks,
+            parser, extensions)
 
     # List tasks and exit
     if options.list_tasks:
@@ -767,7 +1643,14 @@ def main():
                 "of available tasks for your product.")
         sys.exit(1)
 
-    if options.product == "forall":
+    # Display what would be executed and exit
+    if options.plan:
+        print_plan(tasks, options)
+        sys.exit(0)
+
+    if options.forall_parallel > 1 and "forall" in (options.product, options.variant):
+        forall_parallel(tasks, options)
+    elif options.product == "forall":
         for product in get_products():
             restart(tasks, product, "forall")
     elif options.variant == "forall":
@@ -780,8 +1663,7 @@ def main():
             if dragon.BUILD_WRAPPERS:
                 restart(tasks, options.product, options.variant, with_wrappers=True)
             else:
-                for task in tasks:
-                    dragon.do_task(task["name"], task["args"])
+                do_tasks(options, tasks)
         except dragon.TaskError as ex:
             logging.error(str(ex))
             if not options.keep_going:
@@ -790,4 +1672,7 @@ def main():
 #===============================================================================
 #===============================================================================
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        utils.run_cleanups()
@@ -0,0 +1,136 @@
+
+import os
+import logging
+import hashlib
+import json
+import threading
+
+import dragon
+import utils
+
+#===============================================================================
+# Get path of a cache file.
+# If product_specific is True, the file is in the output directory of the
+# current product/variant otherwise in the root output directory.
+#===============================================================================
+def get_cache_path(name, product_specific=True):
+    out_dir = dragon.OUT_DIR if product_specific else dragon.OUT_ROOT_DIR
+    return os.path.join(out_dir, "dragon-cache", name)
+
+#===============================================================================
+# Get a digest of given items (any json serializable object).
+#===============================================================================
+def get_digest(*items):
+    data = json.dumps(items, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+#===============================================================================
+# Get stat information of a file to detect modifications, None if it does not
+# exist.
+#===============================================================================
+def get_stat_info(filepath, follow_symlinks=True):
+    try:
+        st = os.stat(filepath, follow_symlinks=follow_symlinks)
+    except OSError:
+        return None
+    return [st.st_mode, st.st_size, st.st_mtime_ns]
+
+#===============================================================================
+# Get stat information of all files of a directory (hidden directories like
+# .git are skipped) to detect modifications, added and removed files.
+#===============================================================================
+def get_tree_state(root_dir):
+    state = []
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames[:] = sorted([dirname for dirname in dirnames
+                if not dirname.startswith(".")])
+        for filename in sorted(filenames):
+            filepath = os.path.join(dirpath, filename)
+            state.append((os.path.relpath(filepath, root_dir),
+                    get_stat_info(filepath, follow_symlinks=False)))
+    return state
+
+#===============================================================================
+# Get the commit of the HEAD of a git repository without executing git.
+# Return None if not found.
+#===============================================================================
+def get_git_head(dirpath):
+    git_dir = get_git_dir(dirpath)
+    if not git_dir:
+        return None
+    try:
+        with open(os.path.join(git_dir, "HEAD"), "r") as fd:
+            head = fd.read().strip()
+    except OSError:
+        return None
+    if not head.startswith("ref: "):
+        return head
+    return get_git_ref(git_dir, head[5:])
+
+#===============================================================================
+# Get the git directory of a repository ('.git' can be a directory, a link to a
+# directory or a file giving the path of the directory).
+#===============================================================================
+def get_git_dir(dirpath):
+    git_dir = os.path.join(dirpath, ".git")
+    if os.path.isfile(git_dir):
+        with open(git_dir, "r") as fd:
+            line = fd.readline().strip()
+        if not line.startswith("gitdir: "):
+            return None
+        git_dir = os.path.join(dirpath, line[8:])
+    if not os.path.isdir(git_dir):
+        return None
+    return os.path.realpath(git_dir)
+
+#===============================================================================
+# Get the commit of a git reference (loose or packed), None if not found.
+#===============================================================================
+def get_git_ref(git_dir, ref):
+    # Worktrees share refs with the main repository
+    common_dir = git_dir
+    commondir_path = os.path.join(git_dir, "commondir")
+    if os.path.exists(commondir_path):
+        with open(commondir_path, "r") as fd:
+            common_dir = os.path.join(git_dir, fd.read().strip())
+    for refs_dir in [git_dir, common_dir]:
+        try:
+            with open(os.path.join(refs_dir, ref), "r") as fd:
+                return fd.read().strip()
+        except OSError:
+            pass
+    try:
+        with open(os.path.join(common_dir, "packed-refs"), "r") as fd:
+            for line in fd:
+                fields = line.rstrip("\n").split(" ", 1)
+                if len(fields) == 2 and fields[1] == ref:
+                    return fields[0]
+    except OSError:
+        pass
+    return None
+
+#===============================================================================
+# Load a json cache file, None if not found or invalid.
+#===============================================================================
+def load(filepath):
+    try:
+        with open(filepath, "r") as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+#===============================================================================
+# Save a json cache file (atomically). Errors are only logged as the cache is
+# not mandatory.
+#===============================================================================
+def save(filepath, data):
+    tmp_filepath = "%s.%d.%d.tmp" % (filepath, os.getpid(), threading.get_ident())
+    try:
+        utils.makedirs(os.path.dirname(filepath))
+        with open(tmp_filepath, "w") as fd:
+            json.dump(data, fd)
+        os.replace(tmp_filepath, filepath)
+    except OSError as ex:
+        logging.debug("Unable to save cache '%s': %s", filepath, str(ex))
+        if os.path.exists(tmp_filepath):
+            os.unlink(tmp_filepath)
@@ -0,0 +1,116 @@
+
+import os
+import logging
+import hashlib
+import concurrent.futures
+
+import cache
+
+# Name of the file generated for each supported algorithm
+CHECKSUM_FILES = {
+    "md5": "md5sum.txt",
+    "sha256": "sha256sum.txt",
+}
+
+# Size of blocks read to compute checksums
+_BLOCK_SIZE = 1024 * 1024
+
+#===============================================================================
+# Walk a directory like os.walk following symlinks. A directory is not entered
+# if it is one of its parents (symlink loop), directories reached by several
+# paths are walked for each of them. Directories that can not be accessed
+# (dangling symlinks...) are skipped.
+# Sub directories can be removed from dirnames like with os.walk.
+#===============================================================================
+def walk(root_dir):
+    parents = {}
+    for dirpath, dirnames, filenames in os.walk(root_dir, followlinks=True):
+        try:
+            st = os.stat(dirpath)
+        except OSError as ex:
+            logging.warning("Unable to access '%s': %s", dirpath, str(ex))
+            continue
+        inodes = parents.pop(dirpath, frozenset())
+        if (st.st_dev, st.st_ino) in inodes:
+            logging.warning("Symlink loop at '%s'", dirpath)
+            dirnames[:] = []
+            continue
+        yield dirpath, dirnames, filenames
+        inodes = inodes | {(st.st_dev, st.st_ino)}
+        for dirname in dirnames:
+            parents[os.path.join(dirpath, dirname)] = inodes
+
+#===============================================================================
+# Cache of checksums, keyed by file identity (device, inode, size and
+# modification time) so unchanged files are not read again.
+#===============================================================================
+class ChecksumCache(object):
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.entries = cache.load(filepath) or {}
+        self.used = {}
+
+    @staticmethod
+    def get_key(st):
+        return "%d:%d:%d:%d" % (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def get(self, key, algorithms):
+        entry = self.entries.get(key, {})
+        if all(algo in entry for algo in algorithms):
+            self.used[key] = entry
+            return entry
+        return None
+
+    def put(self, key, checksums):
+        entry = self.entries.setdefault(key, {})
+        entry.update(checksums)
+        self.used[key] = entry
+
+    # Only keep entries used since loading
+    def save(self):
+        cache.save(self.filepath, self.used)
+
+#===============================================================================
+# Compute checksums of a file with given algorithms.
+#===============================================================================
+def compute_file(filepath, algorithms):
+    hashes = {algo: hashlib.new(algo) for algo in algorithms}
+    with open(filepath, "rb") as fd:
+        while True:
+            data = fd.read(_BLOCK_SIZE)
+            if not data:
+                break
+            for _hash in hashes.values():
+                _hash.update(data)
+    return {algo: _hash.hexdigest() for algo, _hash in hashes.items()}
+
+#===============================================================================
+# Compute checksums of given files with a pool of threads.
+# Return a dictionary path -> {algo: checksum}.
+#===============================================================================
+def compute_files(filepaths, algorithms, jobs=1, cache_path=None):
+    checksum_cache = ChecksumCache(cache_path) if cache_path else None
+    results = {}
+    to_compute = {}
+    for filepath in filepaths:
+        key = ChecksumCache.get_key(os.stat(filepath))
+        entry = checksum_cache.get(key, algorithms) if checksum_cache else None
+        if entry:
+            results[filepath] = {algo: entry[algo] for algo in algorithms}
+        else:
+            to_compute[filepath] = key
+
+    logging.debug("Checksums: %d files, %d in cache",
+            len(filepaths), len(filepaths) - len(to_compute))
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        futures = {executor.submit(compute_file, filepath, algorithms): filepath
+                for filepath in to_compute}
+        for future in concurrent.futures.as_completed(futures):
+            filepath = futures[future]
+            results[filepath] = future.result()
+            if checksum_cache:
+                checksum_cache.put(to_compute[filepath], results[filepath])
+
+    if checksum_cache:
+        checksum_cache.save()
+    return results
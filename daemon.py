@@ -0,0 +1,284 @@
+
+import sys
+import os
+import io
+import time
+import errno
+import socket
+import struct
+import signal
+import logging
+import traceback
+import subprocess
+
+import daemonclient
+
+# Time (s) to wait for a request after a connection, and for the daemon start
+_REQUEST_TIMEOUT = 5
+_START_TIMEOUT = 10
+
+#===============================================================================
+# Build daemon of a workspace.
+#
+# The daemon is a fork server: it loads the build script modules and the
+# extensions once, then forks a child for each command sent by a client on a
+# unix socket (see daemonclient.py). The child gets the standard input/outputs
+# of the client (passed on the socket), its directory, environment and
+# arguments, and executes the build script main as the client would have done.
+# Each command is executed in a new process so nothing done by a command
+# (tasks executed, global variables) is visible by the next one.
+#
+# Before forking, the daemon can prepare the command in its own process (the
+# build script keeps there the tasks of the product/variant of the command, so
+# the child does not import them again).
+#
+# The daemon checks the source files of loaded modules before each command,
+# if one changed the command is executed by the client itself and the daemon
+# restarts itself.
+#===============================================================================
+
+#===============================================================================
+# Get state of files (stat information), None for missing files.
+#===============================================================================
+def get_files_state(filepaths):
+    state = {}
+    for filepath in filepaths:
+        try:
+            st = os.stat(filepath)
+            state[filepath] = [st.st_size, st.st_mtime_ns, st.st_ino]
+        except OSError:
+            state[filepath] = None
+    return state
+
+#===============================================================================
+# Fork server.
+# handler: function executing a command (argv, cwd, env) in the child process.
+# get_sources: function returning files that invalidate the daemon when they
+# change (or are created).
+# prepare: optional function preparing a command (argv, cwd, env) in the
+# daemon process before forking.
+#===============================================================================
+class Daemon(object):
+    def __init__(self, socket_path, handler, get_sources, prepare=None):
+        self.socket_path = socket_path
+        self.handler = handler
+        self.get_sources = get_sources
+        self.prepare = prepare
+        self.sources_state = get_files_state(get_sources())
+        self.start_time = time.time()
+        self.served = 0
+        self.children = set()
+        self.listener = None
+        self.running = True
+
+    def serve(self):
+        self._bind()
+        logging.info("Daemon %d listening on '%s'", os.getpid(), self.socket_path)
+
+        def signal_handler(_sig, _frame):
+            self.running = False
+        signal.signal(signal.SIGTERM, signal_handler)
+        signal.signal(signal.SIGINT, signal_handler)
+
+        restart = False
+        try:
+            while self.running and not restart:
+                self._reap()
+                try:
+                    conn, _ = self.listener.accept()
+                except socket.timeout:
+                    continue
+                except InterruptedError:
+                    continue
+                try:
+                    restart = self._handle(conn)
+                except (OSError, ValueError, EOFError) as ex:
+                    logging.warning("Invalid request: %s", str(ex))
+                finally:
+                    conn.close()
+        finally:
+            self._unbind()
+
+        if restart:
+            logging.info("Sources changed, restarting daemon")
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        logging.info("Daemon %d stopped", os.getpid())
+
+    def _bind(self):
+        # Remove the socket of a daemon that did not stop properly
+        if os.path.exists(self.socket_path):
+            sock = daemonclient.connect(self.socket_path)
+            if sock:
+                sock.close()
+                raise OSError(errno.EADDRINUSE,
+                        "Daemon already running on '%s'" % self.socket_path)
+            os.unlink(self.socket_path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.listener.listen(16)
+        self.listener.settimeout(1)
+
+    def _unbind(self):
+        self.listener.close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+    # Wait for terminated commands
+    def _reap(self):
+        for pid in list(self.children):
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                    self.children.discard(pid)
+            except ChildProcessError:
+                self.children.discard(pid)
+
+    # Handle a connection. Return True if the daemon shall be restarted
+    def _handle(self, conn):
+        conn.settimeout(_REQUEST_TIMEOUT)
+        # Only accept connections from the same user
+        if hasattr(socket, "SO_PEERCRED"):
+            creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                    struct.calcsize("3i"))
+            _, uid, _ = struct.unpack("3i", creds)
+            if uid != os.getuid():
+                logging.warning("Connection refused for uid %d", uid)
+                return False
+
+        request, fds = daemonclient.recv_msg(conn, max_fds=3)
+        try:
+            if not request:
+                return False
+            if request.get("cmd") == "status":
+                self._reap()
+                daemonclient.send_msg(conn, {
+                    "pid": os.getpid(),
+                    "uptime": time.time() - self.start_time,
+                    "served": self.served,
+                    "running": len(self.children),
+                })
+                return False
+            if request.get("cmd") == "stop":
+                daemonclient.send_msg(conn, {"pid": os.getpid()})
+                self.running = False
+                return False
+            if request.get("cmd") != "build" or len(fds) != 3:
+                daemonclient.send_msg(conn, {"error": "invalid request"})
+                return False
+
+            # The client executes the command itself if sources changed
+            sources_state = get_files_state(self.get_sources())
+            if sources_state != self.sources_state:
+                for filepath in sorted(set(sources_state) | set(self.sources_state)):
+                    if sources_state.get(filepath) != self.sources_state.get(filepath):
+                        logging.info("Source changed: '%s'", filepath)
+                daemonclient.send_msg(conn, {"stale": True})
+                return True
+
+            if self.prepare:
+                self._prepare(request)
+
+            pid = os.fork()
+            if pid == 0:
+                self._run_child(conn, fds, request)
+            self.children.add(pid)
+            self.served += 1
+            logging.debug("Command %d: %s", pid, " ".join(request["argv"][1:]))
+            return False
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    # Prepare a command in the daemon process. Modules it loads become sources
+    # of the daemon (changes of modules of the command are checked by prepare)
+    def _prepare(self, request):
+        try:
+            self.prepare(request["argv"], request["cwd"], request["env"])
+        except Exception:
+            logging.warning("Unable to prepare command:\n%s", traceback.format_exc())
+        sources = [filepath for filepath in self.get_sources()
+                if filepath not in self.sources_state]
+        self.sources_state.update(get_files_state(sources))
+
+    # Execute a command in a child process (never returns)
+    def _run_child(self, conn, fds, request):
+        exitcode = 1
+        try:
+            self.listener.close()
+            for sig in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT]:
+                signal.signal(sig, signal.SIG_DFL)
+
+            # Own process group, so the client can forward signals to the
+            # command and processes it executes
+            os.setpgid(0, 0)
+            daemonclient.send_msg(conn, {"pid": os.getpid()})
+
+            # Use standard input/outputs of the client
+            for fd, stdfd in zip(fds, [0, 1, 2]):
+                os.dup2(fd, stdfd)
+            sys.stdin = io.TextIOWrapper(io.FileIO(0, "r", closefd=False))
+            sys.stdout = io.TextIOWrapper(io.FileIO(1, "w", closefd=False),
+                    line_buffering=True)
+            sys.stderr = io.TextIOWrapper(io.FileIO(2, "w", closefd=False),
+                    line_buffering=True)
+            logging.root.handlers[:] = []
+
+            os.chdir(request["cwd"])
+            os.environ.clear()
+            os.environ.update(request["env"])
+            sys.argv = request["argv"]
+            try:
+                self.handler()
+                exitcode = 0
+            except SystemExit as ex:
+                if ex.code is None or isinstance(ex.code, int):
+                    exitcode = ex.code or 0
+                else:
+                    sys.stderr.write("%s\n" % ex.code)
+            except BaseException:
+                traceback.print_exc()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            daemonclient.send_msg(conn, {"exitcode": exitcode})
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(exitcode)
+
+#===============================================================================
+# Start the daemon in background with given command line. Its output is saved
+# in a log file.
+# Return the pid of the daemon.
+#===============================================================================
+def start(socket_path, cmd, log_path):
+    reply = daemonclient.send_control(socket_path, "status")
+    if reply:
+        return reply["pid"]
+    with open(os.devnull, "r") as devnull, open(log_path, "a") as log:
+        env = os.environ.copy()
+        env.pop(daemonclient.DAEMON_ENV, None)
+        subprocess.Popen(cmd, stdin=devnull, stdout=log, stderr=log,
+                env=env, start_new_session=True, close_fds=True)
+    # Wait for the daemon to accept connections
+    limit = time.time() + _START_TIMEOUT
+    while time.time() < limit:
+        reply = daemonclient.send_control(socket_path, "status")
+        if reply:
+            return reply["pid"]
+        time.sleep(0.1)
+    return None
+
+#===============================================================================
+# Stop the daemon. Return its pid, None if it was not running.
+#===============================================================================
+def stop(socket_path):
+    reply = daemonclient.send_control(socket_path, "stop")
+    return reply["pid"] if reply else None
+
+#===============================================================================
+# Get status of the daemon (dictionary), None if it is not running.
+#===============================================================================
+def get_status(socket_path):
+    return daemonclient.send_control(socket_path, "status")
@@ -0,0 +1,157 @@
+
+# Client of the build daemon (see daemon.py).
+# It is executed by build.py before loading anything else so it only uses a few
+# standard modules, messages are serialized with marshal (both sides are
+# executed by the same python).
+
+import sys
+import os
+import array
+import marshal
+import socket
+import struct
+import signal
+import zlib
+
+# Environment variable enabling the client ('1')
+DAEMON_ENV = "DRAGON_DAEMON"
+
+# Maximum length of a unix socket path (108 on linux including the final 0)
+_MAX_SOCKET_PATH = 100
+
+# Time (s) to wait for the reply to a control command
+_CONTROL_TIMEOUT = 5
+
+#===============================================================================
+# Check if commands shall be sent to a daemon.
+#===============================================================================
+def is_enabled():
+    return os.environ.get(DAEMON_ENV, "") == "1" and "--daemon" not in sys.argv
+
+#===============================================================================
+# Get path of the socket of the daemon for an output directory. A shorter path
+# in the temporary directory is used if the path is too long for a socket.
+#===============================================================================
+def get_socket_path(out_root_dir):
+    socket_path = os.path.join(os.path.abspath(out_root_dir), "dragon-daemon.sock")
+    if len(socket_path.encode("utf-8")) > _MAX_SOCKET_PATH:
+        socket_path = os.path.join(os.environ.get("TMPDIR", "/tmp"),
+                "dragon-daemon-%d-%08x.sock" % (os.getuid(),
+                        zlib.crc32(socket_path.encode("utf-8"))))
+    return socket_path
+
+#===============================================================================
+# Send a message with optional file descriptors.
+#===============================================================================
+def send_msg(sock, msg, fds=None):
+    data = marshal.dumps(msg)
+    data = struct.pack("!I", len(data)) + data
+    if fds:
+        ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))]
+        sent = sock.sendmsg([data], ancdata)
+        data = data[sent:]
+    if data:
+        sock.sendall(data)
+
+#===============================================================================
+# Receive a message and file descriptors sent with it.
+# Return (None, []) if the connection was closed.
+#===============================================================================
+def recv_msg(sock, max_fds=0):
+    fds = array.array("i")
+    ancbufsize = socket.CMSG_LEN(max_fds * fds.itemsize) if max_fds else 0
+    header, ancdata, _, _ = sock.recvmsg(4, ancbufsize)
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+    while header and len(header) < 4:
+        chunk = sock.recv(4 - len(header))
+        if not chunk:
+            break
+        header += chunk
+    data = b""
+    size = struct.unpack("!I", header)[0] if len(header) == 4 else -1
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    if len(data) != size:
+        for fd in fds:
+            os.close(fd)
+        return None, []
+    return marshal.loads(data), list(fds)
+
+#===============================================================================
+# Connect to the daemon. Return None if it is not running.
+#===============================================================================
+def connect(socket_path):
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+#===============================================================================
+# Send a control command (status, stop) to the daemon.
+# Return the reply or None if the daemon is not running.
+#===============================================================================
+def send_control(socket_path, cmd):
+    sock = connect(socket_path)
+    if not sock:
+        return None
+    try:
+        sock.settimeout(_CONTROL_TIMEOUT)
+        send_msg(sock, {"cmd": cmd})
+        return recv_msg(sock)[0]
+    except (OSError, ValueError, EOFError):
+        return None
+    finally:
+        sock.close()
+
+#===============================================================================
+# Execute the command line of this process in the daemon and exit with its
+# exit code. Return (to execute the command in this process) if the daemon is
+# not running or can not execute it.
+#===============================================================================
+def run(socket_path):
+    sock = connect(socket_path)
+    if not sock:
+        return
+    try:
+        send_msg(sock, {
+            "cmd": "build",
+            "argv": sys.argv,
+            "cwd": os.getcwd(),
+            "env": dict(os.environ),
+        }, fds=[0, 1, 2])
+        reply, _ = recv_msg(sock)
+    except (OSError, ValueError, EOFError):
+        reply = None
+    if not reply or "pid" not in reply:
+        sock.close()
+        return
+
+    # Signals are forwarded to the process group of the command
+    pid = reply["pid"]
+    def signal_handler(sig, _frame):
+        try:
+            os.killpg(pid, sig)
+        except OSError:
+            pass
+    for sig in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT]:
+        signal.signal(sig, signal_handler)
+
+    # Wait for the exit code (the connection is closed without it if the
+    # command was killed)
+    try:
+        reply, _ = recv_msg(sock)
+    except (OSError, ValueError, EOFError):
+        reply = None
+    sock.close()
+    sys.stdout.flush()
+    os._exit(reply["exitcode"] if reply and "exitcode" in reply else 1)
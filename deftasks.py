@@ -1,23 +1,31 @@
 
 import sys
 import os
+import glob
 import json
 import platform
 
 import dragon
+import fingerprint
 import police
+import store
 
 #===============================================================================
 # Hooks.
 #===============================================================================
 
 def hook_post_clean(task, args):
-    dragon.exec_cmd("rm -rf %s" % dragon.POLICE_OUT_DIR)
-    dragon.exec_cmd("rm -rf %s" % dragon.IMAGES_DIR)
-    dragon.exec_cmd("rm -rf %s" % os.path.join(dragon.OUT_DIR, "release-*"))
-    dragon.exec_cmd("rm -rf %s" % os.path.join(dragon.OUT_DIR, "pinstrc"))
-    dragon.exec_cmd("rm -f %s" % os.path.join(dragon.OUT_DIR, "build.prop"))
-    dragon.exec_cmd("rm -f %s" % os.path.join(dragon.OUT_DIR, "manifest.xml"))
+    with dragon.FsBatch() as batch:
+        batch.remove(dragon.POLICE_OUT_DIR)
+        batch.remove(dragon.IMAGES_DIR)
+        for path in glob.glob(os.path.join(dragon.OUT_DIR, "release-*")):
+            batch.remove(path)
+        batch.remove(os.path.join(dragon.OUT_DIR, "pinstrc"))
+        batch.remove(os.path.join(dragon.OUT_DIR, "build.prop"))
+        batch.remove(os.path.join(dragon.OUT_DIR, "manifest.xml"))
+        batch.remove(os.path.join(dragon.OUT_DIR, "dragon-cache"))
+        for path in fingerprint.get_record_paths():
+            batch.remove(path)
 
 def hook_pre_images(task, args):
     # Automatically generate a manifest.xml in final/etc (if it exists)
@@ -33,26 +41,41 @@ def hook_pre_images(task, args):
         dragon.relative_symlink(build_prop_path,
                                 os.path.join(dragon.OUT_DIR,
                                              os.path.basename(build_prop_path)))
+    # Do not generate images again if the final directory and the images
+    # configuration did not change since the last generation
+    task.images_key = dragon.get_images_key(task, args)
+    if dragon.is_images_up_to_date(task.images_key):
+        dragon.LOGI("Images are up to date")
+        task.subtasks_up_to_date = True
+
+def plan_images(task, args):
+    # Subtasks are not executed if images are up to date
+    return {"images_up_to_date": dragon.is_images_up_to_date(
+            dragon.get_images_key(task, args))}
 
 def hook_post_images(task, args):
+    # Save the key of generated images (before they are moved)
+    if getattr(task, "images_key", None) and not task.subtasks_up_to_date \
+            and not dragon.OPTIONS.dryrun:
+        dragon.save_images_key(task.images_key)
     # Create the images directory so the release task is happy
     dragon.makedirs(dragon.IMAGES_DIR)
-    # Get json config file
-    json_cfg = dragon.get_json_config()
     # Alchemy images to get verbatim
-    if json_cfg and "images" in json_cfg:
-        for _ext in json_cfg["images"].get("extensions", []):
-            filename = "%s-%s%s" % (dragon.PRODUCT, dragon.VARIANT, _ext)
-            src_path = os.path.join(dragon.OUT_DIR, filename)
-            dst_path = os.path.join(dragon.IMAGES_DIR, filename)
-            if os.path.exists(src_path):
-                dragon.exec_cmd("mv -f %s %s" % (src_path, dst_path))
+    images_cfg = dragon.get_images_config()
+    if images_cfg:
+        with dragon.FsBatch() as batch:
+            for _ext in images_cfg.get("extensions", []):
+                filename = "%s-%s%s" % (dragon.PRODUCT, dragon.VARIANT, _ext)
+                src_path = os.path.join(dragon.OUT_DIR, filename)
+                dst_path = os.path.join(dragon.IMAGES_DIR, filename)
+                if os.path.exists(src_path):
+                    batch.move(src_path, dst_path)
 
 def hook_police_report(task, args):
     police.gen_report(addhtml=True, addtxt=False, compress=False)
 
 def hook_pre_police_packages(task, args):
-    task.extra_env["OSS_PACKAGES"] = police.get_packages()
+    task.extra_env["OSS_PACKAGES"] = " ".join(police.get_index().get_packages())
 
 def hook_pre_release(task, args):
     # Do not include gdb server in generated images
@@ -60,7 +83,7 @@ def hook_pre_release(task, args):
     dragon.check_build_id()
     if dragon.PARROT_BUILD_PROP_UID.lower() != dragon.PARROT_BUILD_PROP_UID:
         raise dragon.TaskError("You shall provide a lowercase build_id")
-    dragon.exec_cmd("rm -rf %s" % dragon.RELEASE_DIR)
+    dragon.remove_path(dragon.RELEASE_DIR)
     dragon.makedirs(dragon.OUT_DIR)
     if platform.system() == 'Linux':
         dragon.exec_cmd("dpkg --list > os_packages.txt", cwd=dragon.OUT_DIR)
@@ -74,6 +97,36 @@ def hook_pre_release(task, args):
 def hook_gen_release_archive(task, args):
     dragon.gen_release_archive()
 
+def hook_release_store(task, args):
+    if "--prune" in args:
+        count, size = store.prune()
+        dragon.LOGI("Removed %d unreferenced files (%d bytes)", count, size)
+    count, physical_size, logical_size = store.get_stats()
+    dragon.LOGI("Release store: %s", store.get_store_dir())
+    dragon.LOGI("Stored files: %d (%d bytes)", count, physical_size)
+    dragon.LOGI("Referenced size: %d bytes", logical_size)
+    if physical_size:
+        dragon.LOGI("Dedup ratio: %.2f", float(logical_size) / physical_size)
+
+def hook_workspace_fingerprint(task, args):
+    info = fingerprint.compute(dragon.OPTIONS.jobs.job_num)
+    dragon.LOGI("Workspace fingerprint: %s", info["fingerprint"])
+    if args and args[0] == "--check":
+        if len(args) < 2:
+            raise dragon.TaskError("Missing tasks of the build to check "
+                    "after '--check'")
+        record = fingerprint.load_record(args[1:])
+        if not record:
+            raise dragon.TaskError("No successful build of '%s' recorded in "
+                    "'%s'" % (", ".join(args[1:]), dragon.OUT_DIR))
+        if record["fingerprint"] != info["fingerprint"]:
+            for name in fingerprint.get_differences(record, info):
+                dragon.LOGI("Changed: %s", name)
+            raise dragon.TaskError("Workspace changed since the last "
+                    "successful build (%s)" % record["build_id"])
+        dragon.LOGI("Workspace did not change since the last successful "
+                "build (%s: %s)", record["build_id"], ", ".join(record["tasks"]))
+
 def hook_alchemy_genproject(task, args):
     script_path = os.path.join(dragon.ALCHEMY_HOME, "scripts",
                                "genproject", "genproject.py")
@@ -123,6 +176,7 @@ dragon.add_meta_task(
     subtasks=["alchemy image"],
     prehook=hook_pre_images,
     posthook=hook_post_images,
+    planhook=plan_images,
     weak=True
 )
 
@@ -132,6 +186,7 @@ dragon.add_meta_task(
     subtasks=["alchemy image"],
     prehook=hook_pre_images,
     posthook=hook_post_images,
+    planhook=plan_images,
     weak=True
 )
 
@@ -195,6 +250,25 @@ dragon.add_meta_task(
     weak=True
 )
 
+dragon.add_meta_task(
+    name = "release-store",
+    desc = "Report usage of the release store, '--prune' removes "
+            "files not referenced by releases anymore",
+    exechook = hook_release_store,
+    secondary_help=True,
+    weak=True
+)
+
+dragon.add_meta_task(
+    name = "workspace-fingerprint",
+    desc = "Display the fingerprint of the sources of the workspace, "
+            "'--check <task>...' fails if it changed since the last "
+            "successful build of the tasks (see --record-fingerprint)",
+    exechook = hook_workspace_fingerprint,
+    secondary_help=True,
+    weak=True
+)
+
 dragon.add_meta_task(
     name = "release",
     desc = "Build everything & generate a release archive",
@@ -206,6 +280,23 @@ dragon.add_meta_task(
         "alchemy symbols-tar sdk dump-modules",
         "gen-release-archive"
     ],
+    # Police report shall be in final directory before generating images.
+    # Symbols/sdk only need the build to be done, but the police report shall
+    # not be generated while they are built (it reads the log of spied
+    # processes, alchemy processes would still append to it).
+    depends = {
+        "police-report": ["build"],
+        "police-packages": ["build", "police-report"],
+        "images-all": ["build", "police-report"],
+        "alchemy symbols-tar sdk dump-modules": ["build", "police-report"],
+        "gen-release-archive": [
+            "build",
+            "police-report",
+            "police-packages",
+            "images-all",
+            "alchemy symbols-tar sdk dump-modules",
+        ],
+    },
     prehook = hook_pre_release,
     secondary_help=True,
     weak=True
@@ -6,6 +6,9 @@ import argparse
 import json
 import tempfile
 import collections
+import contextlib
+import copy
+import filecmp
 
 from task import Hook as Hook
 from task import TaskError as TaskError
@@ -19,6 +22,13 @@ from utils import *
 
 from version import Version, split_uid
 
+import archive
+import cache
+import checksum
+import fingerprint
+import scheduler
+import store
+
 # Options (set by build.py)
 OPTIONS = None
 
@@ -29,15 +39,16 @@ BUILD_WRAPPERS = []
 # Set workspace directory (go up relative to this script)
 WORKSPACE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
 
-# Global variables (some are initialized from environment)
+# Global variables (some are initialized from environment, see
+# _init_environ_globals)
 PRODUCT = ""
 VARIANT = ""
-OUT_ROOT_DIR = os.environ.get("DRAGON_OUT_ROOT_DIR", "")
-OUT_DIR = os.environ.get("DRAGON_OUT_DIR", "")
-PACKAGES_DIR = os.environ.get("DRAGON_PACKAGES_DIR", "")
-PRODUCTS_DIR = os.environ.get("DRAGON_PRODUCTS_DIR", "")
+OUT_ROOT_DIR = ""
+OUT_DIR = ""
+PACKAGES_DIR = ""
+PRODUCTS_DIR = ""
 BUILD_DIR = ""
-DEPLOY_DIR = os.environ.get("TARGET_DEPLOY_ROOT", "usr").strip("/")
+DEPLOY_DIR = ""
 STAGING_DIR = ""
 FINAL_DIR = ""
 IMAGES_DIR = ""
@@ -45,28 +56,73 @@ PRODUCT_DIR = ""
 VARIANT_DIR = ""
 RELEASE_DIR = ""
 
-# Initialize Parrot build properties from environment
-PARROT_BUILD_PROP_GROUP = os.environ.get("PARROT_BUILD_PROP_GROUP", "drones")
-PARROT_BUILD_PROP_PROJECT = os.environ.get("PARROT_BUILD_PROP_PROJECT", "")
-PARROT_BUILD_PROP_PRODUCT = os.environ.get("PARROT_BUILD_PROP_PRODUCT", "")
-PARROT_BUILD_PROP_VARIANT = os.environ.get("PARROT_BUILD_PROP_VARIANT", "")
-PARROT_BUILD_PROP_REGION = os.environ.get("PARROT_BUILD_PROP_REGION", "")
-PARROT_BUILD_PROP_UID = os.environ.get("PARROT_BUILD_PROP_UID", "")
-PARROT_BUILD_PROP_VERSION = os.environ.get("PARROT_BUILD_PROP_VERSION", "")
-PARROT_BUILD_TAG_PREFIX = os.environ.get("PARROT_BUILD_TAG_PREFIX", "")
+# Parrot build properties (initialized from environment)
+PARROT_BUILD_PROP_GROUP = ""
+PARROT_BUILD_PROP_PROJECT = ""
+PARROT_BUILD_PROP_PRODUCT = ""
+PARROT_BUILD_PROP_VARIANT = ""
+PARROT_BUILD_PROP_REGION = ""
+PARROT_BUILD_PROP_UID = ""
+PARROT_BUILD_PROP_VERSION = ""
+PARROT_BUILD_TAG_PREFIX = ""
 PARROT_BUILD_VERSION = None
 
-# Initialize directory where alchemy is from environment
-ALCHEMY_HOME = os.environ.get("ALCHEMY_HOME", "")
+# Directory where alchemy is (initialized from environment)
+ALCHEMY_HOME = ""
 
-# Initialize directory where police is from environment
-POLICE_HOME = os.environ.get("POLICE_HOME", "")
+# Directory where police is (initialized from environment)
+POLICE_HOME = ""
 
 POLICE_OUT_DIR = ""
 POLICE_SPY_LOG = ""
 POLICE_PROCESS_LOG = ""
 POLICE_XML_LICENSES = []
 
+#===============================================================================
+# Initialize global variables from environment (at import, and for each
+# command executed by the build daemon with the environment of its client).
+#===============================================================================
+def _init_environ_globals():
+    global OUT_ROOT_DIR, OUT_DIR, PACKAGES_DIR, PRODUCTS_DIR, DEPLOY_DIR
+    global PARROT_BUILD_PROP_GROUP, PARROT_BUILD_PROP_PROJECT
+    global PARROT_BUILD_PROP_PRODUCT, PARROT_BUILD_PROP_VARIANT
+    global PARROT_BUILD_PROP_REGION, PARROT_BUILD_PROP_UID
+    global PARROT_BUILD_PROP_VERSION, PARROT_BUILD_TAG_PREFIX
+    global ALCHEMY_HOME, POLICE_HOME
+    OUT_ROOT_DIR = os.environ.get("DRAGON_OUT_ROOT_DIR", "")
+    OUT_DIR = os.environ.get("DRAGON_OUT_DIR", "")
+    PACKAGES_DIR = os.environ.get("DRAGON_PACKAGES_DIR", "")
+    PRODUCTS_DIR = os.environ.get("DRAGON_PRODUCTS_DIR", "")
+    DEPLOY_DIR = os.environ.get("TARGET_DEPLOY_ROOT", "usr").strip("/")
+
+    # Parrot build properties
+    PARROT_BUILD_PROP_GROUP = os.environ.get("PARROT_BUILD_PROP_GROUP", "drones")
+    PARROT_BUILD_PROP_PROJECT = os.environ.get("PARROT_BUILD_PROP_PROJECT", "")
+    PARROT_BUILD_PROP_PRODUCT = os.environ.get("PARROT_BUILD_PROP_PRODUCT", "")
+    PARROT_BUILD_PROP_VARIANT = os.environ.get("PARROT_BUILD_PROP_VARIANT", "")
+    PARROT_BUILD_PROP_REGION = os.environ.get("PARROT_BUILD_PROP_REGION", "")
+    PARROT_BUILD_PROP_UID = os.environ.get("PARROT_BUILD_PROP_UID", "")
+    PARROT_BUILD_PROP_VERSION = os.environ.get("PARROT_BUILD_PROP_VERSION", "")
+    PARROT_BUILD_TAG_PREFIX = os.environ.get("PARROT_BUILD_TAG_PREFIX", "")
+
+    # Directories where alchemy and police are
+    ALCHEMY_HOME = os.environ.get("ALCHEMY_HOME", "")
+    POLICE_HOME = os.environ.get("POLICE_HOME", "")
+
+_init_environ_globals()
+
+# Handler to execute tasks of another product/variant in the same process
+# instead of restarting the build script (set by build.py)
+PRODUCT_HANDLER = None
+
+# Handler to get the plan of tasks of another product/variant by loading it in
+# the same process (set by build.py)
+PLAN_HANDLER = None
+
+# Names of tasks whose failure was ignored (-k option), a build is only
+# successful if none failed
+FAILED_TASKS = []
+
 # Log wrappers
 LOGE = logging.error
 LOGW = logging.warning
@@ -125,31 +181,42 @@ def add_task(task):
 
 #===============================================================================
 # Register a new alchemy task.
+# inputs/outputs: see Task (the task is skipped when up to date).
+# planhook: see Task (describes what hooks would do in --plan).
 #===============================================================================
 def add_alchemy_task(name, desc, product, variant, defargs=None,
         secondary_help=False,
         prehook=None, posthook=None, weak=False,
-        outsubdir=None, host_in_subdir=True):
+        outsubdir=None, host_in_subdir=True, inputs=None, outputs=None,
+        planhook=None):
     add_task(AlchemyTask(name, desc, product, variant, defargs,
-            secondary_help, prehook, posthook, weak, outsubdir, host_in_subdir))
+            secondary_help, prehook, posthook, weak, outsubdir, host_in_subdir,
+            inputs, outputs, planhook))
 
 #===============================================================================
 # Register a new meta task.
+# inputs/outputs: see Task (the task is skipped when up to date).
+# planhook: see Task (describes what hooks would do in --plan).
 #===============================================================================
 def add_meta_task(name, desc, subtasks=None,
         secondary_help=False,
-        exechook=None, prehook=None, posthook=None, weak=False):
+        exechook=None, prehook=None, posthook=None, weak=False,
+        depends=None, inputs=None, outputs=None, planhook=None):
     add_task(MetaTask(name, desc, subtasks,
-            secondary_help, exechook, prehook, posthook, weak))
+            secondary_help, exechook, prehook, posthook, weak, depends,
+            inputs, outputs, planhook))
 
 #===============================================================================
 # Register a new product task.
+# inputs/outputs: see Task (the task is skipped when up to date).
+# planhook: see Task (describes what hooks would do in --plan).
 #===============================================================================
 def add_product_task(name, desc, product, variant, defargs=None,
         secondary_help=False,
-        prehook=None, posthook=None, weak=False):
+        prehook=None, posthook=None, weak=False, inputs=None, outputs=None,
+        planhook=None):
     add_task(ProductTask(name, desc, product, variant, defargs,
-            secondary_help, prehook, posthook, weak))
+            secondary_help, prehook, posthook, weak, inputs, outputs, planhook))
 
 #===============================================================================
 # Get registered tasks.
@@ -160,9 +227,16 @@ def get_tasks():
 #===============================================================================
 # Override a task
 #===============================================================================
-def _override_task(task, desc=None, exechook=None, prehook=None, posthook=None):
+def _override_task(task, desc=None, exechook=None, prehook=None, posthook=None,
+        inputs=None, outputs=None, planhook=None):
     if desc is not None:
         task.desc = desc
+    if planhook is not None:
+        task.planhook = planhook
+    if inputs is not None:
+        task.inputs = inputs
+    if outputs is not None:
+        task.outputs = outputs
     # Chain new hooks
     if exechook is not None:
         task.exechook = Hook(exechook, task.exechook)
@@ -176,7 +250,7 @@ def _override_task(task, desc=None, exechook=None, prehook=None, posthook=None):
 #===============================================================================
 def override_alchemy_task(name, desc=None, defargs=None,
         exechook=None, prehook=None, posthook=None, outsubdir=None,
-        host_in_subdir=True):
+        host_in_subdir=True, inputs=None, outputs=None, planhook=None):
     task = _TASKS.get(name, None)
     if not task:
         logging.warning("override_alchemy_task: unknown task: '%s'", name)
@@ -188,13 +262,15 @@ def override_alchemy_task(name, desc=None, defargs=None,
         if outsubdir is not None:
             task.outsubdir = outsubdir
         task.host_in_subdir = host_in_subdir
-        _override_task(task, desc, exechook, prehook, posthook)
+        _override_task(task, desc, exechook, prehook, posthook, inputs, outputs,
+                planhook)
 
 #===============================================================================
 # Override a meta task
 #===============================================================================
 def override_meta_task(name, desc=None, subtasks=None,
-        exechook=None, prehook=None, posthook=None):
+        exechook=None, prehook=None, posthook=None, depends=None,
+        inputs=None, outputs=None, planhook=None):
     task = _TASKS.get(name, None)
     if not task:
         logging.warning("override_meta_task: unknown task: '%s'", name)
@@ -203,7 +279,10 @@ def override_meta_task(name, desc=None, subtasks=None,
     else:
         if subtasks is not None:
             task.subtasks = subtasks
-        _override_task(task, desc, exechook, prehook, posthook)
+        if depends is not None:
+            task.depends = depends
+        _override_task(task, desc, exechook, prehook, posthook, inputs, outputs,
+                planhook)
 
 #===============================================================================
 # Check that tasks are valid: metatask subtasks should exist.
@@ -244,7 +323,57 @@ def do_task(taskname, args=None, extra_env=None, top_info=None):
         raise TaskError("Unknown task: '%s'" % taskname)
     if top_info is None:
         top_info = collections.namedtuple("TopInfo", "taskname, args")(taskname, args)
-    _TASKS[taskname].execute(args, extra_env, top_info)
+    task = _TASKS[taskname]
+    # Tasks executed concurrently shall not share their execution state
+    if scheduler.in_worker():
+        task = copy.copy(task)
+        task.extra_env = dict(task.extra_env or {})
+    task.execute(args, extra_env, top_info)
+
+#===============================================================================
+# Start a list of tasks.
+# tasks is a list of {"name": <name>, "args": [<args>]}.
+# depends is an optional dictionary giving for a task name the list of task
+# names it depends on. If given (and not empty), independent tasks can be
+# executed concurrently, otherwise tasks are executed in order.
+#===============================================================================
+def do_tasks(tasks, depends=None):
+    if not depends:
+        for task in tasks:
+            do_task(task["name"], task["args"])
+        return
+    tasks_by_name = collections.OrderedDict()
+    for task in tasks:
+        if task["name"] in tasks_by_name:
+            raise TaskError("Task '%s' given twice with dependencies" % task["name"])
+        tasks_by_name[task["name"]] = task
+    scheduler.run(list(tasks_by_name.keys()), depends,
+            lambda name: do_task(name, tasks_by_name[name]["args"]),
+            OPTIONS.jobs.job_num)
+
+#===============================================================================
+# Get the plan of a task without executing it (see Task.plan).
+#===============================================================================
+def plan_task(taskname, args=None, extra_env=None):
+    if taskname not in _TASKS:
+        raise TaskError("Unknown task: '%s'" % taskname)
+    return _TASKS[taskname].plan(args, extra_env)
+
+#===============================================================================
+# Get the plan of a build of the current product/variant: list of tasks
+# (like do_tasks) and wrappers the build would be restarted with.
+#===============================================================================
+def plan_build(tasks, depends=None):
+    return {
+        "product": PRODUCT,
+        "variant": VARIANT,
+        "out_dir": OUT_DIR,
+        "build_id": PARROT_BUILD_PROP_UID,
+        "wrappers": [wrapper[0].format(**globals()) if "{" in wrapper[0]
+                else wrapper[0] for wrapper in BUILD_WRAPPERS],
+        "tasks": [plan_task(task["name"], task["args"]) for task in tasks],
+        "depends": depends or {},
+    }
 
 #===============================================================================
 # Get the output directory of a product/variant.
@@ -279,24 +408,36 @@ def add_build_wrapper(script, option_text):
     BUILD_WRAPPERS.append(wrapper)
 
 #===============================================================================
-# Restart the build script with given product/variant
+# Get the command line to restart the build script with given product/variant.
+# jobs can be given to override the -j option.
 #===============================================================================
-def restart(product, variant, extra_args, with_wrappers=False):
+def get_restart_cmd(product, variant, extra_args, with_wrappers=False, jobs=None):
     # Reconstruct command line with given product
     cmd_args = []
     cmd_args.append(sys.argv[0])
     cmd_args.append("-p %s-%s" % (product, variant))
-    cmd_args.append("-j %s" % OPTIONS.jobs.restart_arg)
+    cmd_args.append("-j %s" % (jobs if jobs is not None else OPTIONS.jobs.restart_arg))
     opt_args = [
+        (OPTIONS.mem_per_job is not None, "--mem-per-job %g" % (OPTIONS.mem_per_job or 0)),
         (OPTIONS.verbose, "-v"),
         (OPTIONS.keep_going, "-k"),
         (not OPTIONS.colors, "--no-color"),
         (OPTIONS.build_id, "-b %s" % OPTIONS.build_id),
         (OPTIONS.police, "--police"),
         (OPTIONS.police_no_spy, "--police-no-spy"),
+        (OPTIONS.police_full, "--police-full"),
         (OPTIONS.police_packages, "--police-packages"),
+        (OPTIONS.reexec, "--reexec"),
+        (OPTIONS.release_store, "--release-store"),
+        (OPTIONS.record_fingerprint, "--record-fingerprint"),
+        (OPTIONS.docker_reuse, "--docker-reuse %d" % OPTIONS.docker_reuse),
+        (OPTIONS.force, "--force"),
+        (OPTIONS.task_logs, "--task-logs"),
+        (not OPTIONS.products_cache, "--no-products-cache"),
     ]
     cmd_args.extend([arg for opt, arg in opt_args if opt])
+    for taskname, deps in sorted(OPTIONS.task_deps.items()):
+        cmd_args.append("--task-deps %s:%s" % (taskname, ",".join(deps)))
 
     # Handle wrappers
     # if using them, process them backward (because we insert the script)
@@ -320,23 +461,186 @@ def restart(product, variant, extra_args, with_wrappers=False):
     if extra_args:
         cmd_args.extend(extra_args)
 
+    return " ".join(cmd_args)
+
+#===============================================================================
+# Restart the build script with given product/variant
+#===============================================================================
+def restart(product, variant, extra_args, with_wrappers=False):
+    # Stay in the same process if possible
+    if not with_wrappers and can_switch_context():
+        if PRODUCT_HANDLER(product, variant, extra_args or []):
+            return
+
     # Go!
-    cmd = " ".join(cmd_args)
+    cmd = get_restart_cmd(product, variant, extra_args, with_wrappers)
     try:
         exec_cmd(cmd, dryrun_arg="-n")
     except TaskError as ex:
         logging.error(str(ex))
         if not OPTIONS.keep_going:
             sys.exit(1)
+        FAILED_TASKS.append("%s-%s" % (product, variant))
+
+#===============================================================================
+# Get the plans of the builds a restart would do (several with a 'forall'
+# variant). If the product/variant can not be loaded in this process, the
+# plan only has the command that would be executed.
+#===============================================================================
+def plan_restart(product, variant, extra_args):
+    if PLAN_HANDLER is not None and not scheduler.in_worker():
+        builds = PLAN_HANDLER(product, variant, extra_args or [])
+        if builds is not None:
+            return builds
+    return [{
+        "product": product,
+        "variant": variant,
+        "cmd": get_restart_cmd(product, variant, extra_args),
+    }]
+
+#===============================================================================
+# Build context: global variables, registered tasks, environment and product
+# specific modules of a product/variant.
+#===============================================================================
+class BuildContext(object):
+    # Global variables of the context
+    VARIABLES = [
+        "OPTIONS", "BUILD_WRAPPERS",
+        "PRODUCT", "VARIANT",
+        "OUT_ROOT_DIR", "OUT_DIR", "PACKAGES_DIR", "PRODUCTS_DIR",
+        "BUILD_DIR", "DEPLOY_DIR", "STAGING_DIR", "FINAL_DIR", "IMAGES_DIR",
+        "PRODUCT_DIR", "VARIANT_DIR", "RELEASE_DIR",
+        "PARROT_BUILD_PROP_GROUP", "PARROT_BUILD_PROP_PROJECT",
+        "PARROT_BUILD_PROP_PRODUCT", "PARROT_BUILD_PROP_VARIANT",
+        "PARROT_BUILD_PROP_REGION", "PARROT_BUILD_PROP_UID",
+        "PARROT_BUILD_PROP_VERSION", "PARROT_BUILD_TAG_PREFIX",
+        "PARROT_BUILD_VERSION",
+        "ALCHEMY_HOME", "POLICE_HOME",
+        "POLICE_OUT_DIR", "POLICE_SPY_LOG", "POLICE_PROCESS_LOG",
+        "POLICE_XML_LICENSES",
+    ]
+
+    def __init__(self):
+        self.values = {}
+        self.tasks = {}
+        self.environ = {}
+        self.sys_path = []
+        self.modules = {}
+
+    # Capture the current context
+    @staticmethod
+    def capture():
+        context = BuildContext()
+        for name in BuildContext.VARIABLES:
+            value = globals()[name]
+            context.values[name] = list(value) if isinstance(value, list) else value
+        context.tasks = dict(_TASKS)
+        context.environ = os.environ.copy()
+        context.sys_path = list(sys.path)
+        context.modules = BuildContext.get_product_modules()
+        return context
+
+    # Restore the context
+    def restore(self):
+        globals().update(self.values)
+        _TASKS.clear()
+        _TASKS.update(self.tasks)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        sys.path[:] = self.sys_path
+        for name in BuildContext.get_product_modules():
+            del sys.modules[name]
+        sys.modules.update(self.modules)
+
+    # Get modules loaded for the current product/variant: default tasks,
+    # product configuration and any module found in the products directory
+    @staticmethod
+    def get_product_modules():
+        modules = {}
+        for name, module in list(sys.modules.items()):
+            filepath = getattr(module, "__file__", None) or ""
+            if name in ["deftasks", "buildcfg"] or (PRODUCTS_DIR and
+                    filepath.startswith(os.path.join(PRODUCTS_DIR, ""))):
+                modules[name] = module
+        return modules
+
+    # Reset the context so a new product/variant can be loaded: global
+    # variables take back their initial values (from environment), tasks and
+    # product specific modules are removed.
+    # Options and directories where products/packages are keep current values
+    def reset(self):
+        values = dict(_INITIAL_CONTEXT_VALUES)
+        for name in ["OPTIONS", "BUILD_WRAPPERS", "PACKAGES_DIR", "PRODUCTS_DIR"]:
+            values[name] = self.values[name]
+        for name, value in values.items():
+            globals()[name] = list(value) if isinstance(value, list) else value
+        _TASKS.clear()
+        sys.path[:] = [path for path in self.sys_path if not PRODUCTS_DIR
+                or not os.path.join(path, "").startswith(os.path.join(PRODUCTS_DIR, ""))]
+        for name in self.modules:
+            del sys.modules[name]
+
+#===============================================================================
+# Context manager to load another product/variant in the same process.
+# The current context is reset on entry and restored on exit.
+#===============================================================================
+@contextlib.contextmanager
+def switch_context():
+    context = BuildContext.capture()
+    context.reset()
+    try:
+        yield
+    finally:
+        context.restore()
+
+#===============================================================================
+# Changes done in the build context between two captures (global variables,
+# tasks, environment, python path and product modules), to do them again in
+# another process without importing anything. Used by the build daemon to
+# register the tasks of a product/variant it loaded before forking.
+#===============================================================================
+class BuildContextChanges(object):
+    def __init__(self, before, after):
+        self.values = {name: value for name, value in after.values.items()
+                if value != before.values.get(name)}
+        self.tasks = {name: task for name, task in after.tasks.items()
+                if task is not before.tasks.get(name)}
+        self.environ = {name: after.environ.get(name)
+                for name in set(before.environ) | set(after.environ)
+                if after.environ.get(name) != before.environ.get(name)}
+        self.sys_path = [path for path in after.sys_path
+                if path not in before.sys_path]
+        self.modules = {name: module for name, module in after.modules.items()
+                if module is not before.modules.get(name)}
+
+    # Do the changes in the current context
+    def apply(self):
+        for name, value in self.values.items():
+            globals()[name] = list(value) if isinstance(value, list) else value
+        _TASKS.update(self.tasks)
+        for name, value in self.environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        sys.path.extend([path for path in self.sys_path if path not in sys.path])
+        sys.modules.update(self.modules)
+
+#===============================================================================
+# Check if tasks of another product/variant can be executed without restarting
+# the build script.
+#===============================================================================
+def can_switch_context():
+    return (PRODUCT_HANDLER is not None
+            and not BUILD_WRAPPERS
+            and not OPTIONS.reexec
+            and not scheduler.in_worker())
 
 #===============================================================================
 # Get default docker image
 #===============================================================================
 def get_default_docker_image():
-    json_cfg = get_json_config()
-    if json_cfg is None or "docker_image" not in json_cfg:
-        return None
-    return json_cfg["docker_image"]
+    return _get_json_config_section("docker_image", str, None)
 
 #===============================================================================
 # Generate a manifest.xml from repo manifest command
@@ -346,17 +650,116 @@ def get_default_docker_image():
 def gen_manifest_xml(filepath):
     if not os.path.exists(os.path.join(WORKSPACE_DIR, ".repo")):
         return
+    # The file is only replaced if its contents changed (it is in the final
+    # directory, its modification would require to generate images again)
+    tmp_filepath = filepath + ".tmp"
     cmd = ("repo manifest "
             "--revision-as-HEAD "
-            "--suppress-upstream-revision -o %s") % filepath
+            "--suppress-upstream-revision -o %s") % tmp_filepath
     exec_cmd(cmd, extra_env={"GIT_PAGER": "cat"})
+    if not os.path.exists(tmp_filepath):
+        return
+    if os.path.isfile(filepath) and not os.path.islink(filepath) and \
+            filecmp.cmp(tmp_filepath, filepath, shallow=False):
+        os.unlink(tmp_filepath)
+    else:
+        os.replace(tmp_filepath, filepath)
+
+#===============================================================================
+# Get a digest of the final directory: path, permissions, size and
+# modification time of files and path of directories (symlinks are not
+# followed).
+#===============================================================================
+def get_final_dir_digest():
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(FINAL_DIR):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            filepath = os.path.join(dirpath, name)
+            st = os.lstat(filepath)
+            entry = [os.path.relpath(filepath, FINAL_DIR), st.st_mode]
+            if os.path.islink(filepath):
+                entry.append(os.readlink(filepath))
+            elif not os.path.isdir(filepath):
+                entry.extend([st.st_size, st.st_mtime_ns])
+            entries.append(entry)
+    return cache.get_digest(entries)
+
+#===============================================================================
+# Get the fingerprint of the sources of the workspace (see fingerprint.py).
+#===============================================================================
+def get_workspace_fingerprint():
+    return fingerprint.compute(OPTIONS.jobs.job_num)["fingerprint"]
+
+#===============================================================================
+# Check if the sources of the workspace changed since the last successful
+# build of given tasks (list of 'name args' strings) of the current
+# product/variant (recorded with --record-fingerprint).
+#===============================================================================
+def is_workspace_changed(tasks):
+    record = fingerprint.load_record(tasks)
+    return not record or record["fingerprint"] != get_workspace_fingerprint()
+
+#===============================================================================
+# Get the key of images generated by a task: final directory, images
+# configuration, subtasks and what alchemy images depend on.
+#===============================================================================
+def get_images_key(task, args):
+    return cache.get_digest(
+        task.name,
+        args,
+        getattr(task, "subtasks", None),
+        get_images_config(),
+        get_tasks()["alchemy"].get_images_key(),
+        get_final_dir_digest())
 
 #===============================================================================
-# Dump alchemy database in xml and return path to it
+# Check if images are up to date: the key is the one of the last generated
+# images and these images are still in the images directory. Without any
+# expected image (no images configuration), images are never up to date.
 #===============================================================================
-def gen_alchemy_dump_xml():
-    exec_cmd(cmd="./build.sh -p %s-%s -A dump-xml" % (PRODUCT, VARIANT))
-    return os.path.join(OUT_DIR, "alchemy-database.xml")
+def is_images_up_to_date(key):
+    cache_data = cache.load(cache.get_cache_path("images.json"))
+    if not cache_data or cache_data.get("key") != key:
+        return False
+    images = cache_data.get("images", [])
+    return len(images) > 0 and all([os.path.exists(os.path.join(IMAGES_DIR,
+            filename)) for filename in images])
+
+#===============================================================================
+# Save the key of generated images (before they are moved in the images
+# directory by the 'images' post hook).
+#===============================================================================
+def save_images_key(key):
+    images = []
+    images_cfg = get_images_config()
+    if images_cfg:
+        for _ext in images_cfg.get("extensions", []):
+            filename = "%s-%s%s" % (PRODUCT, VARIANT, _ext)
+            if os.path.exists(os.path.join(OUT_DIR, filename)):
+                images.append(filename)
+    cache.save(cache.get_cache_path("images.json"),
+            {"key": key, "images": images})
+
+#===============================================================================
+# Dump alchemy database in xml and return path to it.
+# The dump is not done again if the atom.mk files, the product configuration
+# and alchemy did not change since the previous one (unless force is True).
+#===============================================================================
+def gen_alchemy_dump_xml(force=False):
+    xml_path = os.path.join(OUT_DIR, "alchemy-database.xml")
+    cache_path = cache.get_cache_path("alchemy-database.json")
+    key = get_tasks()["alchemy"].get_database_key()
+    cache_data = cache.load(cache_path)
+    if not force and os.path.exists(xml_path) and cache_data \
+            and cache_data.get("key") == key:
+        logging.info("Alchemy database is up to date: '%s'", xml_path)
+        return xml_path
+
+    do_task("alchemy", ["dump-xml"])
+    if not OPTIONS.dryrun and os.path.exists(xml_path):
+        cache.save(cache_path, {"key": key})
+    return xml_path
 
 #===============================================================================
 # Dump alchemy variable
@@ -366,43 +769,113 @@ def get_alchemy_var(varname):
     return alchemy.get_var(varname)
 
 #===============================================================================
-# Return the path of the product_config.json
+# Dump several alchemy variables at once.
+# Return a dictionary variable -> value (None if unknown).
 #===============================================================================
-def get_json_config_path(warn_if_not_found=False):
-    search_paths = [
+def get_alchemy_vars(varnames):
+    alchemy = get_tasks()["alchemy"]
+    return alchemy.get_vars(varnames)
+
+# Loaded product_config.json by search paths:
+# (state of directories searched, path, state of file, contents)
+_JSON_CONFIGS = {}
+
+#===============================================================================
+# Get the product_config.json entry of current product/variant, loading it
+# only if not already loaded or modified.
+# Searched directories are not probed again as long as their modification
+# times did not change (no file can have appeared in a directory with higher
+# priority) and the file is not parsed again as long as its stat information
+# did not change.
+#===============================================================================
+def _get_json_config_entry():
+    json_name = "product_config.json"
+    search_paths = (
         os.path.join(OUT_DIR),
         os.path.join(PRODUCTS_DIR, PRODUCT, VARIANT, "config"),
         os.path.join(PRODUCTS_DIR, PRODUCT),
-    ]
+    )
 
-    json_name = "product_config.json"
+    entry = _JSON_CONFIGS.get(search_paths)
+    json_path = entry[1] if entry else None
+    dirs_state = []
     for dirpath in search_paths:
-        json_path = os.path.join(dirpath, json_name)
-        if os.path.exists(json_path):
-            return json_path
+        if json_path == os.path.join(dirpath, json_name):
+            break
+        dirs_state.append(cache.get_stat_info(dirpath))
+    # Search again if the file was removed
+    if not entry or entry[0] != dirs_state or \
+            (json_path and not os.path.exists(json_path)):
+        json_path = None
+        dirs_state = []
+        for dirpath in search_paths:
+            if os.path.exists(os.path.join(dirpath, json_name)):
+                json_path = os.path.join(dirpath, json_name)
+                break
+            dirs_state.append(cache.get_stat_info(dirpath))
+
+    file_state = cache.get_stat_info(json_path) if json_path else None
+    if entry and entry[1] == json_path and entry[2] == file_state:
+        json_cfg = entry[3]
+    elif json_path:
+        with open(json_path, "r") as fd:
+            try:
+                json_cfg = json.load(fd)
+            except ValueError as ex:
+                raise TaskError("Error while parsing json file %s : %s" %
+                        (json_path, str(ex)))
+    else:
+        json_cfg = None
+    entry = (dirs_state, json_path, file_state, json_cfg)
+    _JSON_CONFIGS[search_paths] = entry
+    return entry
 
-    if warn_if_not_found:
-        logging.warning("'%s' file not found", json_name)
-    return None
+#===============================================================================
+# Return the path of the product_config.json
+#===============================================================================
+def get_json_config_path(warn_if_not_found=False):
+    json_path = _get_json_config_entry()[1]
+    if not json_path and warn_if_not_found:
+        logging.warning("'%s' file not found", "product_config.json")
+    return json_path
 
 #===============================================================================
 # Return the product_config.json contents if found else None.
+# Contents are a copy of the loaded ones, callers can modify them.
 #===============================================================================
 def get_json_config(warn_if_not_found=False):
-    json_path = get_json_config_path(warn_if_not_found)
-    if not json_path:
-        return None
-    with open(json_path, "r") as fd:
-        try:
-            return json.load(fd)
-        except ValueError as ex:
-            raise TaskError("Error while parsing json file %s : %s" %
-                    (json_path, str(ex)))
+    entry = _get_json_config_entry()
+    if not entry[1] and warn_if_not_found:
+        logging.warning("'%s' file not found", "product_config.json")
+    return copy.deepcopy(entry[3])
+
+#===============================================================================
+# Get a section of the product_config.json, checking its type.
+# Return default if there is no configuration or section.
+#===============================================================================
+def _get_json_config_section(name, section_type, default):
+    json_cfg = get_json_config()
+    if not json_cfg or name not in json_cfg:
+        return default
+    if not isinstance(json_cfg[name], section_type):
+        raise TaskError("Invalid '%s' section in %s: %s expected" %
+                (name, get_json_config_path(), section_type.__name__))
+    return json_cfg[name]
 
 #===============================================================================
-# Add files in release directory. Symlinks will be created to avoid disk waste.
-# Destination is always overwritten (warning is displayed if warn_on_overwrite
-# is True).
+# Get the 'images' section of the product_config.json ({} if none).
+#===============================================================================
+def get_images_config():
+    return _get_json_config_section("images", dict, {})
+
+#===============================================================================
+# Get the 'release' section of the product_config.json ({} if none).
+#===============================================================================
+def get_release_config():
+    return _get_json_config_section("release", dict, {})
+
+#===============================================================================
+# Resolve release contents in a list of (src, dest) entries.
 #
 # contents is a list of element
 # {
@@ -416,8 +889,15 @@ def get_json_config(warn_if_not_found=False):
 # special directory (${STAGING_DIR}...)
 # <dest> is always relative to the release directory.
 # <mandatory> if set to True (default), task will stop if source is missing.
+#
+# entries is the list of already resolved entries, new ones are appended to it.
+# An element whose destination already exists is skipped (warning is displayed
+# if warn_on_exist is True).
 #===============================================================================
-def add_release_contents(contents, warn_on_exist=False):
+def resolve_release_contents(contents, warn_on_exist=False, entries=None):
+    if entries is None:
+        entries = []
+
     # Export some variables in environment to be used expanded in json
     oldenv = os.environ.copy()
     for _envvar in ["PARROT_BUILD_PROP_GROUP",
@@ -447,27 +927,85 @@ def add_release_contents(contents, warn_on_exist=False):
         mandatory = _elem.get("mandatory", True)
         if not os.path.isabs(src):
             src = os.path.join(OUT_DIR, src)
-        dest = os.path.join(RELEASE_DIR, dest)
+        dest = os.path.normpath(dest)
 
-        if os.path.exists(dest):
+        if _release_dest_exists(entries, dest):
             if warn_on_exist:
-                logging.warning("'%s' already exists", dest)
+                logging.warning("'%s' already exists",
+                        os.path.join(RELEASE_DIR, dest))
         elif os.path.exists(src):
-            relative_symlink(src, dest)
+            entries.append((src, dest))
         elif mandatory and not OPTIONS.dryrun:
             raise TaskError("'%s' file is missing" % src)
 
     # Restore environment
     os.environ.clear()
     os.environ.update(oldenv)
+    return entries
+
+#===============================================================================
+# Check if a destination exists in the release given its entries.
+#===============================================================================
+def _release_dest_exists(entries, dest):
+    for entry_src, entry_dest in entries:
+        if dest == entry_dest:
+            return True
+        if dest.startswith(entry_dest + os.sep) and os.path.exists(
+                os.path.join(entry_src, os.path.relpath(dest, entry_dest))):
+            return True
+    return False
+
+#===============================================================================
+# Get entries already present in the release directory (added by hooks with
+# add_release_contents).
+#===============================================================================
+def get_release_dir_entries():
+    if not os.path.isdir(RELEASE_DIR):
+        return []
+    return [(os.path.join(RELEASE_DIR, name), name)
+            for name in sorted(os.listdir(RELEASE_DIR))]
+
+#===============================================================================
+# Add files in release directory. Symlinks will be created to avoid disk waste
+# (in a single batch, without forking).
+# With the release store (--release-store), files are hard links to the store
+# instead so the release directory is not modified by later builds.
+# See resolve_release_contents for the format of contents.
+#===============================================================================
+def add_release_contents(contents, warn_on_exist=False):
+    entries = resolve_release_contents(contents, warn_on_exist,
+            get_release_dir_entries())
+    link_release_entries(entries, use_store=store.is_enabled())
+
+#===============================================================================
+# Create entries (from resolve_release_contents) in the release directory,
+# either as symlinks or as hard links to the release store.
+#===============================================================================
+def link_release_entries(entries, use_store=False):
+    with FsBatch() as batch:
+        for src, dest in entries:
+            if src.startswith(os.path.join(RELEASE_DIR, "")):
+                continue
+            if not use_store:
+                relative_symlink(src, os.path.join(RELEASE_DIR, dest), batch)
+            elif OPTIONS.dryrun:
+                logging.info("Dry run: store '%s' in '%s'", src,
+                        os.path.join(RELEASE_DIR, dest))
+            else:
+                store.link_tree(src, os.path.join(RELEASE_DIR, dest))
 
 #===============================================================================
 # Generate an archive for a version to be released.
+# Contents are directly streamed in the archive (following symlinks) with their
+# checksums, without creating links in the release directory (it only contains
+# entries added by hooks with add_release_contents).
+# With the release store (--release-store), the release directory is filled
+# with hard links to stored files. The archive itself is not stored: it
+# differs for each release (member times) so it could not be shared.
 #===============================================================================
 def gen_release_archive():
     tmp_release_file = "%s.tar" % RELEASE_DIR
     release_file = os.path.join(WORKSPACE_DIR, "%s.tar" % PARROT_BUILD_PROP_UID)
-
     # Create base list of files for release
     contents = [
         {
@@ -531,28 +1069,44 @@ def gen_release_archive():
             "mandatory": False
         },
     ]
-    add_release_contents(contents)
+    # Entries added by hooks in release directory take precedence
+    entries = resolve_release_contents(contents, entries=get_release_dir_entries())
 
     # Is there a 'product_config.json' ?
     json_path = get_json_config_path()
-    json_cfg = get_json_config()
-    if json_cfg:
-        add_release_contents([{"src": json_path, "dest": "product_config.json"}])
-        if "release" in json_cfg and "additional_files" in json_cfg["release"]:
-            add_release_contents(json_cfg["release"]["additional_files"],
-                    json_cfg["release"].get("warn_on_exist", False))
+    release_cfg = get_release_config()
+    if json_path and get_json_config():
+        resolve_release_contents([{"src": json_path, "dest": "product_config.json"}],
+                entries=entries)
+        if "additional_files" in release_cfg:
+            resolve_release_contents(release_cfg["additional_files"],
+                    release_cfg.get("warn_on_exist", False), entries)
+
+    # md5sum.txt is always generated, other checksums files can be requested
+    # in 'checksums' of the release configuration
+    algorithms = ["md5"]
+    for algo in release_cfg.get("checksums", []):
+        if algo not in checksum.CHECKSUM_FILES:
+            raise TaskError("Unsupported checksum algorithm: '%s'" % algo)
+        if algo not in algorithms:
+            algorithms.append(algo)
 
     # Disable police while generating the archive
     os.environ["POLICE_HOOK_DISABLED"] = "1"
 
-    # Generate md5sum file
-    exec_cmd("find . -follow -name '.git*' -prune -or -path './md5sum.txt' -prune -or -type f -print0 | xargs -0 md5sum > md5sum.txt",
-            cwd=RELEASE_DIR)
+    # Keep contents of the release in the store
+    if store.is_enabled() and not OPTIONS.dryrun:
+        link_release_entries(entries, use_store=True)
+        entries = get_release_dir_entries()
 
-    # Archive the release (follow symlinks)
-    # Add --force-local to tar command on windows to avoid interpretation of ':'
-    tar_cmd = "tar --force-local" if sys.platform == "win32" else "tar"
-    exec_cmd("%s --exclude=.git -C %s -hcf %s ." % (tar_cmd, RELEASE_DIR, tmp_release_file))
+    # Archive the release with checksums files as last members
+    if OPTIONS.dryrun:
+        logging.info("Dry run: archive %d entries in '%s'",
+                len(entries), tmp_release_file)
+    else:
+        logging.info("Archive %d entries in '%s'", len(entries), tmp_release_file)
+        archive.write_release_archive(tmp_release_file, entries, algorithms,
+                cache_path=cache.get_cache_path("checksums.json"))
 
     # Do not create link at root of workspace if output dir is somewhere else
     # (jenkins for example)
@@ -583,7 +1137,7 @@ def debian_install(base_url, pkg_name, pkg_version,
 
     # Remove existing extract directory if in 'force' mode
     if force and os.path.exists(extract_dir):
-        exec_cmd("rm -rf %s" % extract_dir)
+        remove_path(extract_dir)
 
     # Construct package file name
     pkg_deb_filename = "%s_%s_%s.deb" % (pkg_name, pkg_version, pkg_arch)
@@ -599,5 +1153,24 @@ def debian_install(base_url, pkg_name, pkg_version,
             exec_cmd("dpkg -x %s %s" % (pkg_deb_path, extract_dir))
         finally:
             # Cleanup downloaded file (keep extracted dir though)
-            exec_cmd("rm -f %s" % pkg_deb_path)
+            remove_path(pkg_deb_path)
     return extract_dir
+
+# Initial values of context variables (from environment)
+_INITIAL_CONTEXT_VALUES = BuildContext.capture().values
+
+#===============================================================================
+# Reset the build context for a command executed by the build daemon: global
+# variables take back their initial values, from the environment of the
+# command, tasks are removed. Caches (product_config.json files...) are kept.
+#===============================================================================
+def reset_context():
+    global PRODUCT_HANDLER, PLAN_HANDLER, _INITIAL_CONTEXT_VALUES
+    for name, value in _INITIAL_CONTEXT_VALUES.items():
+        globals()[name] = list(value) if isinstance(value, list) else value
+    _init_environ_globals()
+    _INITIAL_CONTEXT_VALUES = BuildContext.capture().values
+    _TASKS.clear()
+    FAILED_TASKS[:] = []
+    PRODUCT_HANDLER = None
+    PLAN_HANDLER = None
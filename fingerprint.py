@@ -0,0 +1,343 @@
+
+import os
+import glob
+import stat
+import logging
+import hashlib
+import struct
+import concurrent.futures
+
+import cache
+import dragon
+
+# Name of files recording the fingerprint of the last successful build of a
+# list of tasks (in the output directory of the product/variant), formatted
+# with the digest of the tasks
+RECORD_FILENAME = "workspace-fingerprint-%s.json"
+
+# Tasks that do not build anything, their execution is not recorded
+NOT_RECORDED_TASKS = ["clean", "workspace-fingerprint"]
+
+# Minimum number of threads (the computation mostly waits for stat calls so it
+# is useful to have more threads than cpus)
+MIN_JOBS = 8
+
+# Flags of index entries
+_FLAG_EXTENDED = 0x4000
+_EXTFLAG_SKIP_WORKTREE = 0x4000
+_EXTFLAG_INTENT_TO_ADD = 0x2000
+
+#===============================================================================
+# Fingerprint of the sources of a workspace.
+#
+# Sources are the repo projects of the workspace (.repo/project.list) and the
+# git repositories of the packages directory, of the product configuration
+# directory and of alchemy (for workspaces not managed by repo or directories
+# outside the workspace).
+#
+# The state of a project is the commit of its HEAD and the files of its index
+# modified in the working tree. Like git, a file is only read when its stat
+# information differs from the one in the index (or when it was modified too
+# close to the write of the index to trust it), the state then has the id of
+# the blob it would have. Untracked files are not taken into account.
+#
+# Files of a directory outside any git repository are taken into account with
+# their stat information.
+#===============================================================================
+
+#===============================================================================
+# Get a path relative to the workspace if possible (so the fingerprint does
+# not depend on the location of the workspace).
+#===============================================================================
+def _get_name(path):
+    relpath = os.path.relpath(path, dragon.WORKSPACE_DIR)
+    return path if relpath.startswith("..") else relpath
+
+#===============================================================================
+# Find the top directory of the git repository containing a directory, None if
+# the directory is not in a git repository.
+#===============================================================================
+def find_project_dir(dirpath):
+    dirpath = os.path.abspath(dirpath)
+    while True:
+        if cache.get_git_dir(dirpath):
+            return dirpath
+        parent = os.path.dirname(dirpath)
+        if parent == dirpath:
+            return None
+        dirpath = parent
+
+#===============================================================================
+# Get projects of a directory: the git repository containing it or the git
+# repositories it contains. Files outside these repositories are added in
+# files (path -> stat information).
+#===============================================================================
+def _scan_dir(root_dir, project_dirs, files):
+    project_dir = find_project_dir(root_dir)
+    if project_dir:
+        project_dirs.append(project_dir)
+        return
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames.sort()
+        for dirname in list(dirnames):
+            if cache.get_git_dir(os.path.join(dirpath, dirname)):
+                project_dirs.append(os.path.join(dirpath, dirname))
+                dirnames.remove(dirname)
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            files[_get_name(filepath)] = cache.get_stat_info(filepath,
+                    follow_symlinks=False)
+
+#===============================================================================
+# Get the directories of projects and files (path -> stat information) that
+# are the sources of the workspace.
+#===============================================================================
+def get_sources():
+    project_dirs = []
+    files = {}
+    repo_dir = os.path.join(dragon.WORKSPACE_DIR, ".repo")
+    try:
+        with open(os.path.join(repo_dir, "project.list"), "r") as fd:
+            for line in fd:
+                if line.strip():
+                    project_dirs.append(os.path.join(dragon.WORKSPACE_DIR,
+                            line.strip()))
+    except OSError:
+        repo_dir = None
+
+    # Directories of the workspace are already covered by repo projects
+    for dirpath in [dragon.PACKAGES_DIR, dragon.PRODUCT_DIR, dragon.ALCHEMY_HOME]:
+        if not dirpath or not os.path.isdir(dirpath):
+            continue
+        dirpath = os.path.abspath(dirpath)
+        if repo_dir and dirpath.startswith(os.path.join(dragon.WORKSPACE_DIR, "")):
+            continue
+        _scan_dir(dirpath, project_dirs, files)
+
+    # Remove duplicates (keeping the order)
+    result = []
+    for project_dir in project_dirs:
+        if project_dir not in result:
+            result.append(project_dir)
+    return result, files
+
+#===============================================================================
+# Read a variable length integer of an index (version 4).
+# Return the integer and the offset after it.
+#===============================================================================
+def _read_varint(data, offset):
+    byte = data[offset]
+    offset += 1
+    value = byte & 0x7f
+    while byte & 0x80:
+        byte = data[offset]
+        offset += 1
+        value = ((value + 1) << 7) | (byte & 0x7f)
+    return value, offset
+
+#===============================================================================
+# Read entries of a git index (versions 2 to 4).
+# Return a list of (path, mtime_ns, ctime_ns, ino, mode, size, id, flags,
+# extflags) where path is bytes and id is the hex id of the blob. Times,
+# inode and size are truncated to 32 bits in the index.
+#===============================================================================
+def read_index(index_path):
+    with open(index_path, "rb") as fd:
+        data = fd.read()
+    signature, index_version, count = struct.unpack_from("!4sII", data)
+    if signature != b"DIRC" or index_version not in (2, 3, 4):
+        raise ValueError("Unsupported index '%s'" % index_path)
+    entries = []
+    offset = 12
+    path = b""
+    for _ in range(count):
+        start = offset
+        (ctime_s, ctime_ns, mtime_s, mtime_ns, _, ino, mode, _, _, size,
+                blob_id, flags) = struct.unpack_from("!10I20sH", data, offset)
+        offset += 62
+        extflags = 0
+        if index_version >= 3 and flags & _FLAG_EXTENDED:
+            extflags = struct.unpack_from("!H", data, offset)[0]
+            offset += 2
+        if index_version < 4:
+            end = data.index(b"\0", offset)
+            path = data[offset:end]
+            # Entries are padded with 1 to 8 nul bytes
+            offset = start + ((end - start + 8) & ~7)
+        else:
+            # Paths are prefix compressed, without padding
+            strip, offset = _read_varint(data, offset)
+            end = data.index(b"\0", offset)
+            path = path[:len(path) - strip] + data[offset:end]
+            offset = end + 1
+        entries.append((path,
+                mtime_s * 1000000000 + mtime_ns,
+                ctime_s * 1000000000 + ctime_ns,
+                ino, mode, size, blob_id.hex(), flags, extflags))
+    return entries
+
+#===============================================================================
+# Get the id of the git blob of a file (or symlink).
+#===============================================================================
+def get_blob_id(filepath, st):
+    if stat.S_ISLNK(st.st_mode):
+        data = os.fsencode(os.readlink(filepath))
+    else:
+        with open(filepath, "rb") as fd:
+            data = fd.read()
+    sha1 = hashlib.sha1(b"blob %d\0" % len(data))
+    sha1.update(data)
+    return sha1.hexdigest()
+
+#===============================================================================
+# Get the mode git would give to a file.
+#===============================================================================
+def _get_git_mode(st):
+    if stat.S_ISLNK(st.st_mode):
+        return 0o120000
+    return 0o100755 if st.st_mode & 0o100 else 0o100644
+
+#===============================================================================
+# Get files of the index of a project that are modified in the working tree.
+# Return a list of [path, blob id, mode] (blob id and mode are None for
+# deleted files).
+#===============================================================================
+def get_changes(project_dir, git_dir):
+    index_path = os.path.join(git_dir, "index")
+    index_st = os.stat(index_path)
+    changes = []
+    for (path, mtime_ns, ctime_ns, ino, mode, size, blob_id, flags,
+            extflags) in read_index(index_path):
+        # Submodules are not checked, skip worktree files are not there
+        if mode == 0o160000 or extflags & _EXTFLAG_SKIP_WORKTREE:
+            continue
+        relpath = os.fsdecode(path)
+        filepath = os.path.join(project_dir, relpath)
+        try:
+            st = os.lstat(filepath)
+        except OSError:
+            changes.append([relpath, None, None])
+            continue
+        if not stat.S_ISREG(st.st_mode) and not stat.S_ISLNK(st.st_mode):
+            changes.append([relpath, None, None])
+            continue
+        # Times are only compared to the second if the index does not have
+        # nanoseconds (git built without USE_NSEC)
+        st_mtime_ns, st_ctime_ns = st.st_mtime_ns, st.st_ctime_ns
+        if mtime_ns % 1000000000 == 0 and ctime_ns % 1000000000 == 0:
+            st_mtime_ns -= st_mtime_ns % 1000000000
+            st_ctime_ns -= st_ctime_ns % 1000000000
+        git_mode = _get_git_mode(st)
+        # Conflicts and intent to add entries are always checked, as well
+        # as racy entries (modified after the index was written)
+        if (flags >> 12) & 3 == 0 \
+                and not extflags & _EXTFLAG_INTENT_TO_ADD \
+                and mtime_ns < index_st.st_mtime_ns \
+                and st_mtime_ns == mtime_ns \
+                and st_ctime_ns == ctime_ns \
+                and (st.st_ino & 0xffffffff) == ino \
+                and (st.st_size & 0xffffffff) == size \
+                and git_mode == mode:
+            continue
+        file_blob_id = get_blob_id(filepath, st)
+        if file_blob_id != blob_id or git_mode != mode or (flags >> 12) & 3:
+            changes.append([relpath, file_blob_id, git_mode])
+    return changes
+
+#===============================================================================
+# Get the state of a project: commit of HEAD and modified files.
+# If the index can not be read, its stat information is used instead of the
+# modified files.
+#===============================================================================
+def get_project_state(project_dir):
+    git_dir = cache.get_git_dir(project_dir)
+    if not git_dir:
+        return None
+    state = {"head": cache.get_git_head(project_dir)}
+    try:
+        state["changes"] = get_changes(project_dir, git_dir)
+    except (OSError, ValueError, struct.error) as ex:
+        logging.warning("Unable to read index of '%s': %s", project_dir, str(ex))
+        state["index"] = cache.get_stat_info(os.path.join(git_dir, "index"))
+    return state
+
+#===============================================================================
+# Compute the fingerprint of the workspace, states of projects being computed
+# concurrently (with at least MIN_JOBS threads).
+# Return a dictionary with the fingerprint, the state of each project and the
+# files outside projects.
+#===============================================================================
+def compute(jobs=1):
+    project_dirs, files = get_sources()
+    projects = {}
+    with concurrent.futures.ThreadPoolExecutor(max(MIN_JOBS, jobs)) as executor:
+        for project_dir, state in zip(project_dirs,
+                executor.map(get_project_state, project_dirs)):
+            projects[_get_name(project_dir)] = state
+    return {
+        "fingerprint": cache.get_digest(projects, files),
+        "projects": projects,
+        "files": files,
+    }
+
+#===============================================================================
+# Get names of projects (or files) whose state differs between two results of
+# compute().
+#===============================================================================
+def get_differences(info1, info2):
+    names = []
+    for key in ["projects", "files"]:
+        items1, items2 = info1.get(key, {}), info2.get(key, {})
+        for name in sorted(set(items1) | set(items2)):
+            if items1.get(name) != items2.get(name):
+                names.append(name)
+    return names
+
+#===============================================================================
+# Get the tasks of a build as a list of 'name args' strings (what '--check'
+# of the 'workspace-fingerprint' task takes).
+# tasks: list of {"name", "args"}
+#===============================================================================
+def get_task_names(tasks):
+    return [" ".join([task["name"]] + task["args"]) for task in tasks]
+
+#===============================================================================
+# Get path of the file recording the fingerprint of the last successful build
+# of given tasks (list of 'name args' strings) of the current product/variant.
+#===============================================================================
+def get_record_path(tasks):
+    return os.path.join(dragon.OUT_DIR,
+            RECORD_FILENAME % cache.get_digest(tasks)[:16])
+
+#===============================================================================
+# Get paths of all files recording fingerprints of the current product/variant.
+#===============================================================================
+def get_record_paths():
+    return glob.glob(os.path.join(dragon.OUT_DIR, RECORD_FILENAME % "*"))
+
+#===============================================================================
+# Load the fingerprint of the last successful build of given tasks (as
+# returned by compute() with the build id and tasks), None if not found.
+#===============================================================================
+def load_record(tasks):
+    return cache.load(get_record_path(tasks))
+
+#===============================================================================
+# Compute the fingerprint of the workspace before a build of given tasks (list
+# of {"name", "args"}): sources modified during the build shall not be
+# recorded as built. Return None if the tasks are not recorded.
+#===============================================================================
+def prepare_record(tasks, jobs=1):
+    if all([task["name"] in NOT_RECORDED_TASKS for task in tasks]):
+        return None
+    info = compute(jobs)
+    info["build_id"] = dragon.PARROT_BUILD_PROP_UID
+    info["tasks"] = get_task_names(tasks)
+    return info
+
+#===============================================================================
+# Record the fingerprint computed by prepare_record() after a successful build.
+#===============================================================================
+def record(info):
+    cache.save(get_record_path(info["tasks"]), info)
+    logging.debug("Workspace fingerprint: %s", info["fingerprint"])
@@ -1,10 +1,22 @@
 
 import os
 import logging
+import collections
+import hashlib
+import shutil
 
+import cache
 import dragon
 import utils
 
+# Size of the parts of the spy log checked to detect it was only appended
+_CHECK_SIZE = 4096
+
+# Environment variable giving the offset in the spy log where the current
+# session starts (the build script that set up the spy started there, no
+# spied process was running)
+_SESSION_ENV = "DRAGON_POLICE_SPY_SESSION"
+
 #===============================================================================
 # Setup police environment variables for spy.
 # This shall be kept in sync with what is done in police-spy.sh
@@ -35,6 +47,158 @@ def setup_spy():
     if not os.path.exists(dragon.POLICE_SPY_LOG):
         fd = open(dragon.POLICE_SPY_LOG, "w")
         fd.close()
+    os.environ[_SESSION_ENV] = str(_get_lines_end(dragon.POLICE_SPY_LOG))
+
+#===============================================================================
+# Process a spy log with police-process.py
+#===============================================================================
+def _exec_process(infile, outfile):
+    utils.exec_cmd("%s --infile %s --outfile %s %s" % (
+            os.path.join(dragon.POLICE_HOME, "police-process.py"),
+            infile,
+            outfile,
+            "-vv" if dragon.OPTIONS.verbose else ""))
+
+#===============================================================================
+# Get digests of the start of the spy log and of the part just before offset,
+# to check later that the log was only appended since.
+#===============================================================================
+def _get_spy_log_marks(filepath, offset):
+    with open(filepath, "rb") as fd:
+        head = fd.read(min(offset, _CHECK_SIZE))
+        fd.seek(max(0, offset - _CHECK_SIZE))
+        tail = fd.read(offset - max(0, offset - _CHECK_SIZE))
+    return [hashlib.sha1(head).hexdigest(), hashlib.sha1(tail).hexdigest()]
+
+#===============================================================================
+# Remove a file if it exists.
+#===============================================================================
+def _remove_file(filepath):
+    if os.path.exists(filepath):
+        os.unlink(filepath)
+
+#===============================================================================
+# Get the offset after the last complete line of the spy log.
+#===============================================================================
+def _get_lines_end(filepath):
+    with open(filepath, "rb") as fd:
+        end = fd.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - _CHECK_SIZE)
+            fd.seek(start)
+            data = fd.read(end - start)
+            if b"\n" in data:
+                return start + data.rindex(b"\n") + 1
+            end = start
+    return 0
+
+#===============================================================================
+# Get the offset where the current session starts in the spy log, None if not
+# known (spy set up by someone else, or for another log).
+#===============================================================================
+def _get_session_offset():
+    if os.environ.get("POLICE_HOOK_LOG") != dragon.POLICE_SPY_LOG:
+        return None
+    try:
+        return int(os.environ[_SESSION_ENV])
+    except (KeyError, ValueError):
+        return None
+
+#===============================================================================
+# Process the part of the spy log from start to end (None for the end of the
+# log) and append the result to outfilepath.
+#===============================================================================
+def _process_spy_log_part(start, end, outfilepath):
+    spy_part_path = dragon.POLICE_SPY_LOG + ".part"
+    process_part_path = dragon.POLICE_PROCESS_LOG + ".part"
+    with open(dragon.POLICE_SPY_LOG, "rb") as fin, \
+            open(spy_part_path, "wb") as fout:
+        fin.seek(start)
+        size = None if end is None else end - start
+        while size is None or size > 0:
+            data = fin.read(1024 * 1024 if size is None
+                    else min(size, 1024 * 1024))
+            if not data:
+                break
+            fout.write(data)
+            if size is not None:
+                size -= len(data)
+    try:
+        _exec_process(spy_part_path, process_part_path)
+        with open(process_part_path, "rb") as fin, \
+                open(outfilepath, "ab") as fout:
+            shutil.copyfileobj(fin, fout)
+    finally:
+        _remove_file(spy_part_path)
+        _remove_file(process_part_path)
+
+#===============================================================================
+# Process the spy log in police process log.
+#
+# The spy log is kept between builds, each build script setting up the spy
+# starts a session at the end of the log (when no spied process is running).
+# As spied processes never span two sessions, the output of police-process is
+# the concatenation of the outputs of the sessions (processed separately).
+#
+# The output of previous sessions is kept in a base file, with a checkpoint
+# recording the part of the spy log it covers (always a session start). If the
+# log was only appended since, sessions after the checkpoint are processed and
+# appended to the base file, and only the current session is processed again
+# for the process log. Otherwise (log truncated or re-created, police or base
+# file changed, --police-full) the base file is created again, or the whole
+# log is processed if the current session is not known.
+#===============================================================================
+def process_spy_log():
+    checkpoint_path = os.path.join(dragon.POLICE_OUT_DIR, "police-process.checkpoint")
+    base_path = os.path.join(dragon.POLICE_OUT_DIR, "police-process.base")
+    if dragon.OPTIONS.dryrun:
+        _exec_process(dragon.POLICE_SPY_LOG, dragon.POLICE_PROCESS_LOG)
+        return
+
+    st = os.stat(dragon.POLICE_SPY_LOG)
+    session = _get_session_offset()
+    police_state = cache.get_stat_info(
+            os.path.join(dragon.POLICE_HOME, "police-process.py"))
+    checkpoint = cache.load(checkpoint_path) or {}
+    offset = checkpoint.get("offset", 0)
+    incremental = (not dragon.OPTIONS.police_full
+            and checkpoint.get("inode") == [st.st_dev, st.st_ino]
+            and offset <= (st.st_size if session is None else session)
+            and checkpoint.get("police") == police_state
+            and checkpoint.get("base") == cache.get_stat_info(base_path)
+            and checkpoint.get("marks") ==
+                    _get_spy_log_marks(dragon.POLICE_SPY_LOG, offset))
+
+    if not incremental:
+        _remove_file(checkpoint_path)
+        _remove_file(base_path)
+        if session is None:
+            _exec_process(dragon.POLICE_SPY_LOG, dragon.POLICE_PROCESS_LOG)
+            return
+        offset = 0
+        open(base_path, "wb").close()
+
+    # Add previous sessions not processed yet in the base file (the checkpoint
+    # is removed until it is updated)
+    if session is not None and offset < session:
+        _remove_file(checkpoint_path)
+        logging.info("Police: process %d bytes of previous builds in spy log",
+                session - offset)
+        _process_spy_log_part(offset, session, base_path)
+        offset = session
+        cache.save(checkpoint_path, {
+            "inode": [st.st_dev, st.st_ino],
+            "offset": offset,
+            "marks": _get_spy_log_marks(dragon.POLICE_SPY_LOG, offset),
+            "police": police_state,
+            "base": cache.get_stat_info(base_path),
+        })
+
+    # Process the current session after the base file
+    logging.info("Police: process %d bytes of current build in spy log",
+            st.st_size - offset)
+    shutil.copyfile(base_path, dragon.POLICE_PROCESS_LOG)
+    _process_spy_log_part(offset, None, dragon.POLICE_PROCESS_LOG)
 
 #===============================================================================
 # Generate police report in the final directory.
@@ -49,11 +213,7 @@ def setup_spy():
 def gen_report(addhtml=True, addtxt=False, compress=False):
     # Process step
     logging.info("Police: process")
-    utils.exec_cmd("%s --infile %s --outfile %s %s" % (
-            os.path.join(dragon.POLICE_HOME, "police-process.py"),
-            dragon.POLICE_SPY_LOG,
-            dragon.POLICE_PROCESS_LOG,
-            "-vv" if dragon.OPTIONS.verbose else ""))
+    process_spy_log()
 
     # Report step
     logging.info("Police: report")
@@ -70,36 +230,91 @@ def gen_report(addhtml=True, addtxt=False, compress=False):
 
     # Remove existing police files
     police_final_dir = os.path.join(dragon.FINAL_DIR, dragon.DEPLOY_DIR, "share", "police")
-    utils.exec_cmd("rm -rf %s" % police_final_dir)
+    utils.remove_path(police_final_dir)
     utils.makedirs(police_final_dir)
 
     # Add files
     if addhtml:
-        utils.exec_cmd("cp -af %s %s" % (
+        utils.copy_path(
                 os.path.join(dragon.POLICE_OUT_DIR, "police-notice.html"),
-                police_final_dir))
+                police_final_dir)
         if compress:
             utils.exec_cmd("gzip %s" %
                     os.path.join(police_final_dir, "police-notice.html"))
     if addtxt:
-        utils.exec_cmd("cp -af %s %s" % (
+        utils.copy_path(
                 os.path.join(dragon.POLICE_OUT_DIR, "police-notice.txt"),
-                police_final_dir))
+                police_final_dir)
         if compress:
             utils.exec_cmd("gzip %s" %
                     os.path.join(police_final_dir, "police-notice.txt"))
 
 #===============================================================================
+# Index of police results (police-package-license-module.txt), each line
+# giving a module, the package it belongs to (with an optional '#' suffix)
+# and its license.
 #===============================================================================
-def get_packages():
-    # Get list of packages to generate
+class PoliceIndex(object):
+    def __init__(self, filepath):
+        self.filepath = filepath
+        # package -> license -> list of modules (in order of the file)
+        self.packages = collections.OrderedDict()
+        self.module_packages = {}
+        self.license_modules = {}
+        with open(filepath) as fin:
+            for line in fin:
+                fields = line.rstrip("\n").split(" ", 2)
+                if len(fields) < 2:
+                    continue
+                module, package = fields[0], fields[1].split("#")[0]
+                license = fields[2] if len(fields) > 2 else ""
+                licenses = self.packages.setdefault(package,
+                        collections.OrderedDict())
+                licenses.setdefault(license, []).append(module)
+                self.module_packages.setdefault(module, []).append(package)
+                self.license_modules.setdefault(license, []).append(module)
+
+    # Get the list of packages
+    def get_packages(self):
+        return list(self.packages.keys())
+
+    # Get the licenses of a package
+    def get_licenses(self, package):
+        return list(self.packages.get(package, {}).keys())
+
+    # Get the modules of a package (optionally only under given license)
+    def get_package_modules(self, package, license=None):
+        licenses = self.packages.get(package, {})
+        if license is not None:
+            return list(licenses.get(license, []))
+        return [module for modules in licenses.values() for module in modules]
+
+    # Get the packages of a module
+    def get_module_packages(self, module):
+        return list(self.module_packages.get(module, []))
+
+    # Get the modules under a license
+    def get_license_modules(self, license):
+        return list(self.license_modules.get(license, []))
+
+# Loaded police index and stat information of its file
+_INDEX = (None, None)
+
+#===============================================================================
+# Get the index of police results, parsed again only if the file changed.
+#===============================================================================
+def get_index():
+    global _INDEX
     filepath = os.path.join(dragon.POLICE_OUT_DIR, "police-package-license-module.txt")
-    packages = []
-    with open(filepath) as fin:
-        for line in fin:
-            package = line.split(" ")[1].rstrip("\n")
-            if "#" in package:
-                package = package.split("#")[0]
-            if package not in packages:
-                packages.append(package)
-    return " ".join(packages)
+    stat_info = cache.get_stat_info(filepath)
+    index, index_stat_info = _INDEX
+    if index is None or index.filepath != filepath or index_stat_info != stat_info:
+        index = PoliceIndex(filepath)
+        _INDEX = (index, stat_info)
+    return index
+
+#===============================================================================
+# Get list of packages to generate (separated by spaces).
+#===============================================================================
+def get_packages():
+    return " ".join(get_index().get_packages())
@@ -0,0 +1,165 @@
+
+import logging
+import threading
+import contextlib
+import concurrent.futures
+
+import utils
+
+# Thread local storage, used to know if we are running inside a worker thread
+_LOCAL = threading.local()
+
+# Number of workers currently running or about to (all scheduler runs)
+_RUNNING_WORKERS = 0
+_RUNNING_LOCK = threading.Lock()
+
+#===============================================================================
+# Return True if current thread is a scheduler worker.
+# Shared objects (like registered tasks) shall not be modified by workers.
+#===============================================================================
+def in_worker():
+    return getattr(_LOCAL, "worker", False)
+
+#===============================================================================
+# Sort keys so that a key always comes after its dependencies, keeping the
+# given order as much as possible.
+# keys: ordered list of unique keys.
+# depends: dictionary key -> list of keys it depends on. Unknown keys are
+# ignored (they can be optional entries that have been disabled).
+#===============================================================================
+def sort_keys(keys, depends):
+    deps = get_deps(keys, depends)
+    result = []
+    done = set()
+    visiting = set()
+    def visit(key):
+        if key in done:
+            return
+        if key in visiting:
+            raise utils.ExecError("Dependency cycle detected on '%s'" % key)
+        visiting.add(key)
+        for dep in [k for k in keys if k in deps[key]]:
+            visit(dep)
+        visiting.remove(key)
+        done.add(key)
+        result.append(key)
+    for key in keys:
+        visit(key)
+    return result
+
+#===============================================================================
+# Get the dependencies of each key, restricted to the given keys.
+#===============================================================================
+def get_deps(keys, depends):
+    if len(set(keys)) != len(keys):
+        raise utils.ExecError("Duplicate entries in %s" % " ".join(keys))
+    deps = {}
+    for key in keys:
+        deps[key] = set([dep for dep in (depends or {}).get(key, [])
+                if dep in keys and dep != key])
+    return deps
+
+#===============================================================================
+# Execute fct(key) for each key, respecting dependencies.
+#
+# If depends is empty (or None) or max_workers is 1, keys are executed one after
+# the other in the given order (dependencies order when given).
+# Otherwise independent keys are executed concurrently in at most max_workers
+# threads. Once an entry failed, no new one is started and the error is raised
+# once running ones are finished.
+#===============================================================================
+def run(keys, depends, fct, max_workers=1):
+    if not depends or max_workers <= 1 or len(keys) <= 1:
+        for key in sort_keys(keys, depends) if depends else keys:
+            fct(key)
+        return
+
+    # Check dependencies (cycles...) before starting anything
+    sort_keys(keys, depends)
+    deps = get_deps(keys, depends)
+
+    pending = list(keys)
+    running = {}
+    done = set()
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers,
+            thread_name_prefix="scheduler") as executor:
+        while pending or running:
+            # Start all ready entries (unless an error occured)
+            while not errors and pending and len(running) < max_workers:
+                ready = [key for key in pending if deps[key] <= done]
+                if not ready:
+                    break
+                key = ready[0]
+                pending.remove(key)
+                _add_running_workers(1)
+                running[executor.submit(_run_worker, fct, key)] = key
+                logging.debug("Scheduling '%s' (%d running)", key, len(running))
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(running,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                key = running.pop(future)
+                try:
+                    future.result()
+                    done.add(key)
+                except BaseException as ex:
+                    errors.append(ex)
+
+    if errors:
+        raise errors[0]
+
+#===============================================================================
+# Execute fct(key) in a worker thread.
+#===============================================================================
+def _run_worker(fct, key):
+    _LOCAL.worker = True
+    try:
+        fct(key)
+    finally:
+        _add_running_workers(-1)
+
+#===============================================================================
+# Update the number of running workers (counted when they are submitted).
+#===============================================================================
+def _add_running_workers(count):
+    global _RUNNING_WORKERS
+    with _RUNNING_LOCK:
+        _RUNNING_WORKERS += count
+
+#===============================================================================
+# Pool of jobs shared by commands executed concurrently by workers (alchemy
+# invocations...) so that they do not use more jobs than given in total.
+# A command takes the jobs not used by other commands, divided by the number
+# of running workers not holding jobs yet (all of them outside workers). It
+# waits for at least one job to be available.
+#===============================================================================
+class JobPool(object):
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.used = 0
+        self.holders = 0
+
+    # Take jobs from the pool for a command (context manager giving the
+    # number of jobs to use)
+    @contextlib.contextmanager
+    def take(self, total):
+        with self.cond:
+            while self.used >= total:
+                self.cond.wait()
+            with _RUNNING_LOCK:
+                sharers = _RUNNING_WORKERS - self.holders
+            jobs = max(1, (total - self.used) // max(1, sharers))
+            self.used += jobs
+            self.holders += 1
+        try:
+            yield jobs
+        finally:
+            with self.cond:
+                self.used -= jobs
+                self.holders -= 1
+                self.cond.notify_all()
+
+# Pool of jobs of the build
+JOBS = JobPool()
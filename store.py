@@ -0,0 +1,136 @@
+
+import os
+import logging
+import shutil
+
+import cache
+import checksum
+import dragon
+import utils
+
+#===============================================================================
+# Content addressed store of release artifacts.
+#
+# Files are stored once in OUT_ROOT_DIR/store/objects, named by their sha256
+# and permissions, and referenced by hard links from release directories.
+# References shall not be modified in place as it would modify all of them
+# (files are always replaced).
+#===============================================================================
+
+#===============================================================================
+# Check if the store shall be used (--release-store option).
+#===============================================================================
+def is_enabled():
+    return bool(getattr(dragon.OPTIONS, "release_store", False))
+
+#===============================================================================
+# Get the directory of the store.
+#===============================================================================
+def get_store_dir():
+    return os.path.join(dragon.OUT_ROOT_DIR, "store")
+
+#===============================================================================
+# Get path of a stored file from its sha256 and permissions.
+#===============================================================================
+def get_blob_path(digest, mode):
+    return os.path.join(get_store_dir(), "objects", digest[:2],
+            "%s-%03o" % (digest[2:], mode & 0o777))
+
+#===============================================================================
+# Get the sha256 of given files (cached by file identity).
+#===============================================================================
+def _get_digests(filepaths):
+    results = checksum.compute_files(filepaths, ["sha256"],
+            jobs=dragon.OPTIONS.jobs.job_num,
+            cache_path=cache.get_cache_path("store-checksums.json"))
+    return {filepath: results[filepath]["sha256"] for filepath in filepaths}
+
+#===============================================================================
+# Replace dest by a hard link to src (atomically).
+# Fallback to a copy if a hard link is not possible (other file system).
+#===============================================================================
+def _link(src, dest):
+    tmp_dest = "%s.%d.tmp" % (dest, os.getpid())
+    try:
+        os.link(src, tmp_dest)
+    except OSError as ex:
+        logging.warning("Unable to link '%s' to '%s', copy it (%s)",
+                dest, src, str(ex))
+        shutil.copy2(src, tmp_dest)
+    os.replace(tmp_dest, dest)
+
+#===============================================================================
+# Add files in the store (copying them if not already stored).
+# Return a dictionary file -> path of stored file.
+#===============================================================================
+def add_files(filepaths):
+    blobs = {}
+    for filepath, digest in _get_digests(filepaths).items():
+        blob_path = get_blob_path(digest, os.stat(filepath).st_mode)
+        if not os.path.exists(blob_path):
+            utils.makedirs(os.path.dirname(blob_path))
+            tmp_blob_path = "%s.%d.tmp" % (blob_path, os.getpid())
+            shutil.copy2(filepath, tmp_blob_path)
+            os.replace(tmp_blob_path, blob_path)
+        blobs[filepath] = blob_path
+    return blobs
+
+#===============================================================================
+# Create dest as a copy of src (file or directory, following symlinks) made of
+# hard links to stored files.
+#===============================================================================
+def link_tree(src, dest):
+    # Do not write through a previous symlink to the source
+    if os.path.islink(dest):
+        os.unlink(dest)
+    links = []
+    if os.path.isdir(src):
+        for dirpath, dirnames, filenames in os.walk(src, followlinks=True):
+            dirnames[:] = [name for name in dirnames if name != ".git"]
+            dest_dirpath = os.path.normpath(os.path.join(dest,
+                    os.path.relpath(dirpath, src)))
+            utils.makedirs(dest_dirpath)
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                if os.path.isfile(filepath):
+                    links.append((filepath, os.path.join(dest_dirpath, filename)))
+    else:
+        utils.makedirs(os.path.dirname(dest))
+        links.append((src, dest))
+
+    blobs = add_files([filepath for filepath, _ in links])
+    for filepath, dest_filepath in links:
+        _link(blobs[filepath], dest_filepath)
+
+#===============================================================================
+# Get statistics of the store.
+# Return (number of stored files, size of stored files, size of references)
+# A stored file with a single link is not referenced any more.
+#===============================================================================
+def get_stats():
+    blob_count, physical_size, logical_size = 0, 0, 0
+    objects_dir = os.path.join(get_store_dir(), "objects")
+    for dirpath, _, filenames in os.walk(objects_dir):
+        for filename in filenames:
+            st = os.lstat(os.path.join(dirpath, filename))
+            blob_count += 1
+            physical_size += st.st_size
+            logical_size += st.st_size * (st.st_nlink - 1)
+    return blob_count, physical_size, logical_size
+
+#===============================================================================
+# Remove stored files that are not referenced any more.
+# Return the number of removed files and their size.
+#===============================================================================
+def prune():
+    count, size = 0, 0
+    objects_dir = os.path.join(get_store_dir(), "objects")
+    for dirpath, _, filenames in os.walk(objects_dir):
+        for filename in filenames:
+            blob_path = os.path.join(dirpath, filename)
+            st = os.lstat(blob_path)
+            if st.st_nlink == 1 and not filename.endswith(".tmp"):
+                os.unlink(blob_path)
+                count += 1
+                size += st.st_size
+    return count, size
@@ -0,0 +1,142 @@
+
+import os
+import logging
+
+import cache
+import version
+
+# Loaded indexes by (git directory, prefix): (state of refs, index)
+_INDEXES = {}
+
+#===============================================================================
+# Index of version tags of a git repository.
+#
+# Tags are named '<prefix>-<version>' (the prefix being PARROT_BUILD_TAG_PREFIX)
+# and are read directly from the refs of the repository (packed and loose)
+# without executing git.
+#===============================================================================
+class TagIndex(object):
+    def __init__(self, git_dir, prefix):
+        self.git_dir = git_dir
+        self.prefix = prefix
+        self.tags = {}
+        tag_prefix = prefix + "-"
+        for tagname in get_tag_names(git_dir):
+            if not tagname.startswith(tag_prefix):
+                continue
+            try:
+                self.tags[tagname] = version.parse(tagname[len(tag_prefix):])
+            except ValueError:
+                logging.debug("Ignoring tag '%s'", tagname)
+        # Versions from the oldest to the newest
+        self.versions = version.sort_versions(self.tags.values())
+
+    # Get the newest version matching a filter (None if no match)
+    def _get_latest(self, fct):
+        for _version in reversed(self.versions):
+            if fct(_version):
+                return _version
+        return None
+
+    # Get the newest version (including custom ones)
+    def get_latest(self):
+        return self.versions[-1] if self.versions else None
+
+    # Get the newest release version (not custom)
+    def get_latest_release(self):
+        return self._get_latest(lambda v:
+                v.type == version.Version.TYPE_RELEASE and not v.custom)
+
+    # Get the newest release candidate version (not custom)
+    def get_latest_rc(self):
+        return self._get_latest(lambda v:
+                v.type == version.Version.TYPE_RC and not v.custom)
+
+    # Get the newest custom version
+    def get_latest_custom(self):
+        return self._get_latest(lambda v: bool(v.custom))
+
+    # Get the version that the next release will have: the version being
+    # prepared if the newest tag is an alpha/beta/rc, otherwise the patch
+    # following the newest release
+    def get_next_version(self):
+        latest = self._get_latest(lambda v: not v.custom)
+        if latest is None:
+            return version.parse("0.0.0")
+        if latest.type == version.Version.TYPE_RELEASE:
+            return version.parse("%d.%d.%d" %
+                    (latest.major, latest.minor, latest.patch + 1))
+        return latest.as_release()
+
+#===============================================================================
+# Get names of the tags of a git repository (loose and packed refs).
+#===============================================================================
+def get_tag_names(git_dir):
+    common_dir = _get_common_dir(git_dir)
+    names = set()
+    try:
+        with open(os.path.join(common_dir, "packed-refs"), "r") as fd:
+            for line in fd:
+                fields = line.rstrip("\n").split(" ", 1)
+                if len(fields) == 2 and fields[1].startswith("refs/tags/"):
+                    names.add(fields[1][len("refs/tags/"):])
+    except OSError:
+        pass
+    tags_dir = os.path.join(common_dir, "refs", "tags")
+    for dirpath, _, filenames in os.walk(tags_dir):
+        for filename in filenames:
+            names.add(os.path.relpath(os.path.join(dirpath, filename), tags_dir))
+    return sorted(names)
+
+#===============================================================================
+# Get the directory shared by worktrees of a repository.
+#===============================================================================
+def _get_common_dir(git_dir):
+    commondir_path = os.path.join(git_dir, "commondir")
+    if os.path.exists(commondir_path):
+        with open(commondir_path, "r") as fd:
+            return os.path.normpath(os.path.join(git_dir, fd.read().strip()))
+    return git_dir
+
+#===============================================================================
+# Get the state of tags of a repository: stat information of packed-refs and
+# of directories of loose tags (changed when a tag is added or removed).
+#===============================================================================
+def _get_refs_state(git_dir):
+    common_dir = _get_common_dir(git_dir)
+    state = [cache.get_stat_info(os.path.join(common_dir, "packed-refs"))]
+    tags_dir = os.path.join(common_dir, "refs", "tags")
+    for dirpath, dirnames, _ in os.walk(tags_dir):
+        dirnames.sort()
+        state.append((dirpath, cache.get_stat_info(dirpath)))
+    return state
+
+#===============================================================================
+# Find the git directory of the repository containing a directory.
+#===============================================================================
+def find_git_dir(dirpath):
+    dirpath = os.path.abspath(dirpath)
+    while True:
+        git_dir = cache.get_git_dir(dirpath)
+        if git_dir:
+            return git_dir
+        parent = os.path.dirname(dirpath)
+        if parent == dirpath:
+            return None
+        dirpath = parent
+
+#===============================================================================
+# Get the tag index of the repository containing a directory for a prefix.
+# Indexes are kept while tags of the repository do not change.
+# Return None if the directory is not in a git repository.
+#===============================================================================
+def get_tag_index(dirpath, prefix):
+    git_dir = find_git_dir(dirpath)
+    if not git_dir:
+        return None
+    state = _get_refs_state(git_dir)
+    entry = _INDEXES.get((git_dir, prefix))
+    if not entry or entry[0] != state:
+        entry = (state, TagIndex(git_dir, prefix))
+        _INDEXES[(git_dir, prefix)] = entry
+    return entry[1]
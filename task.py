@@ -1,10 +1,15 @@
 
 import sys
 import os
+import glob
 import logging
+import shlex
 import subprocess
 
+import cache
 import dragon
+import scheduler
+import tracing
 import utils
 
 # Generic task error.
@@ -35,7 +40,8 @@ class Hook(object):
 #===============================================================================
 class Task(object):
     def __init__(self, name, desc, secondary_help=False,
-            exechook=None, prehook=None, posthook=None, weak=False):
+            exechook=None, prehook=None, posthook=None, weak=False,
+            inputs=None, outputs=None, planhook=None):
         self.name = name
         self.desc = desc
         self.secondary_help = secondary_help
@@ -45,11 +51,24 @@ class Task(object):
         self.extra_env = None
         self.weak = weak
         self.top_info = None
+        # Files/directories (glob patterns, relative to the workspace, that can
+        # reference global variables like '{OUT_DIR}') used and generated by
+        # the task. If outputs are given, the task is skipped when its inputs
+        # did not change since its last execution and its outputs exist.
+        self.inputs = inputs
+        self.outputs = outputs
+        # Optional function (task, args) describing what hooks would do in the
+        # plan of the task (dictionary added to it)
+        self.planhook = planhook
 
     # To be implemented by tasks to actually do something
     def _do_exec(self, args=None):
         pass
 
+    # To be implemented by tasks to describe what _do_exec would do
+    def _plan_exec(self, args=None):
+        return {}
+
     def call_base_exec_hook(self, args):
         if self.exechook and self.exechook.basehook:
             oldhook = self.exechook
@@ -77,9 +96,108 @@ class Task(object):
             finally:
                 self.posthook = oldhook
 
+    # Call a step of the task execution (hook or internal execution) in a
+    # trace span
+    def _call_step(self, step, fct, *args):
+        name = getattr(fct, "fct", fct).__name__
+        with tracing.span("%s:%s" % (step, name), "hook", task=self.name):
+            TaskExit.wrap(fct, *args)
+
+    # Get what defines the task besides its hooks (arguments given to
+    # subtasks or commands), to be implemented by tasks
+    def _get_definition(self):
+        return None
+
+    # Get paths matching a declared input/output
+    @staticmethod
+    def _expand_path(pattern):
+        if "{" in pattern:
+            pattern = pattern.format(**vars(dragon))
+        pattern = os.path.join(dragon.WORKSPACE_DIR, pattern)
+        return sorted(glob.glob(pattern, recursive=True))
+
+    # Get state of input files (directories are walked)
+    def _get_inputs_state(self):
+        state = []
+        for pattern in self.inputs or []:
+            entries = []
+            for path in Task._expand_path(pattern):
+                if os.path.isdir(path):
+                    for dirpath, dirnames, filenames in os.walk(path):
+                        dirnames.sort()
+                        for filename in sorted(filenames):
+                            filepath = os.path.join(dirpath, filename)
+                            entries.append((filepath, cache.get_stat_info(filepath)))
+                else:
+                    entries.append((path, cache.get_stat_info(path)))
+            state.append((pattern, entries))
+        return state
+
+    # Get the key of an execution of the task: arguments, environment,
+    # definition and state of inputs
+    def get_inputs_key(self, args=None, extra_env=None):
+        return cache.get_digest(self.name, args or [], extra_env or {},
+                self._get_definition(), self._get_inputs_state())
+
+    def _get_key_cache_path(self):
+        filename = "".join([c if c.isalnum() or c in "._-" else "_"
+                for c in self.name])
+        return cache.get_cache_path(os.path.join("tasks", filename + ".json"))
+
+    # Check if the task is up to date: same key as its last execution and all
+    # outputs exist
+    def is_up_to_date(self, key):
+        cache_data = cache.load(self._get_key_cache_path())
+        if not cache_data or cache_data.get("key") != key:
+            return False
+        for pattern in self.outputs:
+            if not Task._expand_path(pattern):
+                logging.debug("Task '%s': missing output '%s'", self.name, pattern)
+                return False
+        return True
+
+    # Get the plan of an execution of the task without executing anything:
+    # names of hooks (they are not called, the plan hook can describe what they
+    # would do), whether the task is up to date and what the task itself would
+    # execute (commands, subtasks, builds)
+    def plan(self, args=None, extra_env=None):
+        plan = {
+            "name": self.name,
+            "type": self.__class__.__name__,
+            "args": args or [],
+        }
+        for step, hook in [("prehook", self.prehook),
+                ("exechook", self.exechook),
+                ("posthook", self.posthook)]:
+            if hook:
+                plan[step] = getattr(hook.fct, "__name__", str(hook.fct))
+        if self.outputs:
+            plan["up_to_date"] = not dragon.OPTIONS.force and \
+                    self.is_up_to_date(self.get_inputs_key(args, extra_env))
+        self.extra_env = {}
+        if extra_env:
+            self.extra_env.update(extra_env)
+        plan.update(self._plan_exec(args))
+        # Lists given by the plan hook (commands...) extend the ones of the task
+        if self.planhook:
+            for key, value in (self.planhook(self, args) or {}).items():
+                if isinstance(value, list) and isinstance(plan.get(key), list):
+                    plan[key] = plan[key] + value
+                else:
+                    plan[key] = value
+        return plan
+
     # Start execution of task by executing hooks before and after internal
     # task execution
     def execute(self, args=None, extra_env=None, top_info=None):
+        # Skip the task if it is up to date (unless forced)
+        key = None
+        if self.outputs:
+            key = self.get_inputs_key(args, extra_env)
+            if not dragon.OPTIONS.force and self.is_up_to_date(key):
+                logging.info("Task '%s' is up to date", self.name)
+                return
+
         # Clear extra env before executing hooks and task
         self.extra_env = {}
         if extra_env:
@@ -92,23 +210,30 @@ class Task(object):
         else:
             logging.info("Starting task '%s'", self.name)
 
+        prev_taskname = utils.set_current_task(self.name)
         try:
-            # Execute hooks
-            if self.prehook:
-                TaskExit.wrap(self.prehook, self, args)
-            if self.exechook:
-                TaskExit.wrap(self.exechook, self, args)
-            else:
-                TaskExit.wrap(self._do_exec, args)
-            if self.posthook:
-                TaskExit.wrap(self.posthook, self, args)
+            with tracing.span(self.name, "task", args=args or []):
+                # Execute hooks
+                if self.prehook:
+                    self._call_step("prehook", self.prehook, self, args)
+                if self.exechook:
+                    self._call_step("exechook", self.exechook, self, args)
+                else:
+                    self._call_step("exec", self._do_exec, args)
+                if self.posthook:
+                    self._call_step("posthook", self.posthook, self, args)
         except subprocess.CalledProcessError as ex:
             logging.error("Task '%s' failed (%s)", self.name, str(ex))
             if not dragon.OPTIONS.keep_going:
                 sys.exit(1)
+            dragon.FAILED_TASKS.append(self.name)
         else:
             # Task is finished
             logging.info("Finished task '%s'", self.name)
+            if key and not dragon.OPTIONS.dryrun:
+                cache.save(self._get_key_cache_path(), {"key": key})
+        finally:
+            utils.set_current_task(prev_taskname)
 
 #===============================================================================
 # Alchemy build system task.
@@ -116,31 +241,42 @@ class Task(object):
 class AlchemyTask(Task):
     def __init__(self, name, desc, product, variant, defargs=None,
                 secondary_help=False, prehook=None, posthook=None, weak=False,
-                outsubdir=None, host_in_subdir=True):
+                outsubdir=None, host_in_subdir=True, inputs=None, outputs=None,
+                planhook=None):
         Task.__init__(self, name, desc, secondary_help=secondary_help,
-                prehook=prehook, posthook=posthook, weak=weak)
+                prehook=prehook, posthook=posthook, weak=weak,
+                inputs=inputs, outputs=outputs, planhook=planhook)
         self.product = product
         self.product_variant = variant
         self.defargs = defargs
         self.outsubdir = outsubdir
         self.host_in_subdir = host_in_subdir
 
-    def _setup_extra_env(self):
+    def _get_definition(self):
+        return [self.product, self.product_variant, self.defargs,
+                self.outsubdir, self.host_in_subdir]
+
+    # Add environment given to alchemy in extra_env (the one of the current
+    # execution by default). Return extra_env.
+    def _setup_extra_env(self, extra_env=None):
+        if extra_env is None:
+            extra_env = self.extra_env
+
         # Export parrot build properties
         if dragon.PARROT_BUILD_PROP_GROUP:
-            self.extra_env["PARROT_BUILD_PROP_GROUP"] = dragon.PARROT_BUILD_PROP_GROUP
+            extra_env["PARROT_BUILD_PROP_GROUP"] = dragon.PARROT_BUILD_PROP_GROUP
         if dragon.PARROT_BUILD_PROP_PROJECT:
-            self.extra_env["PARROT_BUILD_PROP_PROJECT"] = dragon.PARROT_BUILD_PROP_PROJECT
+            extra_env["PARROT_BUILD_PROP_PROJECT"] = dragon.PARROT_BUILD_PROP_PROJECT
         if dragon.PARROT_BUILD_PROP_PRODUCT:
-            self.extra_env["PARROT_BUILD_PROP_PRODUCT"] = dragon.PARROT_BUILD_PROP_PRODUCT
+            extra_env["PARROT_BUILD_PROP_PRODUCT"] = dragon.PARROT_BUILD_PROP_PRODUCT
         if dragon.PARROT_BUILD_PROP_VARIANT:
-            self.extra_env["PARROT_BUILD_PROP_VARIANT"] = dragon.PARROT_BUILD_PROP_VARIANT
+            extra_env["PARROT_BUILD_PROP_VARIANT"] = dragon.PARROT_BUILD_PROP_VARIANT
         if dragon.PARROT_BUILD_PROP_REGION:
-            self.extra_env["PARROT_BUILD_PROP_REGION"] = dragon.PARROT_BUILD_PROP_REGION
+            extra_env["PARROT_BUILD_PROP_REGION"] = dragon.PARROT_BUILD_PROP_REGION
         if dragon.PARROT_BUILD_PROP_UID:
-            self.extra_env["PARROT_BUILD_PROP_UID"] = dragon.PARROT_BUILD_PROP_UID
+            extra_env["PARROT_BUILD_PROP_UID"] = dragon.PARROT_BUILD_PROP_UID
         if dragon.PARROT_BUILD_PROP_VERSION:
-            self.extra_env["PARROT_BUILD_PROP_VERSION"] = dragon.PARROT_BUILD_PROP_VERSION
+            extra_env["PARROT_BUILD_PROP_VERSION"] = dragon.PARROT_BUILD_PROP_VERSION
 
         # Determine output directory
         if self.outsubdir:
@@ -149,11 +285,11 @@ class AlchemyTask(Task):
             out_dir = dragon.OUT_DIR
 
         # Export Alchemy variables
-        self.extra_env["ALCHEMY_WORKSPACE_DIR"] = dragon.WORKSPACE_DIR
-        self.extra_env["ALCHEMY_TARGET_PRODUCT"] = self.product
-        self.extra_env["ALCHEMY_TARGET_PRODUCT_VARIANT"] = self.product_variant
-        self.extra_env["ALCHEMY_TARGET_OUT"] = out_dir
-        self.extra_env["ALCHEMY_TARGET_CONFIG_DIR"] = os.path.join(
+        extra_env["ALCHEMY_WORKSPACE_DIR"] = dragon.WORKSPACE_DIR
+        extra_env["ALCHEMY_TARGET_PRODUCT"] = self.product
+        extra_env["ALCHEMY_TARGET_PRODUCT_VARIANT"] = self.product_variant
+        extra_env["ALCHEMY_TARGET_OUT"] = out_dir
+        extra_env["ALCHEMY_TARGET_CONFIG_DIR"] = os.path.join(
                 dragon.PRODUCTS_DIR,
                 self.product, self.product_variant, "config")
         if not self.host_in_subdir:
@@ -161,81 +297,233 @@ class AlchemyTask(Task):
             host_out_dir = os.path.join(dragon.OUT_DIR, "host")
             host_build = os.path.join(host_out_dir, "build")
             host_staging = os.path.join(host_out_dir, "staging")
-            self.extra_env["ALCHEMY_HOST_OUT_BUILD"] = host_build
-            self.extra_env["ALCHEMY_HOST_OUT_STAGING"] = host_staging
+            extra_env["ALCHEMY_HOST_OUT_BUILD"] = host_build
+            extra_env["ALCHEMY_HOST_OUT_STAGING"] = host_staging
 
         # Only scan 'packages' sub-directory and exclude top directory (workspace)
-        self.extra_env["ALCHEMY_TARGET_SCAN_PRUNE_DIRS"] = " ".join([
+        extra_env["ALCHEMY_TARGET_SCAN_PRUNE_DIRS"] = " ".join([
                 os.environ.get("ALCHEMY_TARGET_SCAN_PRUNE_DIRS", ""),
                 dragon.WORKSPACE_DIR])
-        self.extra_env["ALCHEMY_TARGET_SCAN_ADD_DIRS"] = " ".join([
+        extra_env["ALCHEMY_TARGET_SCAN_ADD_DIRS"] = " ".join([
                 os.environ.get("ALCHEMY_TARGET_SCAN_ADD_DIRS", ""),
                 dragon.PACKAGES_DIR])
 
         # Use colors (unless already set or disabled, by jenkins for example)
         if not dragon.OPTIONS.colors:
-            self.extra_env["ALCHEMY_USE_COLORS"] = "0"
+            extra_env["ALCHEMY_USE_COLORS"] = "0"
         elif not os.environ.get("ALCHEMY_USE_COLORS", ""):
-            self.extra_env["ALCHEMY_USE_COLORS"] = "1"
+            extra_env["ALCHEMY_USE_COLORS"] = "1"
+        return extra_env
 
-    def _do_exec(self, args=None):
-        # Setup extra env
-        self._setup_extra_env()
-        cmd_args = []
+    # jobs: number of jobs to use instead of the -j option
+    def _get_cmd_args(self, args=None, jobs=None):
+        cmd_args = [os.path.join(dragon.ALCHEMY_HOME, "scripts", "alchemake")]
 
         # jobs argument
-        cmd_args.append(dragon.OPTIONS.jobs.make_arg)
+        if jobs is not None:
+            cmd_args.extend(["-j", str(jobs)])
+        else:
+            cmd_args.extend(dragon.OPTIONS.jobs.make_arg.split())
 
         # Verbose
         if dragon.OPTIONS.verbose:
             cmd_args.append("V=1")
 
-        # Get arguments from task if none provided
+        # Get arguments from task if none provided, add given arguments
+        # otherwise (split like the shell did when the command was a string,
+        # for compatibility with configurations and command lines)
         if not args and self.defargs:
-            cmd_args.extend(self.defargs)
+            cmd_args.extend(shlex.split(" ".join(self.defargs)))
+        elif args:
+            cmd_args.extend(shlex.split(" ".join([arg for arg in args if arg])))
+        return cmd_args
 
-        # Add given arguments
-        if args:
-            cmd_args.extend(args)
+    def _do_exec(self, args=None):
+        # Setup extra env
+        self._setup_extra_env()
 
-        # Execute command
-        utils.exec_cmd("%s/scripts/alchemake %s" %
-                (dragon.ALCHEMY_HOME, " ".join(cmd_args)),
-                extra_env=self.extra_env)
+        # Execute command. Alchemy invocations of subtasks executed
+        # concurrently share the jobs of the build (unless make limits them
+        # with the load)
+        if "-l" in dragon.OPTIONS.jobs.make_arg.split():
+            utils.exec_cmd(self._get_cmd_args(args), extra_env=self.extra_env)
+            return
+        with scheduler.JOBS.take(dragon.OPTIONS.jobs.job_num) as jobs:
+            utils.exec_cmd(self._get_cmd_args(args, jobs),
+                    extra_env=self.extra_env)
+
+    def _plan_exec(self, args=None):
+        self._setup_extra_env()
+        return {"commands": [{
+            "cmd": self._get_cmd_args(args),
+            "env": dict(self.extra_env),
+        }]}
 
     def get_var(self, varname):
-        self.extra_env = {}
-        self._setup_extra_env()
-        output =  dragon.exec_shell("make -f %s/envsetup.mk var-%s" %
-                (dragon.ALCHEMY_HOME, varname),
-                extra_env=self.extra_env, single_line=False)
-        for line in output.splitlines():
-            if line.startswith(varname + "="):
-                return line[len(varname)+1:]
-        return None
+        return self.get_vars([varname])[varname]
+
+    # Get the values of alchemy variables (None for unknown ones) with a single
+    # invocation of alchemy. Values are cached in the output directory until
+    # configuration or alchemy itself changes.
+    def get_vars(self, varnames):
+        # The registered task can be executed at the same time, its
+        # environment is not modified
+        extra_env = self._setup_extra_env({})
+
+        cache_path = cache.get_cache_path("alchemy-vars.json")
+        cache_key = self._get_vars_cache_key(extra_env)
+        cache_data = cache.load(cache_path)
+        if not cache_data or cache_data.get("key") != cache_key:
+            cache_data = {"key": cache_key, "vars": {}}
+
+        missing = [varname for varname in varnames
+                if varname not in cache_data["vars"]]
+        if missing:
+            logging.debug("Get alchemy variables: %s", " ".join(missing))
+            values = dict.fromkeys(missing)
+            try:
+                output = dragon.exec_shell(
+                        ["make", "-f", os.path.join(dragon.ALCHEMY_HOME, "envsetup.mk")] +
+                        ["var-%s" % varname for varname in missing],
+                        extra_env=extra_env, single_line=False, check=True)
+            except utils.ExecError as ex:
+                # Values are not saved (like values of an empty output) to
+                # try again next time
+                logging.warning("Unable to get alchemy variables: %s", str(ex))
+                output = None
+            for line in (output or "").splitlines():
+                varname, sep, value = line.partition("=")
+                if sep and varname in values and values[varname] is None:
+                    values[varname] = value
+            cache_data["vars"].update(values)
+            if output:
+                cache.save(cache_path, cache_data)
+
+        return {varname: cache_data["vars"][varname] for varname in varnames}
+
+    # Get a digest of what images depend on besides the final directory:
+    # environment given to alchemy (except the build uid, already in the final
+    # directory), product configuration and alchemy version
+    def get_images_key(self):
+        extra_env = self._setup_extra_env({})
+        return cache.get_digest(
+            {key: value for key, value in extra_env.items()
+                    if key not in ["ALCHEMY_USE_COLORS", "PARROT_BUILD_PROP_UID"]},
+            {key: value for key, value in os.environ.items()
+                    if key.startswith(("ALCHEMY_", "TARGET_"))},
+            self._get_config_state(extra_env))
+
+    # Key of the variables cache: environment given to alchemy, product
+    # configuration and alchemy files
+    def _get_vars_cache_key(self, extra_env):
+        return cache.get_digest(
+            {key: value for key, value in extra_env.items()
+                    if key != "PARROT_BUILD_PROP_UID"},
+            {key: value for key, value in os.environ.items()
+                    if key.startswith(("ALCHEMY_", "TARGET_"))},
+            self._get_config_state(extra_env))
+
+    # State of product configuration and alchemy (version and all its files,
+    # modified or not committed ones included)
+    def _get_config_state(self, extra_env):
+        config_dir = extra_env["ALCHEMY_TARGET_CONFIG_DIR"]
+        config_files = sorted(os.listdir(config_dir)) \
+                if os.path.isdir(config_dir) else []
+        return [
+            [(name, cache.get_stat_info(os.path.join(config_dir, name)))
+                    for name in config_files],
+            cache.get_stat_info(os.path.join(dragon.OUT_DIR, "global.config")),
+            cache.get_git_head(dragon.ALCHEMY_HOME),
+            cache.get_tree_state(dragon.ALCHEMY_HOME),
+        ]
+
+    # Get a digest of what the alchemy database depends on: product
+    # configuration, alchemy version and atom.mk files found in scanned
+    # directories (the same way alchemy does)
+    def get_database_key(self):
+        extra_env = self._setup_extra_env({})
+        # Paths are resolved once, walked directories are then compared
+        # lexically (symlinks are not followed by the walk)
+        prune_dirs = set([os.path.realpath(dirpath) for dirpath in
+                extra_env["ALCHEMY_TARGET_SCAN_PRUNE_DIRS"].split()])
+        atoms = []
+        for scan_dir in extra_env["ALCHEMY_TARGET_SCAN_ADD_DIRS"].split():
+            for dirpath, dirnames, filenames in os.walk(os.path.realpath(scan_dir)):
+                dirnames[:] = sorted([dirname for dirname in dirnames
+                        if not dirname.startswith(".")
+                        and os.path.join(dirpath, dirname) not in prune_dirs])
+                if "atom.mk" in filenames:
+                    atom_path = os.path.join(dirpath, "atom.mk")
+                    atoms.append((atom_path, cache.get_stat_info(atom_path)))
+        return cache.get_digest(
+            {key: value for key, value in extra_env.items()
+                    if key not in ["ALCHEMY_USE_COLORS", "PARROT_BUILD_PROP_UID"]},
+            self._get_config_state(extra_env),
+            atoms)
 
 #===============================================================================
 # Meta task.
+# depends is an optional dictionary giving for a subtask the list of subtasks
+# it depends on (using the full subtask string as key, like
+# "alchemy symbols-tar"). If given (and not empty), independent subtasks can be
+# executed concurrently, otherwise subtasks are executed in order.
 #===============================================================================
 class MetaTask(Task):
     def __init__(self, name, desc, subtasks=None, secondary_help=False,
-                exechook=None, prehook=None, posthook=None, weak=False):
+                exechook=None, prehook=None, posthook=None, weak=False,
+                depends=None, inputs=None, outputs=None, planhook=None):
         Task.__init__(self, name, desc, secondary_help=secondary_help,
                 exechook=exechook, prehook=prehook, posthook=posthook,
-                weak=weak)
+                weak=weak, inputs=inputs, outputs=outputs, planhook=planhook)
         self.subtasks = subtasks
+        self.depends = depends
+        # Set by a hook (before the execution of subtasks) when what they
+        # would generate is up to date, subtasks are then not executed
+        self.subtasks_up_to_date = False
+
+    def _get_definition(self):
+        return [self.subtasks, self.depends]
+
+    def execute(self, args=None, extra_env=None, top_info=None):
+        self.subtasks_up_to_date = False
+        Task.execute(self, args, extra_env, top_info)
 
     def _do_exec(self, args=None):
+        self.exec_subtasks(args)
+
+    # Execute subtasks (can be called by an exec hook replacing _do_exec)
+    def exec_subtasks(self, args=None):
+        if self.subtasks_up_to_date:
+            logging.debug("Subtasks of '%s' are up to date", self.name)
+            return
         # Subtask list can be empty in case user was only interested in hooks
         if self.subtasks:
-            for subtask in self.subtasks:
-                if subtask:
-                    # Split subtask in name and arguments
-                    subtaskargs = subtask.split(" ")
-                    subtaskname = subtaskargs[0]
-                    subtaskargs = subtaskargs[1:]
-                    dragon.do_task(subtaskname, subtaskargs,
-                            self.extra_env, self.top_info)
+            subtasks = [subtask for subtask in self.subtasks if subtask]
+            scheduler.run(subtasks, self.depends, self._do_subtask,
+                    dragon.OPTIONS.jobs.job_num)
+
+    def _do_subtask(self, subtask):
+        # Split subtask in name and arguments
+        subtaskargs = subtask.split(" ")
+        subtaskname = subtaskargs[0]
+        subtaskargs = subtaskargs[1:]
+        dragon.do_task(subtaskname, subtaskargs,
+                self.extra_env, self.top_info)
+
+    # Subtasks are listed even if an exec hook replaces _do_exec (it can
+    # execute them with exec_subtasks)
+    def _plan_exec(self, args=None):
+        subtasks = [subtask for subtask in self.subtasks or [] if subtask]
+        plans = []
+        for subtask in subtasks:
+            subtaskargs = subtask.split(" ")
+            plans.append(dragon.plan_task(subtaskargs[0], subtaskargs[1:],
+                    self.extra_env))
+        depends = {}
+        for subtask, deps in (self.depends or {}).items():
+            if subtask in subtasks:
+                depends[subtask] = [dep for dep in deps if dep in subtasks]
+        return {"subtasks": plans, "depends": depends}
 
 #===============================================================================
 # Product task.
@@ -243,14 +531,18 @@ class MetaTask(Task):
 class ProductTask(Task):
     def __init__(self, name, desc, product, variant, defargs=None,
                 secondary_help=False,
-                prehook=None, posthook=None, weak=False):
+                prehook=None, posthook=None, weak=False,
+                inputs=None, outputs=None, planhook=None):
         Task.__init__(self, name, desc, secondary_help=secondary_help,
                 prehook=prehook, posthook=posthook,
-                weak=weak)
+                weak=weak, inputs=inputs, outputs=outputs, planhook=planhook)
         self.product = product
         self.variant = variant
         self.defargs = defargs
 
+    def _get_definition(self):
+        return [self.product, self.variant, self.defargs]
+
     @staticmethod
     def _extend_args(cmd_args, args):
         # Add -t for each arg if not given
@@ -260,7 +552,7 @@ class ProductTask(Task):
             else:
                 cmd_args.append("-t " + arg)
 
-    def _do_exec(self, args=None):
+    def _get_cmd_args(self, args=None):
         cmd_args = []
 
         # Get arguments from task if none provided
@@ -270,5 +562,11 @@ class ProductTask(Task):
         # Add given arguments
         if args:
             ProductTask._extend_args(cmd_args, args)
+        return cmd_args
+
+    def _do_exec(self, args=None):
+        dragon.restart(self.product, self.variant, self._get_cmd_args(args))
 
-        dragon.restart(self.product, self.variant, cmd_args)
+    def _plan_exec(self, args=None):
+        return {"builds": dragon.plan_restart(self.product, self.variant,
+                self._get_cmd_args(args))}
@@ -0,0 +1,75 @@
+import os
+import sys
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dragon
+import archive
+
+#===============================================================================
+#===============================================================================
+class WriteReleaseArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.out_dir = os.path.join(self.root_dir, "out")
+        os.makedirs(os.path.join(self.out_dir, "images", ".git"))
+        self.write("images/image.plf", b"image")
+        self.write("images/.git/HEAD", b"ref")
+        self.write("build.prop", b"prop")
+        self.tar_path = os.path.join(self.root_dir, "release.tar")
+        self.entries = [
+            (os.path.join(self.out_dir, "images"), "images"),
+            (os.path.join(self.out_dir, "build.prop"), "build.prop"),
+            (os.path.join(self.out_dir, "build.prop"), "config/build.prop"),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def write(self, relpath, data):
+        with open(os.path.join(self.out_dir, relpath), "wb") as fd:
+            fd.write(data)
+
+    def read_members(self):
+        with tarfile.open(self.tar_path) as tar:
+            return [(member.name, tar.extractfile(member).read()
+                    if member.isfile() else None) for member in tar]
+
+    def test_members(self):
+        archive.write_release_archive(self.tar_path, self.entries,
+                ["md5", "sha256"])
+        members = self.read_members()
+        self.assertEqual([name for name, _ in members], [
+            ".", "./build.prop", "./config", "./config/build.prop",
+            "./images", "./images/image.plf",
+            "./md5sum.txt", "./sha256sum.txt",
+        ])
+        self.assertEqual(members[-2][1].decode(), "".join([
+            "%s  %s\n" % (hashlib.md5(data).hexdigest(), name)
+            for name, data in [("./build.prop", b"prop"),
+                    ("./config/build.prop", b"prop"),
+                    ("./images/image.plf", b"image")]]))
+        self.assertFalse(os.path.exists(self.tar_path + ".tmp"))
+
+    def test_checksum_cache(self):
+        cache_path = os.path.join(self.root_dir, "checksums.json")
+        for _ in range(2):
+            archive.write_release_archive(self.tar_path, self.entries,
+                    cache_path=cache_path)
+            self.assertEqual(self.read_members()[-1][1].decode().split("\n")[2],
+                    "%s  ./images/image.plf" % hashlib.md5(b"image").hexdigest())
+
+    def test_failure(self):
+        self.entries.append((os.path.join(self.out_dir, "missing"), "missing"))
+        self.assertRaises(OSError, archive.write_release_archive,
+                self.tar_path, self.entries)
+        self.assertFalse(os.path.exists(self.tar_path))
+        self.assertFalse(os.path.exists(self.tar_path + ".tmp"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# build sets the directory of compiled modules when imported, keep ours
+_PYCACHE_PREFIX = getattr(sys, "pycache_prefix", None)
+import dragon
+import build
+sys.pycache_prefix = _PYCACHE_PREFIX
+
+_GB = 1024 * 1024 * 1024
+
+#===============================================================================
+# Limits read from sample /proc and cgroup files.
+#===============================================================================
+class LimitsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = os.path.realpath(tempfile.mkdtemp())
+        self.cgroup_root = os.path.join(self.tmp_dir, "cgroup")
+        self.saved = (build.CGROUP_ROOT, build.PROC_CGROUP_PATH,
+                build.PROC_MEMINFO_PATH)
+        build.CGROUP_ROOT = self.cgroup_root
+        build.PROC_CGROUP_PATH = os.path.join(self.tmp_dir, "proc-cgroup")
+        build.PROC_MEMINFO_PATH = os.path.join(self.tmp_dir, "proc-meminfo")
+
+    def tearDown(self):
+        (build.CGROUP_ROOT, build.PROC_CGROUP_PATH,
+                build.PROC_MEMINFO_PATH) = self.saved
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, filepath, data):
+        filepath = os.path.join(self.tmp_dir, filepath)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, "w") as fd:
+            fd.write(data)
+
+    def setup_v2(self, path):
+        self.write("proc-cgroup", "0::%s\n" % path)
+        self.write("cgroup/cgroup.controllers", "cpu memory\n")
+
+    def setup_v1(self, path):
+        self.write("proc-cgroup", "12:memory:%s\n4:cpu,cpuacct:%s\n0::/\n" % (
+                path, path))
+        os.makedirs(os.path.join(self.cgroup_root, "cpu"), exist_ok=True)
+        os.makedirs(os.path.join(self.cgroup_root, "memory"), exist_ok=True)
+
+    def test_missing_files(self):
+        self.assertEqual(build._get_cgroup_dirs("cpu"), (None, []))
+        self.assertIsNone(build.get_cgroup_cpu_quota())
+        self.assertIsNone(build.get_available_memory())
+        # cgroup known but without limit files
+        self.setup_v2("/build")
+        os.makedirs(os.path.join(self.cgroup_root, "build"))
+        self.assertIsNone(build.get_cgroup_cpu_quota())
+        self.assertIsNone(build.get_available_memory())
+
+    def test_v2_nested(self):
+        self.setup_v2("/user/build/job")
+        self.write("cgroup/user/build/job/cpu.max", "max 100000\n")
+        self.write("cgroup/user/cpu.max", "150000 100000\n")
+        self.assertEqual(build._get_cgroup_dirs("cpu"), (2, [
+                os.path.join(self.cgroup_root, "user", "build", "job"),
+                os.path.join(self.cgroup_root, "user", "build"),
+                os.path.join(self.cgroup_root, "user"),
+                self.cgroup_root]))
+        self.assertEqual(build.get_cgroup_cpu_quota(), 1.5)
+
+    def test_v2_namespace(self):
+        # The cgroup of the process is the root in a container
+        self.setup_v2("/user/build")
+        self.write("cgroup/cpu.max", "50000 100000\n")
+        self.assertEqual(build._get_cgroup_dirs("cpu"), (2, [self.cgroup_root]))
+        self.assertEqual(build.get_cgroup_cpu_quota(), 0.5)
+
+    def test_v2_max(self):
+        self.setup_v2("/build")
+        self.write("cgroup/build/cpu.max", "max 100000\n")
+        self.write("cgroup/build/memory.max", "max\n")
+        self.assertIsNone(build.get_cgroup_cpu_quota())
+        self.assertIsNone(build.get_available_memory())
+
+    def test_v1(self):
+        self.setup_v1("/docker/id")
+        self.write("cgroup/cpu/docker/id/cpu.cfs_quota_us", "-1\n")
+        self.write("cgroup/cpu/docker/id/cpu.cfs_period_us", "100000\n")
+        self.assertEqual(build._get_cgroup_dirs("cpu"), (1, [
+                os.path.join(self.cgroup_root, "cpu", "docker", "id"),
+                os.path.join(self.cgroup_root, "cpu", "docker"),
+                os.path.join(self.cgroup_root, "cpu")]))
+        self.assertIsNone(build.get_cgroup_cpu_quota())
+        self.write("cgroup/cpu/docker/cpu.cfs_quota_us", "200000\n")
+        self.write("cgroup/cpu/docker/cpu.cfs_period_us", "100000\n")
+        self.assertEqual(build.get_cgroup_cpu_quota(), 2.0)
+
+    def test_memory(self):
+        self.write("proc-meminfo", "MemTotal: 16000000 kB\n"
+                "MemFree: 1000000 kB\nMemAvailable: 8388608 kB\n")
+        self.assertEqual(build.get_available_memory(), 8 * _GB)
+        # Not limited by a huge cgroup v1 limit, limited by a lower one
+        self.setup_v1("/docker/id")
+        self.write("cgroup/memory/memory.limit_in_bytes",
+                "9223372036854771712\n")
+        self.assertEqual(build.get_available_memory(), 8 * _GB)
+        self.write("cgroup/memory/docker/id/memory.limit_in_bytes",
+                "%d\n" % (2 * _GB))
+        self.assertEqual(build.get_available_memory(), 2 * _GB)
+
+#===============================================================================
+# Number of jobs from the -j option and the maximum number of jobs.
+#===============================================================================
+class ParseJobsTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = build.get_max_jobs
+        build.get_max_jobs = lambda mem_per_job: (4, "memory")
+
+    def tearDown(self):
+        build.get_max_jobs = self.saved
+
+    def test_explicit(self):
+        with self.assertLogs(level="WARNING"):
+            jobs = build.parse_jobs("16")
+        self.assertEqual((jobs.make_arg, jobs.job_num, jobs.restart_arg),
+                ("-j 16", 16, "16"))
+        self.assertEqual(build.parse_jobs("2").job_num, 2)
+
+    def test_computed(self):
+        self.assertEqual(build.parse_jobs("__ALL_CPUS__").job_num, 4)
+        self.assertEqual(build.parse_jobs("/3").job_num, 2)
+        self.assertEqual(build.parse_jobs("-1").job_num, 3)
+        self.assertEqual(build.parse_jobs("0").make_arg, "-j -l 4")
+
+if __name__ == "__main__":
+    unittest.main()
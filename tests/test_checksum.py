@@ -0,0 +1,55 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dragon
+import checksum
+
+#===============================================================================
+# Files found by checksum.walk as sorted paths relative to the root.
+#===============================================================================
+def get_files(root_dir):
+    files = []
+    for dirpath, _, filenames in checksum.walk(root_dir):
+        files.extend([os.path.relpath(os.path.join(dirpath, filename), root_dir)
+                for filename in filenames])
+    return sorted(files)
+
+#===============================================================================
+#===============================================================================
+class WalkTest(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root_dir, "images", "sub"))
+        with open(os.path.join(self.root_dir, "images", "sub", "image.plf"), "w") as fd:
+            fd.write("image")
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def test_two_paths_to_same_dir(self):
+        os.symlink("images", os.path.join(self.root_dir, "images-link"))
+        self.assertEqual(get_files(self.root_dir), [
+            "images-link/sub/image.plf",
+            "images/sub/image.plf",
+        ])
+
+    def test_symlink_loop(self):
+        os.symlink("..", os.path.join(self.root_dir, "images", "sub", "loop"))
+        self.assertEqual(get_files(self.root_dir), [
+            "images/sub/image.plf",
+        ])
+
+    def test_dangling_symlink(self):
+        os.symlink("missing", os.path.join(self.root_dir, "images", "dangling"))
+        self.assertEqual(get_files(self.root_dir), [
+            "images/dangling",
+            "images/sub/image.plf",
+        ])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dragon
+import daemon
+
+_PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Daemon executing commands with a handler writing its context on the standard
+# outputs and exiting with the code given as first argument
+_SERVER_SCRIPT = """
+import os
+import sys
+sys.path.insert(0, %(package_dir)r)
+import daemon
+
+def handler():
+    sys.stdout.write("out %%s %%s %%s\\n" %% (os.getcwd(),
+            os.environ.get("DAEMON_TEST", ""), " ".join(sys.argv[1:])))
+    sys.stderr.write("err %%s\\n" %% sys.stdin.readline().strip())
+    sys.exit(int(sys.argv[1]))
+
+daemon.Daemon(%(socket_path)r, handler, lambda: [%(source_path)r]).serve()
+"""
+
+# Client sending its command to the daemon, executing it itself if the daemon
+# can not
+_CLIENT_SCRIPT = """
+import sys
+sys.path.insert(0, %(package_dir)r)
+import daemonclient
+
+daemonclient.run(%(socket_path)r)
+sys.stdout.write("local\\n")
+sys.exit(99)
+"""
+
+#===============================================================================
+#===============================================================================
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = os.path.realpath(tempfile.mkdtemp())
+        self.socket_path = os.path.join(self.tmp_dir, "daemon.sock")
+        self.source_path = os.path.join(self.tmp_dir, "source.py")
+        self.write(self.source_path, "source")
+        values = {
+            "package_dir": _PACKAGE_DIR,
+            "socket_path": self.socket_path,
+            "source_path": self.source_path,
+        }
+        self.server_path = os.path.join(self.tmp_dir, "server.py")
+        self.write(self.server_path, _SERVER_SCRIPT % values)
+        self.client_path = os.path.join(self.tmp_dir, "client.py")
+        self.write(self.client_path, _CLIENT_SCRIPT % values)
+        self.pid = daemon.start(self.socket_path,
+                [sys.executable, self.server_path],
+                os.path.join(self.tmp_dir, "daemon.log"))
+        self.assertIsNotNone(self.pid)
+
+    def tearDown(self):
+        daemon.stop(self.socket_path)
+        self.wait_stopped()
+        shutil.rmtree(self.tmp_dir)
+
+    # Wait for the daemon to remove its socket
+    def wait_stopped(self):
+        limit = time.time() + 10
+        while time.time() < limit and os.path.exists(self.socket_path):
+            time.sleep(0.1)
+
+    @staticmethod
+    def write(filepath, data):
+        with open(filepath, "w") as fd:
+            fd.write(data)
+
+    def run_client(self, *args):
+        env = dict(os.environ, DAEMON_TEST="value")
+        return subprocess.run([sys.executable, self.client_path] + list(args),
+                input="in\n", stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                cwd=self.tmp_dir, env=env, universal_newlines=True, timeout=30)
+
+    def test_command(self):
+        for exitcode in [0, 3]:
+            result = self.run_client(str(exitcode), "arg")
+            self.assertEqual(result.returncode, exitcode)
+            self.assertEqual(result.stdout, "out %s value %d arg\n" % (
+                    self.tmp_dir, exitcode))
+            self.assertEqual(result.stderr, "err in\n")
+        status = daemon.get_status(self.socket_path)
+        self.assertEqual(status["pid"], self.pid)
+        self.assertEqual(status["served"], 2)
+
+    def test_stale(self):
+        time.sleep(0.01)
+        self.write(self.source_path, "changed source")
+        result = self.run_client("0")
+        self.assertEqual((result.returncode, result.stdout), (99, "local\n"))
+        # The daemon restarts itself (same process) and serves next commands
+        limit = time.time() + 10
+        status = None
+        while time.time() < limit and not status:
+            time.sleep(0.1)
+            status = daemon.get_status(self.socket_path)
+        self.assertEqual(status["pid"], self.pid)
+        self.assertEqual(status["served"], 0)
+        self.assertEqual(self.run_client("0").returncode, 0)
+
+    def test_stop(self):
+        self.assertEqual(daemon.stop(self.socket_path), self.pid)
+        self.wait_stopped()
+        self.assertFalse(os.path.exists(self.socket_path))
+        self.assertIsNone(daemon.get_status(self.socket_path))
+        result = self.run_client("0")
+        self.assertEqual((result.returncode, result.stdout), (99, "local\n"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dragon
+
+_SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+        "build-with-docker.sh")
+
+# Fake docker command: records its arguments (one call per line, new lines of
+# arguments being replaced by spaces) and keeps the name of the running
+# container in a state file
+_DOCKER_STUB = """#!/bin/sh
+{ printf "%s" "$*" | tr "\\n" " "; echo; } >> "${DOCKER_STUB_DIR}/calls"
+state="${DOCKER_STUB_DIR}/running"
+case "$1" in
+inspect)
+	[ -f "${state}" ] && echo true
+	;;
+run)
+	if [ "$2" = "--detach" ]; then
+		echo "$4" > "${state}"
+		echo container-id
+	fi
+	;;
+ps)
+	[ -f "${state}" ] && cat "${state}"
+	;;
+rm)
+	shift 2
+	[ -f "${state}" ] && [ "$(cat "${state}")" = "$1" ] && rm -f "${state}"
+	;;
+esac
+exit 0
+"""
+
+#===============================================================================
+# build-with-docker.sh with a fake docker command in PATH.
+#===============================================================================
+class DockerReuseTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = os.path.realpath(tempfile.mkdtemp())
+        self.workspace_dir = os.path.join(self.tmp_dir, "workspace")
+        os.makedirs(self.workspace_dir)
+        bin_dir = os.path.join(self.tmp_dir, "bin")
+        os.makedirs(bin_dir)
+        docker_path = os.path.join(bin_dir, "docker")
+        with open(docker_path, "w") as fd:
+            fd.write(_DOCKER_STUB)
+        os.chmod(docker_path, 0o755)
+        self.env = dict(os.environ,
+                PATH=bin_dir + os.pathsep + os.environ.get("PATH", ""),
+                DOCKER_STUB_DIR=self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_script(self, args, reuse="60"):
+        self.env["DRAGON_DOCKER_REUSE"] = reuse
+        subprocess.check_call(["sh", _SCRIPT_PATH] + args,
+                cwd=self.workspace_dir, env=self.env, stdin=subprocess.DEVNULL)
+        calls_path = os.path.join(self.tmp_dir, "calls")
+        with open(calls_path, "r") as fd:
+            calls = [line.split() for line in fd.read().splitlines()]
+        os.unlink(calls_path)
+        return calls
+
+    def is_running(self):
+        return os.path.exists(os.path.join(self.tmp_dir, "running"))
+
+    def test_reuse(self):
+        # First command starts the container
+        calls = self.run_script(["image", "make", "all"])
+        self.assertEqual([call[0] for call in calls],
+                ["inspect", "rm", "run", "exec"])
+        self.assertEqual(calls[2][1], "--detach")
+        self.assertIn("dragon.workspace=%s" % self.workspace_dir, calls[2])
+        self.assertEqual(calls[3][-2:], ["make", "all"])
+        self.assertTrue(self.is_running())
+
+        # Next ones are executed in it
+        calls = self.run_script(["image", "make", "clean"])
+        self.assertEqual([call[0] for call in calls], ["inspect", "exec"])
+        self.assertEqual(calls[1][-2:], ["make", "clean"])
+
+        # A dead container is created again
+        os.unlink(os.path.join(self.tmp_dir, "running"))
+        calls = self.run_script(["image", "make"])
+        self.assertEqual([call[0] for call in calls],
+                ["inspect", "rm", "run", "exec"])
+        self.assertTrue(self.is_running())
+
+        # Containers of the workspace are removed with --stop
+        calls = self.run_script(["--stop"])
+        self.assertEqual([call[0] for call in calls], ["ps", "rm"])
+        self.assertEqual(calls[1][1], "--force")
+        self.assertFalse(self.is_running())
+
+    def test_no_reuse(self):
+        for reuse in ["", "0"]:
+            calls = self.run_script(["image", "make", "all"], reuse)
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(calls[0][0], "run")
+            self.assertIn("--rm", calls[0])
+            self.assertEqual(calls[0][-3:], ["image", "make", "all"])
+            self.assertFalse(self.is_running())
+
+if __name__ == "__main__":
+    unittest.main()
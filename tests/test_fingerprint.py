@@ -0,0 +1,109 @@
+import os
+import sys
+import time
+import shutil
+import struct
+import tempfile
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dragon
+import fingerprint
+
+# Files of the test repository (paths sharing prefixes for the compression of
+# index version 4, a path longer than the padding of an entry)
+_FILES = {
+    "README": "readme\n",
+    "src/main.c": "int main() { return 0; }\n",
+    "src/main.h": "int main();\n",
+    "src/module/module.c": "void module() {}\n",
+    "src/module-with-a-name-longer-than-the-entry-padding.c": "\n",
+    "script.sh": "#!/bin/sh\n",
+}
+
+#===============================================================================
+# Indexes of a real git repository, written by git in each version.
+#===============================================================================
+class ReadIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.repo_dir = os.path.realpath(tempfile.mkdtemp())
+        self.git("init", "-q")
+        for path, data in _FILES.items():
+            self.write(path, data)
+        os.chmod(os.path.join(self.repo_dir, "script.sh"), 0o755)
+        os.symlink("src/main.c", os.path.join(self.repo_dir, "link"))
+        self.git("add", ".")
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_dir)
+
+    def git(self, *args):
+        return subprocess.check_output(["git"] + list(args),
+                cwd=self.repo_dir, universal_newlines=True)
+
+    def write(self, path, data):
+        filepath = os.path.join(self.repo_dir, path)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, "w") as fd:
+            fd.write(data)
+
+    def read_index(self, index_version):
+        self.git("update-index", "--index-version", str(index_version))
+        index_path = os.path.join(self.repo_dir, ".git", "index")
+        with open(index_path, "rb") as fd:
+            self.assertEqual(struct.unpack("!4sI", fd.read(8)),
+                    (b"DIRC", index_version))
+        return fingerprint.read_index(index_path)
+
+    def check_entries(self, entries):
+        # Same entries as 'git ls-files -s': <mode> <id> <stage>\t<path>
+        expected = self.git("ls-files", "-s").splitlines()
+        self.assertEqual(["%o %s %d\t%s" % (mode, blob_id, (flags >> 12) & 3,
+                os.fsdecode(path)) for (path, _, _, _, mode, _, blob_id, flags,
+                _) in entries], expected)
+        self.assertEqual(len(entries), len(_FILES) + 1)
+        # Stat information of an unmodified file
+        entry = entries[[entry[0] for entry in entries].index(b"src/main.c")]
+        st = os.lstat(os.path.join(self.repo_dir, "src", "main.c"))
+        self.assertEqual(entry[1] // 1000000000, int(st.st_mtime))
+        self.assertEqual(entry[3], st.st_ino & 0xffffffff)
+        self.assertEqual(entry[5], st.st_size)
+
+    def test_version2(self):
+        self.check_entries(self.read_index(2))
+
+    def test_extended_flags(self):
+        self.write("new.c", "new\n")
+        self.git("add", "--intent-to-add", "new.c")
+        self.git("update-index", "--skip-worktree", "src/main.h")
+        for index_version in [3, 4]:
+            entries = self.read_index(index_version)
+            extflags = dict([(entry[0], entry[8]) for entry in entries])
+            self.assertEqual(extflags[b"new.c"],
+                    fingerprint._EXTFLAG_INTENT_TO_ADD)
+            self.assertEqual(extflags[b"src/main.h"],
+                    fingerprint._EXTFLAG_SKIP_WORKTREE)
+            self.assertEqual(extflags[b"src/main.c"], 0)
+            self.assertEqual(len([entry for entry in entries if entry[8]]), 2)
+
+    def test_version4(self):
+        self.check_entries(self.read_index(4))
+
+    def test_changes(self):
+        self.git("update-index", "--index-version", "4")
+        git_dir = os.path.join(self.repo_dir, ".git")
+        # Unmodified files (even racy ones, checked with their content)
+        time.sleep(0.01)
+        self.git("update-index", "--refresh")
+        self.assertEqual(fingerprint.get_changes(self.repo_dir, git_dir), [])
+        self.write("src/main.c", "int main() { return 1; }\n")
+        os.unlink(os.path.join(self.repo_dir, "README"))
+        blob_id = self.git("hash-object", "src/main.c").strip()
+        self.assertEqual(fingerprint.get_changes(self.repo_dir, git_dir), [
+                ["README", None, None],
+                ["src/main.c", blob_id, 0o100644]])
+
+if __name__ == "__main__":
+    unittest.main()
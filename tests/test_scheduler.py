@@ -0,0 +1,166 @@
+import os
+import sys
+import time
+import types
+import threading
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dragon
+import scheduler
+import utils
+
+#===============================================================================
+# Function recording executions of keys (start and end events, maximum number
+# of concurrent executions). Keys in fail raise an error.
+#===============================================================================
+class Recorder(object):
+    def __init__(self, fail=None, delay=0.05):
+        self.lock = threading.Lock()
+        self.events = []
+        self.running = 0
+        self.max_running = 0
+        self.fail = fail or []
+        self.delay = delay
+
+    def __call__(self, key):
+        with self.lock:
+            self.events.append(("start", key))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+            self.events.append(("end", key))
+        if key in self.fail:
+            raise utils.ExecError("%s failed" % key)
+
+    def started(self):
+        return [key for event, key in self.events if event == "start"]
+
+    def index(self, event, key):
+        return self.events.index((event, key))
+
+#===============================================================================
+#===============================================================================
+class RunTest(unittest.TestCase):
+    def test_sequential_order(self):
+        for depends in [None, {}]:
+            recorder = Recorder(delay=0)
+            scheduler.run(["c", "a", "b"], depends, recorder, max_workers=4)
+            self.assertEqual(recorder.started(), ["c", "a", "b"])
+            self.assertEqual(recorder.max_running, 1)
+
+    def test_sequential_dependencies_order(self):
+        recorder = Recorder(delay=0)
+        scheduler.run(["c", "a", "b"], {"c": ["b"]}, recorder, max_workers=1)
+        self.assertEqual(recorder.started(), ["b", "c", "a"])
+
+    def test_dependencies(self):
+        recorder = Recorder()
+        depends = {"b": ["a"], "c": ["a"], "d": ["b", "c"]}
+        scheduler.run(["a", "b", "c", "d"], depends, recorder, max_workers=4)
+        for key, deps in depends.items():
+            for dep in deps:
+                self.assertLess(recorder.index("end", dep),
+                        recorder.index("start", key))
+        # b and c are independent
+        self.assertEqual(recorder.max_running, 2)
+
+    def test_max_workers(self):
+        keys = ["k%d" % i for i in range(8)]
+        recorder = Recorder()
+        scheduler.run(keys, {"k7": ["k0"]}, recorder, max_workers=3)
+        self.assertEqual(sorted(recorder.started()), keys)
+        self.assertEqual(recorder.max_running, 3)
+
+    def test_cycle(self):
+        recorder = Recorder()
+        self.assertRaises(utils.ExecError, scheduler.run, ["a", "b"],
+                {"a": ["b"], "b": ["a"]}, recorder, max_workers=2)
+        self.assertEqual(recorder.events, [])
+
+    def test_failure(self):
+        recorder = Recorder(fail=["a"])
+        with self.assertRaises(utils.ExecError):
+            scheduler.run(["a", "b", "c"], {"b": ["a"]}, recorder,
+                    max_workers=2)
+        # b depends on a, c was already running when a failed
+        self.assertNotIn("b", recorder.started())
+        self.assertIn(("end", "c"), recorder.events)
+
+#===============================================================================
+#===============================================================================
+class JobPoolTest(unittest.TestCase):
+    def test_outside_workers(self):
+        pool = scheduler.JobPool()
+        with pool.take(8) as jobs:
+            self.assertEqual(jobs, 8)
+
+    def test_shared(self):
+        pool = scheduler.JobPool()
+        lock = threading.Lock()
+        taken = []
+        used = []
+        # a and b start together, c after a
+        barrier = threading.Barrier(2)
+        def fct(key):
+            if key != "c":
+                barrier.wait()
+            with pool.take(8) as jobs:
+                with lock:
+                    taken.append(jobs)
+                    used.append(pool.used)
+                time.sleep(0.2 if key == "b" else 0.05)
+        scheduler.run(["a", "b", "c"], {"c": ["a"]}, fct, max_workers=2)
+        self.assertTrue(all([value <= 8 for value in used]))
+        self.assertEqual(sorted(taken[:2]), [4, 4])
+        # c takes the jobs released by a while b is running
+        self.assertEqual(taken[2], 4)
+
+#===============================================================================
+# Failures of tasks executed concurrently, with and without -k.
+#===============================================================================
+class MetaTaskFailureTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = (dragon.OPTIONS, dict(dragon._TASKS),
+                list(dragon.FAILED_TASKS))
+        self.executed = []
+        self.lock = threading.Lock()
+        for name in ["a", "b", "c"]:
+            dragon.add_meta_task(name, name, exechook=self.hook_exec)
+        dragon.add_meta_task("all", "all", subtasks=["a", "b", "c"],
+                depends={"b": ["a"], "c": ["b"]})
+
+    def tearDown(self):
+        dragon.OPTIONS = self.saved[0]
+        dragon._TASKS.clear()
+        dragon._TASKS.update(self.saved[1])
+        dragon.FAILED_TASKS[:] = self.saved[2]
+
+    def set_options(self, keep_going):
+        dragon.OPTIONS = types.SimpleNamespace(keep_going=keep_going,
+                force=False, dryrun=False,
+                jobs=types.SimpleNamespace(job_num=4, make_arg="-j 4"))
+
+    def hook_exec(self, task, args):
+        with self.lock:
+            self.executed.append(task.name)
+        if task.name == "a":
+            raise subprocess.CalledProcessError(1, "false")
+
+    def test_stop(self):
+        self.set_options(keep_going=False)
+        self.assertRaises(SystemExit, dragon.do_task, "all")
+        self.assertEqual(self.executed, ["a"])
+
+    def test_keep_going(self):
+        self.set_options(keep_going=True)
+        dragon.do_task("all")
+        self.assertEqual(self.executed, ["a", "b", "c"])
+        self.assertEqual(dragon.FAILED_TASKS[-1:], ["a"])
+
+if __name__ == "__main__":
+    unittest.main()
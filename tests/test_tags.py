@@ -0,0 +1,90 @@
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dragon
+import tags
+
+#===============================================================================
+# Tags of a real git repository, packed (with peeled annotated tags) and loose.
+#===============================================================================
+class TagIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.repo_dir = os.path.realpath(tempfile.mkdtemp())
+        self.git_dir = os.path.join(self.repo_dir, ".git")
+        self.env = dict(os.environ,
+                GIT_AUTHOR_NAME="test", GIT_AUTHOR_EMAIL="test@test",
+                GIT_COMMITTER_NAME="test", GIT_COMMITTER_EMAIL="test@test")
+        self.git("init", "-q")
+        self.git("commit", "-q", "--allow-empty", "-m", "first")
+        # Packed tags
+        self.git("tag", "prod-1.0.0")
+        self.git("tag", "-a", "-m", "rc", "prod-1.1.0-rc1")
+        self.git("tag", "prod-1.0.1+custom1")
+        self.git("tag", "-a", "-m", "other", "other-2.0.0")
+        self.git("tag", "prod-invalid")
+        self.git("tag", "team/prod-0.1.0")
+        self.git("pack-refs", "--all")
+        # Loose tags (one of them also packed)
+        self.git("commit", "-q", "--allow-empty", "-m", "second")
+        self.git("tag", "-a", "-m", "rc", "prod-1.1.0-rc2")
+        self.git("tag", "prod-0.9.0")
+        self.git("tag", "-f", "prod-1.0.0")
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_dir)
+
+    def git(self, *args):
+        return subprocess.check_output(["git"] + list(args), cwd=self.repo_dir,
+                env=self.env, universal_newlines=True)
+
+    def test_tag_names(self):
+        with open(os.path.join(self.git_dir, "packed-refs"), "r") as fd:
+            self.assertIn("\n^", fd.read())
+        self.assertTrue(os.path.exists(os.path.join(self.git_dir,
+                "refs", "tags", "prod-1.0.0")))
+        self.assertEqual(tags.get_tag_names(self.git_dir),
+                sorted(self.git("tag", "--list").splitlines()))
+
+    def test_versions(self):
+        index = tags.TagIndex(self.git_dir, "prod")
+        self.assertEqual(sorted(index.tags), ["prod-0.9.0", "prod-1.0.0",
+                "prod-1.0.1+custom1", "prod-1.1.0-rc1", "prod-1.1.0-rc2"])
+        self.assertEqual([str(v) for v in index.versions], ["0.9.0", "1.0.0",
+                "1.0.1+custom1", "1.1.0-rc1", "1.1.0-rc2"])
+        self.assertEqual(str(index.get_latest()), "1.1.0-rc2")
+        self.assertEqual(str(index.get_latest_release()), "1.0.0")
+        self.assertEqual(str(index.get_latest_rc()), "1.1.0-rc2")
+        self.assertEqual(str(index.get_latest_custom()), "1.0.1+custom1")
+        self.assertEqual(str(index.get_next_version()), "1.1.0")
+        self.git("tag", "prod-1.1.0")
+        index = tags.TagIndex(self.git_dir, "prod")
+        self.assertEqual(str(index.get_next_version()), "1.1.1")
+        index = tags.TagIndex(self.git_dir, "none")
+        self.assertIsNone(index.get_latest())
+        self.assertEqual(str(index.get_next_version()), "0.0.0")
+
+    def test_get_tag_index(self):
+        subdir = os.path.join(self.repo_dir, "sub")
+        os.makedirs(subdir)
+        index = tags.get_tag_index(subdir, "prod")
+        self.assertEqual(index.git_dir, self.git_dir)
+        self.assertIs(tags.get_tag_index(self.repo_dir, "prod"), index)
+        # Indexes are loaded again when tags change
+        self.git("tag", "prod-2.0.0")
+        index = tags.get_tag_index(self.repo_dir, "prod")
+        self.assertEqual(str(index.get_latest()), "2.0.0")
+        self.git("pack-refs", "--all")
+        self.git("tag", "-d", "prod-2.0.0")
+        index = tags.get_tag_index(self.repo_dir, "prod")
+        self.assertEqual(str(index.get_latest()), "1.1.0-rc2")
+        self.assertEqual(tags.get_tag_names(self.git_dir),
+                sorted(self.git("tag", "--list").splitlines()))
+
+if __name__ == "__main__":
+    unittest.main()
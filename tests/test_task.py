@@ -0,0 +1,168 @@
+import os
+import sys
+import shutil
+import tempfile
+import types
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dragon
+import task
+
+#===============================================================================
+# Tasks skipped when up to date (key of inputs saved in
+# dragon-cache/tasks/<name>.json after a successful execution).
+#===============================================================================
+class UpToDateTest(unittest.TestCase):
+    def setUp(self):
+        self.workspace_dir = os.path.realpath(tempfile.mkdtemp())
+        self.saved = (dragon.OPTIONS, dragon.WORKSPACE_DIR, dragon.OUT_DIR,
+                list(dragon.FAILED_TASKS))
+        dragon.WORKSPACE_DIR = self.workspace_dir
+        dragon.OUT_DIR = os.path.join(self.workspace_dir, "out")
+        self.set_options()
+        self.executed = 0
+        self.fail = False
+        self.task = task.Task("gen", "gen", exechook=self.hook_exec,
+                inputs=["src"], outputs=["{OUT_DIR}/gen/*.txt"])
+        self.write(os.path.join("src", "input.txt"), "input")
+
+    def tearDown(self):
+        (dragon.OPTIONS, dragon.WORKSPACE_DIR, dragon.OUT_DIR,
+                dragon.FAILED_TASKS[:]) = self.saved
+        shutil.rmtree(self.workspace_dir)
+
+    def set_options(self, force=False, dryrun=False):
+        dragon.OPTIONS = types.SimpleNamespace(force=force, dryrun=dryrun,
+                keep_going=True)
+
+    def write(self, path, data):
+        filepath = os.path.join(self.workspace_dir, path)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, "w") as fd:
+            fd.write(data)
+
+    def hook_exec(self, task, args):
+        self.executed += 1
+        if self.fail:
+            raise subprocess.CalledProcessError(1, "gen")
+        if not dragon.OPTIONS.dryrun:
+            self.write(os.path.join("out", "gen", "output.txt"), "output")
+
+    def get_key_path(self):
+        return os.path.join(dragon.OUT_DIR, "dragon-cache", "tasks", "gen.json")
+
+    def check_execute(self, executed, args=None):
+        count = self.executed
+        self.task.execute(args)
+        self.assertEqual(self.executed - count, 1 if executed else 0)
+
+    def test_unchanged(self):
+        self.check_execute(True)
+        self.assertTrue(os.path.exists(self.get_key_path()))
+        self.assertTrue(self.task.is_up_to_date(self.task.get_inputs_key()))
+        self.check_execute(False)
+        # Arguments are part of the key
+        self.check_execute(True, ["arg"])
+        self.check_execute(False, ["arg"])
+
+    def test_changed_input(self):
+        self.check_execute(True)
+        self.write(os.path.join("src", "input.txt"), "changed input")
+        self.check_execute(True)
+        self.write(os.path.join("src", "sub", "new.txt"), "new")
+        self.check_execute(True)
+        self.check_execute(False)
+
+    def test_missing_output(self):
+        self.check_execute(True)
+        os.unlink(os.path.join(dragon.OUT_DIR, "gen", "output.txt"))
+        self.assertFalse(self.task.is_up_to_date(self.task.get_inputs_key()))
+        self.check_execute(True)
+        self.check_execute(False)
+
+    def test_force(self):
+        self.check_execute(True)
+        self.set_options(force=True)
+        self.check_execute(True)
+
+    def test_failure(self):
+        self.fail = True
+        self.check_execute(True)
+        self.assertEqual(dragon.FAILED_TASKS[-1:], ["gen"])
+        self.assertFalse(os.path.exists(self.get_key_path()))
+        # The key of changed inputs is not saved by a failure either
+        self.fail = False
+        self.check_execute(True)
+        self.write(os.path.join("src", "input.txt"), "changed input")
+        self.fail = True
+        self.check_execute(True)
+        self.fail = False
+        self.check_execute(True)
+
+    def test_dryrun(self):
+        self.write(os.path.join("out", "gen", "output.txt"), "output")
+        self.set_options(dryrun=True)
+        self.check_execute(True)
+        self.assertFalse(os.path.exists(self.get_key_path()))
+        self.set_options()
+        self.check_execute(True)
+        self.check_execute(False)
+
+#===============================================================================
+# Cache of alchemy variables, with a fake alchemy printing variables of its
+# make files.
+#===============================================================================
+class AlchemyVarsTest(unittest.TestCase):
+    def setUp(self):
+        self.workspace_dir = os.path.realpath(tempfile.mkdtemp())
+        names = ["OPTIONS", "WORKSPACE_DIR", "OUT_DIR", "PACKAGES_DIR",
+                "PRODUCTS_DIR", "ALCHEMY_HOME", "exec_shell"]
+        self.saved = dict([(name, getattr(dragon, name)) for name in names])
+        dragon.OPTIONS = types.SimpleNamespace(colors=False)
+        dragon.WORKSPACE_DIR = self.workspace_dir
+        dragon.OUT_DIR = os.path.join(self.workspace_dir, "out")
+        dragon.PACKAGES_DIR = os.path.join(self.workspace_dir, "packages")
+        dragon.PRODUCTS_DIR = os.path.join(self.workspace_dir, "products")
+        dragon.ALCHEMY_HOME = os.path.join(self.workspace_dir, "alchemy")
+        self.executed = 0
+        dragon.exec_shell = self.exec_shell
+        self.write("envsetup.mk", "include %s\nvar-%%:\n\t@echo $*=$($*)\n" %
+                os.path.join(dragon.ALCHEMY_HOME, "classes", "setup.mk"))
+        self.write(os.path.join("classes", "setup.mk"), "FOO := foo\n")
+        self.task = task.AlchemyTask("alchemy", "alchemy", "product", "variant")
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(dragon, name, value)
+        shutil.rmtree(self.workspace_dir)
+
+    def exec_shell(self, *args, **kwargs):
+        self.executed += 1
+        return self.saved["exec_shell"](*args, **kwargs)
+
+    def write(self, path, data):
+        filepath = os.path.join(dragon.ALCHEMY_HOME, path)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, "w") as fd:
+            fd.write(data)
+
+    def test_cache(self):
+        self.assertEqual(self.task.get_vars(["FOO", "BAR"]),
+                {"FOO": "foo", "BAR": ""})
+        self.assertEqual(self.task.get_var("FOO"), "foo")
+        self.assertEqual(self.executed, 1)
+        # Any file of alchemy (not committed) can change variables
+        self.write(os.path.join("classes", "setup.mk"), "FOO := changed\n")
+        self.assertEqual(self.task.get_var("FOO"), "changed")
+        self.assertEqual(self.executed, 2)
+        self.write(os.path.join("classes", "new.mk"), "\n")
+        self.assertEqual(self.task.get_var("FOO"), "changed")
+        self.assertEqual(self.executed, 3)
+        self.assertEqual(self.task.get_var("FOO"), "changed")
+        self.assertEqual(self.executed, 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+
+import os
+import sys
+import shutil
+import tempfile
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dragon
+import utils
+
+#===============================================================================
+#===============================================================================
+class RelativeSymlinkTest(unittest.TestCase):
+    def setUp(self):
+        self.workspace_dir = os.path.realpath(tempfile.mkdtemp())
+        self.saved = (dragon.OPTIONS, dragon.WORKSPACE_DIR, dragon.OUT_DIR)
+        dragon.OPTIONS = types.SimpleNamespace(dryrun=False)
+        dragon.WORKSPACE_DIR = self.workspace_dir
+        dragon.OUT_DIR = os.path.join(self.workspace_dir, "out")
+
+    def tearDown(self):
+        dragon.OPTIONS, dragon.WORKSPACE_DIR, dragon.OUT_DIR = self.saved
+        shutil.rmtree(self.workspace_dir)
+
+    def test_same_link_twice(self):
+        src = os.path.join(dragon.OUT_DIR, "final", "etc", "manifest.xml")
+        dst = os.path.join(dragon.OUT_DIR, "manifest.xml")
+        os.makedirs(os.path.dirname(src))
+        with open(src, "w") as fd:
+            fd.write("manifest")
+        for _ in range(2):
+            utils.relative_symlink(src, dst)
+            self.assertEqual(os.readlink(dst),
+                    os.path.join("final", "etc", "manifest.xml"))
+            self.assertEqual(os.path.realpath(dst), src)
+
+if __name__ == "__main__":
+    unittest.main()
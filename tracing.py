@@ -0,0 +1,149 @@
+
+import sys
+import os
+import logging
+import json
+import time
+import threading
+import contextlib
+
+# Environment variable giving the trace file to child processes
+TRACE_FILE_ENV = "DRAGON_TRACE_FILE"
+
+# File descriptor of the trace file (None if tracing is disabled)
+_FD = None
+# True if this process created the trace file (and shall terminate it)
+_OWNER = False
+# Start time of the process (us)
+_START_TIME = 0
+_LOCK = threading.Lock()
+
+#===============================================================================
+# Trace of execution in Chrome trace event format (json array), to be opened
+# with chrome://tracing or https://ui.perfetto.dev.
+#
+# The top level process creates the file and child processes (restarted for
+# another product/variant or in docker) append their events to it, so all
+# processes share the same timeline.
+#===============================================================================
+
+#===============================================================================
+# Get current wall time in microseconds.
+#===============================================================================
+def _now():
+    return int(time.time() * 1000000)
+
+#===============================================================================
+# Get an identifier of the current thread.
+#===============================================================================
+def _get_tid():
+    if hasattr(threading, "get_native_id"):
+        return threading.get_native_id()
+    return threading.get_ident()
+
+#===============================================================================
+# Write an event in the trace file. Each event is written with a single write
+# so events of concurrent processes are not mixed.
+#===============================================================================
+def _write(event, first=False):
+    data = ("" if first else ",\n") + json.dumps(event, default=str)
+    with _LOCK:
+        if _FD is not None:
+            os.write(_FD, data.encode("utf-8"))
+
+#===============================================================================
+# Setup tracing.
+# filepath: trace file to create (--trace option). If None, tracing is enabled
+# only if a parent process gave a trace file in the environment.
+# close() shall be called when the process ends.
+#===============================================================================
+def setup(filepath=None):
+    global _FD, _OWNER, _START_TIME
+    if filepath:
+        filepath = os.path.abspath(filepath)
+        _FD = os.open(filepath,
+                os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+        _OWNER = True
+        os.write(_FD, b"[\n")
+        os.environ[TRACE_FILE_ENV] = filepath
+    elif os.environ.get(TRACE_FILE_ENV, ""):
+        try:
+            _FD = os.open(os.environ[TRACE_FILE_ENV], os.O_WRONLY | os.O_APPEND)
+        except OSError as ex:
+            logging.warning("Unable to open trace file '%s': %s",
+                    os.environ[TRACE_FILE_ENV], str(ex))
+            return
+    else:
+        return
+
+    _START_TIME = _now()
+    _write({
+        "name": "process_name",
+        "ph": "M",
+        "pid": os.getpid(),
+        "tid": _get_tid(),
+        "args": {"name": " ".join([os.path.basename(sys.argv[0])] + sys.argv[1:])},
+    }, first=_OWNER)
+
+#===============================================================================
+# Terminate tracing for this process: add a span for the whole process and
+# close the json array if the file was created by this process.
+#===============================================================================
+def close():
+    global _FD
+    if _FD is None:
+        return
+    add_span(os.path.basename(sys.argv[0]), "process", _START_TIME,
+            _now() - _START_TIME, {"argv": sys.argv, "ppid": os.getppid()})
+    with _LOCK:
+        if _OWNER:
+            os.write(_FD, b"\n]\n")
+        os.close(_FD)
+        _FD = None
+
+#===============================================================================
+# Return True if tracing is enabled.
+#===============================================================================
+def is_enabled():
+    return _FD is not None
+
+#===============================================================================
+# Add a span (complete event) in the trace.
+#===============================================================================
+def add_span(name, cat, start, duration, args=None):
+    _write({
+        "name": name,
+        "cat": cat,
+        "ph": "X",
+        "ts": start,
+        "dur": duration,
+        "pid": os.getpid(),
+        "tid": _get_tid(),
+        "args": args or {},
+    })
+
+#===============================================================================
+# Context manager recording a span around a block of code.
+# Arguments are recorded with the span, with the error if any.
+#===============================================================================
+@contextlib.contextmanager
+def span(name, cat, **args):
+    if _FD is None:
+        yield
+        return
+    start = _now()
+    try:
+        yield
+    except BaseException as ex:
+        args["error"] = "%s: %s" % (type(ex).__name__, str(ex))
+        raise
+    finally:
+        add_span(name, cat, start, _now() - start, args)
+
+#===============================================================================
+# Context manager recording a span around the execution of a command.
+# The span is named with the command without its environment (extra_env).
+#===============================================================================
+def cmd_span(cmd, cwd, extra_env=None, cat="cmd"):
+    name = cmd if len(cmd) <= 80 else cmd[:77] + "..."
+    return span(name, cat, cmd=cmd, cwd=cwd, env=extra_env or {})
@@ -4,6 +4,11 @@
 import os as _os
 import sys as _sys
 import logging as _logging
+import shutil as _shutil
+import errno as _errno
+import shlex as _shlex
+import threading as _threading
+import collections as _collections
 import subprocess as _subprocess
 
 # Detect windows platform to force using msys shell (through 'sh')
@@ -11,6 +16,21 @@ import subprocess as _subprocess
 _mswindows = (_sys.platform == "win32")
 
 import dragon as _dragon
+import tracing as _tracing
+
+# Number of last output lines of a failed command displayed when its output is
+# saved in a task log file
+_TAIL_LINES = 50
+
+# Thread local storage of the current task (to save output in its log file)
+_LOCAL = _threading.local()
+
+# Log files already written by this process (appended), others are truncated
+_TASK_LOGS = set()
+_TASK_LOGS_LOCK = _threading.Lock()
+
+# Functions to call when the build script ends (see run_cleanups)
+_CLEANUPS = []
 
 #===============================================================================
 # Exec call error
@@ -28,68 +48,298 @@ class ExecError(_subprocess.SubprocessError):
 class SetupError(Exception):
     pass
 
+#===============================================================================
+# Set the name of the task being executed by the current thread.
+# Return the previous one.
+#===============================================================================
+def set_current_task(taskname):
+    prev_taskname = getattr(_LOCAL, "taskname", None)
+    _LOCAL.taskname = taskname
+    return prev_taskname
+
+#===============================================================================
+# Get the log file of the task being executed by the current thread
+# (OUT_DIR/logs/<task>.log), 'dragon.log' if outside of any task.
+#===============================================================================
+def get_task_log_path():
+    taskname = getattr(_LOCAL, "taskname", None) or "dragon"
+    filename = "".join([c if c.isalnum() or c in "._-" else "_" for c in taskname])
+    return _os.path.join(_dragon.OUT_DIR, "logs", filename + ".log")
+
+#===============================================================================
+# Get a command as a string to be displayed (argv are quoted).
+#===============================================================================
+def get_cmd_str(cmd):
+    if isinstance(cmd, list):
+        return " ".join([_shlex.quote(arg) for arg in cmd])
+    return cmd
+
+#===============================================================================
+# Get arguments of Popen for a command: argv list is executed directly,
+# string through the shell.
+# On windows (msys), commands are always executed by sh as they can be shell
+# scripts (like alchemake).
+#===============================================================================
+def _get_popen_args(cmd):
+    if isinstance(cmd, list):
+        if _mswindows:
+            return ["sh", "-c", get_cmd_str(cmd)], False
+        return cmd, False
+    elif _mswindows:
+        return "sh -c '%s'" % cmd, False
+    else:
+        return cmd, True
+
 #===============================================================================
 # Execute given command in given directory with given extra environment
 # and get output as a string.
-# If command fails, it will be ignored.
+# The command can be a string (executed by the shell) or an argv list.
+# If command fails, it will be ignored (unless check is True, an ExecError is
+# then raised).
 #===============================================================================
-def exec_shell(cmd, cwd=None, extra_env=None, single_line=True):
+def exec_shell(cmd, cwd=None, extra_env=None, single_line=True, check=False):
     env = _os.environ.copy()
     if extra_env:
         env.update(extra_env)
+    args, shell = _get_popen_args(cmd)
     try:
-        if _mswindows:
-            process = _subprocess.Popen("sh -c '%s'" % cmd, cwd=cwd, env=env,
-                    stdout=_subprocess.PIPE, shell=False, universal_newlines=True)
-        else:
-            process = _subprocess.Popen(cmd, cwd=cwd, env=env,
-                    stdout=_subprocess.PIPE, shell=True, universal_newlines=True)
+        with _tracing.cmd_span(get_cmd_str(cmd), cwd, extra_env, cat="shell"):
+            process = _subprocess.Popen(args, cwd=cwd, env=env,
+                    stdout=_subprocess.PIPE, shell=shell, universal_newlines=True)
+            output = process.communicate()[0]
+        if check and process.returncode != 0:
+            raise ExecError("Command '%s' failed (%d)" %
+                    (get_cmd_str(cmd), process.returncode))
         if single_line:
-            return process.communicate()[0].replace("\n", " ").strip()
+            return output.replace("\n", " ").strip()
         else:
-            return process.communicate()[0]
+            return output
     except OSError as ex:
+        if check:
+            raise ExecError("%s: %s" % (get_cmd_str(cmd), str(ex)))
         _logging.warning("%s: %s", cmd, str(ex))
         return ""
 
 #===============================================================================
 # Execute the given command in given directory with given extra environment.
+# The command can be a string (executed by the shell) or an argv list
+# (executed directly, without any quoting issue).
+# With the --task-logs option, the output is saved in the log file of the
+# current task and only its last lines are displayed if the command fails.
 #===============================================================================
 def exec_cmd(cmd, cwd=None, extra_env=None, dryrun=None, dryrun_arg=None):
     if not cwd:
         cwd = _dragon.WORKSPACE_DIR
     if dryrun is None:
         dryrun = _dragon.OPTIONS.dryrun
-    # Add extra environment variables before command
+    trace_span = _tracing.cmd_span(get_cmd_str(cmd), cwd, extra_env)
+    # Extra environment variables are given to the process, only displayed
+    # before the command
+    env = None
+    env_str = ""
     if extra_env:
-        env = " ".join(['%s="%s"' % (key, extra_env[key])
-                for key in sorted(extra_env.keys())])
-        cmd = env + " " + cmd
+        env = _os.environ.copy()
+        env.update(extra_env)
+        env_str = " ".join(['%s="%s"' % (key, extra_env[key])
+                for key in sorted(extra_env.keys())]) + " "
     # Execute command unless in dry mode
     if dryrun:
         if not dryrun_arg:
-            _logging.info("Dry run in '%s': %s", cwd, cmd)
+            _logging.info("Dry run in '%s': %s%s", cwd, env_str, get_cmd_str(cmd))
             return
-        cmd += " " + dryrun_arg
+        if isinstance(cmd, list):
+            cmd = cmd + [dryrun_arg]
+        else:
+            cmd += " " + dryrun_arg
 
-    _logging.info("In '%s': %s", cwd, cmd)
+    cmd_str = env_str + get_cmd_str(cmd)
+    _logging.info("In '%s': %s", cwd, cmd_str)
+    args, shell = _get_popen_args(cmd)
     try:
-        if _mswindows:
-            process = _subprocess.Popen("sh -c '%s'" % cmd, cwd=cwd, shell=False)
-        else:
-            process = _subprocess.Popen(cmd, cwd=cwd, shell=True)
-        process.wait()
-        if process.returncode != 0:
-            raise ExecError("Command failed (returncode=%d)" % process.returncode)
+        with trace_span:
+            if _dragon.OPTIONS.task_logs:
+                returncode = _exec_logged(args, cwd, env, shell, cmd_str)
+            else:
+                process = _subprocess.Popen(args, cwd=cwd, env=env, shell=shell)
+                returncode = process.wait()
+        if returncode != 0:
+            raise ExecError("Command failed (returncode=%d)" % returncode)
     except OSError as ex:
         raise ExecError("Exception caught ([err=%d] %s)" % (ex.errno, ex.strerror))
 
+#===============================================================================
+# Execute a command, saving its output in the log file of the current task.
+# The last lines are kept to be displayed if the command fails.
+#===============================================================================
+def _exec_logged(args, cwd, env, shell, cmd_str):
+    log_path = get_task_log_path()
+    with _TASK_LOGS_LOCK:
+        mode = "ab" if log_path in _TASK_LOGS else "wb"
+        _TASK_LOGS.add(log_path)
+    makedirs(_os.path.dirname(log_path))
+    tail = _collections.deque(maxlen=_TAIL_LINES)
+    with open(log_path, mode) as fd:
+        fd.write(("### In '%s': %s\n" % (cwd, cmd_str)).encode("utf-8"))
+        fd.flush()
+        process = _subprocess.Popen(args, cwd=cwd, env=env, shell=shell,
+                stdout=_subprocess.PIPE, stderr=_subprocess.STDOUT)
+        for line in iter(process.stdout.readline, b""):
+            fd.write(line)
+            tail.append(line)
+        process.stdout.close()
+        process.wait()
+    if process.returncode != 0:
+        _logging.error("Last lines of output (full log in '%s'):", log_path)
+        for line in tail:
+            _sys.stderr.write(line.decode("utf-8", "replace"))
+        _sys.stderr.flush()
+    else:
+        _logging.debug("Output saved in '%s'", log_path)
+    return process.returncode
+
+#===============================================================================
+# Remove a file, symlink or directory tree (like 'rm -rf').
+#===============================================================================
+def _remove(path):
+    try:
+        if _os.path.isdir(path) and not _os.path.islink(path):
+            _shutil.rmtree(path)
+        else:
+            _os.unlink(path)
+    except OSError as ex:
+        if ex.errno != _errno.ENOENT:
+            raise
+
+#===============================================================================
+# Create or replace a symlink (like 'ln -fs').
+#===============================================================================
+def _symlink(target, linkpath):
+    if _os.path.lexists(linkpath):
+        if _os.path.isdir(linkpath) and not _os.path.islink(linkpath):
+            linkpath = _os.path.join(linkpath, _os.path.basename(target))
+        _remove(linkpath)
+    _os.symlink(target, linkpath)
+
+#===============================================================================
+# Move a file or directory (like 'mv -f'), possibly to another file system.
+#===============================================================================
+def _move(src, dst):
+    if _os.path.isdir(dst) and not _os.path.islink(dst):
+        dst = _os.path.join(dst, _os.path.basename(_os.path.normpath(src)))
+    try:
+        _os.replace(src, dst)
+    except OSError as ex:
+        if ex.errno != _errno.EXDEV:
+            raise
+        _remove(dst)
+        _shutil.move(src, dst)
+
+#===============================================================================
+# Copy a file or directory tree (like 'cp -af'): symlinks are copied as
+# symlinks, modes and times are preserved, existing directories are merged.
+#===============================================================================
+def _copy(src, dst):
+    if _os.path.isdir(dst) and not _os.path.islink(dst):
+        dst = _os.path.join(dst, _os.path.basename(_os.path.normpath(src)))
+    _copy_entry(src, dst)
+
+def _copy_entry(src, dst):
+    if _os.path.islink(src):
+        _symlink(_os.readlink(src), dst)
+    elif _os.path.isdir(src):
+        if _os.path.lexists(dst) and not _os.path.isdir(dst):
+            _remove(dst)
+        makedirs(dst)
+        for name in _os.listdir(src):
+            _copy_entry(_os.path.join(src, name), _os.path.join(dst, name))
+        _shutil.copystat(src, dst)
+    else:
+        if _os.path.islink(dst):
+            _remove(dst)
+        _shutil.copy2(src, dst)
+
+#===============================================================================
+# Batch of native file system operations.
+#
+# Operations are recorded and executed in order by run() (or at the end of a
+# 'with' block if no exception occured). A single summary is logged, the
+# equivalent shell commands being logged in debug. In dry run mode, operations
+# are only logged.
+#===============================================================================
+class FsBatch(object):
+    def __init__(self, dryrun=None):
+        self.dryrun = dryrun
+        self.ops = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+
+    def remove(self, path):
+        self.ops.append(("rm -rf %s" % path, _remove, (path,)))
+
+    def symlink(self, target, linkpath):
+        self.ops.append(("ln -fs %s %s" % (target, linkpath),
+                _symlink, (target, linkpath)))
+
+    def move(self, src, dst):
+        self.ops.append(("mv -f %s %s" % (src, dst), _move, (src, dst)))
+
+    def copy(self, src, dst):
+        self.ops.append(("cp -af %s %s" % (src, dst), _copy, (src, dst)))
+
+    def makedirs(self, dirpath):
+        self.ops.append(("mkdir -p %s" % dirpath, makedirs, (dirpath,)))
+
+    def run(self):
+        dryrun = self.dryrun
+        if dryrun is None:
+            dryrun = _dragon.OPTIONS.dryrun
+        ops, self.ops = self.ops, []
+        prefix = "Dry run: " if dryrun else ""
+        level = _logging.INFO if len(ops) == 1 else _logging.DEBUG
+        if len(ops) > 1:
+            _logging.info("%s%d file operations", prefix, len(ops))
+        for desc, fct, args in ops:
+            _logging.log(level, "%s%s", prefix, desc)
+            if dryrun:
+                continue
+            try:
+                fct(*args)
+            except OSError as ex:
+                raise ExecError("%s: %s" % (desc, ex.strerror or str(ex)))
+
+#===============================================================================
+# Native file system operations, without forking a shell. They keep exec_cmd
+# semantics: the equivalent command is logged and nothing is done in dry run.
+# Missing paths are not errors when removing (like 'rm -rf').
+#===============================================================================
+def remove_path(path, dryrun=None):
+    with FsBatch(dryrun) as batch:
+        batch.remove(path)
+
+def symlink(target, linkpath, dryrun=None):
+    with FsBatch(dryrun) as batch:
+        batch.symlink(target, linkpath)
+
+def move_path(src, dst, dryrun=None):
+    with FsBatch(dryrun) as batch:
+        batch.move(src, dst)
+
+def copy_path(src, dst, dryrun=None):
+    with FsBatch(dryrun) as batch:
+        batch.copy(src, dst)
+
 #===============================================================================
 # Create a symlink with relative path
 # src : source (target of link)
 # dst : destination (link to create)
+# batch : FsBatch where to add the operation (executed immediately if None)
 #===============================================================================
-def relative_symlink(src, dst):
+def relative_symlink(src, dst, batch=None):
     out_dir = _os.path.realpath(_dragon.OUT_DIR)
     workspace_dir = _os.path.realpath(_dragon.WORKSPACE_DIR)
     if out_dir.startswith(workspace_dir):
@@ -102,13 +352,15 @@ def relative_symlink(src, dst):
             if not _os.path.realpath(path).startswith(workspace_dir):
                 _logging.warning("'%s' is not part of the workspace.", path)
 
-    if _os.path.lexists(dst):
-        if not _os.path.islink(dst):
-            raise ExecError("'%s' should not be a regular file/directory" % dst)
-        exec_cmd("rm -f %s" % dst)
+    if _os.path.lexists(dst) and not _os.path.islink(dst):
+        raise ExecError("'%s' should not be a regular file/directory" % dst)
     makedirs(_os.path.dirname(dst))
-    exec_cmd("ln -fs %s %s" % (_os.path.relpath(
-         src, _os.path.dirname(_os.path.realpath(dst))), dst))
+    # dst may be an existing link, only resolve its directory
+    target = _os.path.relpath(src, _os.path.realpath(_os.path.dirname(dst)))
+    if batch is not None:
+        batch.symlink(target, dst)
+    else:
+        symlink(target, dst)
 
 #===============================================================================
 # Create directory tree if needed with correct access rights.
@@ -152,3 +404,23 @@ def call_script(script_name, args, **kwargs):
     if args:
         cmd.extend(args)
     exec_cmd(" ".join(cmd), dryrun_arg=dryrun, **kwargs)
+
+#===============================================================================
+# Register a function to call when the build script ends. Unlike atexit, the
+# functions are also called at the end of each command executed by the build
+# daemon (in its child process).
+#===============================================================================
+def add_cleanup(fct):
+    _CLEANUPS.append(fct)
+
+#===============================================================================
+# Call the registered cleanup functions (last registered first) and forget
+# them.
+#===============================================================================
+def run_cleanups():
+    while _CLEANUPS:
+        fct = _CLEANUPS.pop()
+        try:
+            fct()
+        except Exception as ex:
+            _logging.warning("Cleanup failed: %s", str(ex))
@@ -2,6 +2,8 @@
 # Due to wildcard import in dragon, import local modules as private
 
 import re as _re
+import copy as _copy
+import functools as _functools
 
 #
 # PyPuf:
@@ -85,6 +87,19 @@ class Version(object):
         else:
             raise ValueError("Invalid version: {}".format(name))
 
+    # Ordering key: two custom versions are equal regardless of their custom
+    # name/number, a non-custom version is older than a custom one
+    def _get_key(self):
+        return (self.major, self.minor, self.patch,
+                self.type, self.build, bool(self.custom))
+
+    # Get a copy of the version with some fields changed
+    def _replace(self, **fields):
+        v = _copy.copy(self)
+        for name, value in fields.items():
+            setattr(v, name, value)
+        return v
+
     def __repr__(self):
         type_to_str = {
             Version.TYPE_ALPHA: "alpha",
@@ -102,83 +117,77 @@ class Version(object):
             name.append("+{}{}".format(self.custom, self.custom_number))
         return "".join(name)
 
+    def __hash__(self):
+        return hash(self._get_key())
+
     def __eq__(self, other):
-        if self.major != other.major:
-            return False
-        if self.minor != other.minor:
-            return False
-        if self.patch != other.patch:
-            return False
-        if self.type != other.type:
-            return False
-        if self.build != other.build:
-            return False
-        # two custom versions are equal regardless of their custom name/number
-        if bool(self.custom) != bool(other.custom):
-            return False
-        return True
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._get_key() == other._get_key()
 
     def __ne__(self, other):
-        return not self.__eq__(other)
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._get_key() != other._get_key()
 
     def __lt__(self, other):
-        if self.major != other.major:
-            return self.major < other.major
-        if self.minor != other.minor:
-            return self.minor < other.minor
-        if self.patch != other.patch:
-            return self.patch < other.patch
-        if self.type != other.type:
-            return self.type < other.type
-        if self.build != other.build:
-            return self.build < other.build
-        # a non-custom version is older than a custom one
-        if not self.custom and other.custom:
-            return True
-        return False
+        return self._get_key() < other._get_key()
 
     def __gt__(self, other):
-        if self.major != other.major:
-            return self.major > other.major
-        if self.minor != other.minor:
-            return self.minor > other.minor
-        if self.patch != other.patch:
-            return self.patch > other.patch
-        if self.type != other.type:
-            return self.type > other.type
-        if self.build != other.build:
-            return self.build > other.build
-        # a custom version is newer than a non-custom one
-        if self.custom and not other.custom:
-            return True
-        return False
+        return self._get_key() > other._get_key()
 
     def __le__(self, other):
-        return not self.__gt__(other)
+        return self._get_key() <= other._get_key()
 
     def __ge__(self, other):
-        return not self.__lt__(other)
+        return self._get_key() >= other._get_key()
 
     # generate a pure release version from the current version
     def as_release(self):
-        v = Version(self.__repr__())
-
-        v.type = Version.TYPE_RELEASE
-        v.custom = None
-        v.custom_number = 0
-        v.type_string = None
-        v.build = 0
-
-        return v
+        return self._replace(type=Version.TYPE_RELEASE, custom=None,
+                custom_number=0, type_string=None, build=0)
 
     # generate a version without custom suffix from the current version
     def as_not_custom(self):
-        v = Version(self.__repr__())
+        return self._replace(custom=None, custom_number=0)
 
-        v.custom = None
-        v.custom_number = 0
 
-        return v
+#
+# Bulk API
+#
+
+# Parse a version, parsed versions are cached (and shall not be modified)
+@_functools.lru_cache(maxsize=4096)
+def parse(name):
+    return Version(name)
+
+
+# Ordering key of a version string, cached as the string can not change
+@_functools.lru_cache(maxsize=4096)
+def _parse_key(name):
+    return Version(name)._get_key()
+
+
+def _get_version_key(item, key):
+    if key is not None:
+        item = key(item)
+    return item._get_key() if isinstance(item, Version) else _parse_key(item)
+
+
+# Sort items (versions or strings) by version, from the oldest.
+# key can give the version (or string) of each item.
+# Raise ValueError if an item is not a valid version.
+def sort_versions(items, key=None, reverse=False):
+    return sorted(items, key=lambda item: _get_version_key(item, key),
+            reverse=reverse)
+
+
+# Get the newest of items (versions or strings), default if there is none.
+# key can give the version (or string) of each item.
+# Raise ValueError if an item is not a valid version.
+def max_version(items, key=None, default=None):
+    return max(items, key=lambda item: _get_version_key(item, key),
+            default=default)
 
 
 def split_uid(uid):
@@ -190,7 +199,7 @@ def split_uid(uid):
         if idx < 0:
             break
         try:
-            _ = Version(uid[idx+1:])
+            _ = parse(uid[idx+1:])
         except ValueError:
             pass
         else:
@@ -339,6 +348,26 @@ def _test():
         assert (v2 <= v1) == res[3]
         assert (v2 < v1) == res[4]
 
+    # bulk API (stable for versions equal regardless of custom suffix)
+    names = ["1.2.3", "0.0.0", "1.2.3+custom2", "1.2.3-rc1", "1.2.3+custom1",
+             "1.10.0-alpha1", "1.2.10"]
+    assert sort_versions(names) == ["0.0.0", "1.2.3-rc1", "1.2.3",
+            "1.2.3+custom2", "1.2.3+custom1", "1.2.10", "1.10.0-alpha1"]
+    assert sort_versions(names, reverse=True)[0] == "1.10.0-alpha1"
+    assert max_version(names) == "1.10.0-alpha1"
+    assert max_version([], default="none") == "none"
+    tags = [("v", "1.2.3"), ("w", "1.2.4-beta1")]
+    assert max_version(tags, key=lambda tag: tag[1]) == ("w", "1.2.4-beta1")
+    assert parse("1.2.3") is parse("1.2.3")
+    v = Version("1.2.3")
+    v.patch = 5
+    assert v > parse("1.2.4") and v == Version("1.2.5")
+    assert len(set([parse("1.2.3+a1"), Version("1.2.3+b2"), parse("1.2.3")])) == 2
+    assert str(parse("1.2.3-rc1+custom1").as_release()) == "1.2.3"
+    assert str(parse("1.2.3-rc1+custom1").as_not_custom()) == "1.2.3-rc1"
+    assert parse("1.2.3-rc1+custom1").as_not_custom() < parse("1.2.3-rc1+custom1")
+    assert str(parse("1.2.3-rc1+custom1")) == "1.2.3-rc1+custom1"
+
     test_split = [
         ("product-variant-1.2.3", "product-variant", "1.2.3"),
         ("product-variant-0.0.0-test", "product-variant", "0.0.0-test"),